@@ -0,0 +1,483 @@
+# Database backends for userdata.
+# db.py uses these classes for everything that differs between database engines.
+
+# Imports {{{
+import re
+import sqlite3
+import collections
+try:
+	import pymysql
+	import pymysql.cursors
+except ImportError:
+	# Only the sqlite backend can be used without pymysql.
+	pymysql = None
+import schema
+# }}}
+
+'''Backends: {{{
+The backend is selected with the "backend" key in db.ini; the default is
+mysql. Both backends accept the statements that userdata uses, which are
+written for MySQL. The mysql backend passes them through unchanged. The sqlite
+backend translates them:
+	- %s placeholders are converted into ?.
+	- INSERT IGNORE becomes INSERT OR IGNORE.
+	- The maximum LIMIT (used for OFFSET without LIMIT) becomes LIMIT -1.
+	- SHOW TABLES, DESCRIBE and SHOW COLUMNS are answered from the SQLite schema, in MySQL format.
+	- Column definitions are converted in CREATE TABLE. An AUTO_INCREMENT
+	  primary key becomes INTEGER PRIMARY KEY AUTOINCREMENT; other
+	  AUTO_INCREMENT columns are filled from the rowid by a trigger. KEY
+	  definitions become separate indexes.
+	- SQLite cannot change columns or keys, so ALTER TABLE rebuilds the table.
+
+Keys in db.ini:
+	- mysql: host, user, password, database.
+	- sqlite: file; optionally mmap-size (in bytes, default 256 MiB) and
+	  statement-cache (number of prepared statements kept per connection, default 256).
+}}}'''
+
+class MySQL: # {{{
+	'MariaDB or MySQL server, through pymysql.'
+	def __init__(self, cfg): # {{{
+		if pymysql is None:
+			raise ImportError('the mysql backend requires pymysql')
+		self.cfg = {key: cfg.pop(key) for key in ('host', 'user', 'password', 'database')}
+		assert len(cfg) == 0
+		self.OperationalError = pymysql.OperationalError
+		self.Error = pymysql.MySQLError
+	# }}}
+	def connect(self, autocommit = False): # {{{
+		return pymysql.connect(autocommit = autocommit, **self.cfg)
+	# }}}
+	def stream_cursor(self, connection): # {{{
+		'Return an unbuffered cursor.'
+		return connection.cursor(pymysql.cursors.SSCursor)
+	# }}}
+	def insert_many(self, connection, c, cmd, rows): # {{{
+		'Run an INSERT command for every row, and return the list of inserted ids.'
+		# A multi-row statement only reports one id, and the others cannot be
+		# derived from it: pymysql splits long batches into several statements,
+		# and with innodb_autoinc_lock_mode 2 the ids need not be consecutive.
+		# So the rows are inserted one by one, in the caller's transaction.
+		ret = []
+		for row in rows:
+			c.execute(cmd, row)
+			ret.append(c.lastrowid)
+		return ret
+	# }}}
+	def describe_owner(self, c, prefix): # {{{
+		'Return the columns of all tables that start with prefix; see db.bg_describe_owner().'
+		pattern = like_prefix(prefix)
+		c.execute('''SELECT c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE, c.IS_NULLABLE, c.COLUMN_DEFAULT, c.EXTRA, c.COLUMN_KEY, s.INDEX_NAME
+			FROM information_schema.COLUMNS c
+			LEFT JOIN (
+				SELECT TABLE_NAME, INDEX_NAME, MIN(COLUMN_NAME) AS COLUMN_NAME
+				FROM information_schema.STATISTICS
+				WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME LIKE %s AND NON_UNIQUE = 0 AND INDEX_NAME <> 'PRIMARY'
+				GROUP BY TABLE_NAME, INDEX_NAME
+				HAVING COUNT(*) = 1
+			) s ON s.TABLE_NAME = c.TABLE_NAME AND s.COLUMN_NAME = c.COLUMN_NAME
+			WHERE c.TABLE_SCHEMA = DATABASE() AND c.TABLE_NAME LIKE %s
+			ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION''', (pattern, pattern))
+		return c.fetchall()
+	# }}}
+	def add_index(self, c, table, name, columns): # {{{
+		'Add a non-unique index to a table, unless it has an index with that name. Returns whether the index was added.'
+		c.execute('SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s', (table, name))
+		if c.fetchone()[0] > 0:
+			return False
+		c.execute('ALTER TABLE %s ADD KEY %s (%s)' % (table, name, ', '.join(columns)))
+		return True
+	# }}}
+	def union(self, selects): # {{{
+		'''Combine selects with UNION ALL; see query.union().
+		Every select is put in parentheses, so it can have its own ORDER BY and
+		LIMIT, and the columns do not need unique names. The server ignores ORDER
+		BY in a part without LIMIT, so those parts get the maximum LIMIT.'''
+		parts = []
+		for select in selects:
+			if ' ORDER BY ' in select and ' LIMIT ' not in select:
+				select += ' LIMIT 18446744073709551615'
+			parts.append('(%s)' % select)
+		return ' UNION ALL '.join(parts)
+	# }}}
+	def owner_sizes(self, catalog, prefix, owners): # {{{
+		'''Return the query and arguments for reading the number of tables, records and bytes of owners; see db.bg_inventory().
+		The numbers of records are estimates from the table statistics.'''
+		return '''SELECT c.owner, COUNT(*), SUM(t.TABLE_ROWS), SUM(t.DATA_LENGTH + t.INDEX_LENGTH)
+			FROM {} c
+			LEFT JOIN information_schema.TABLES t ON t.TABLE_SCHEMA = DATABASE() AND t.TABLE_NAME = CONCAT(%s, c.owner, c.name)
+			WHERE c.owner IN ({})
+			GROUP BY c.owner'''.format(catalog, ', '.join(['%s'] * len(owners))), (prefix,) + tuple(owners)
+	# }}}
+# }}}
+
+def like_prefix(prefix): # {{{
+	'Return a LIKE pattern (with backslash as escape character) that matches all names that start with prefix.'
+	return prefix.replace('\\', '\\\\').replace('_', '\\_').replace('%', '\\%') + '%'
+# }}}
+
+# SQLite. {{{
+class SQLite: # {{{
+	'SQLite database file, in WAL mode.'
+	def __init__(self, cfg): # {{{
+		self.file = cfg.pop('file')
+		self.mmap_size = int(cfg.pop('mmap-size', 256 << 20))
+		self.statement_cache = int(cfg.pop('statement-cache', 256))
+		assert len(cfg) == 0
+		self.OperationalError = sqlite3.OperationalError
+		self.Error = sqlite3.Error
+	# }}}
+	def connect(self, autocommit = False): # {{{
+		# SQLite connections always commit every statement, unless begin() was called.
+		return SQLiteConnection(self)
+	# }}}
+	def stream_cursor(self, connection): # {{{
+		# SQLite cursors produce rows as they are fetched.
+		return connection.cursor()
+	# }}}
+	def insert_many(self, connection, c, cmd, rows): # {{{
+		'Run an INSERT command for every row, and return the list of inserted ids.'
+		# sqlite3 does not report ids for executemany(), and statements are cheap, so insert the rows one by one.
+		ret = []
+		for row in rows:
+			c.execute(cmd, row)
+			ret.append(c.lastrowid)
+		return ret
+	# }}}
+	def describe_owner(self, c, prefix): # {{{
+		'Return the columns of all tables that start with prefix; see db.bg_describe_owner().'
+		c = c.cursor
+		tables = [row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ESCAPE '\\' ORDER BY name", (like_prefix(prefix),)).fetchall()]
+		ret = []
+		for table in tables:
+			for name, type, nullable, key, default, extra, index, pk in table_columns(c, table):
+				ret.append((table, name, type, nullable, default, extra, key, index))
+		return ret
+	# }}}
+	def add_index(self, c, table, name, columns): # {{{
+		'Add a non-unique index to a table, unless it has an index with that name. Returns whether the index was added.'
+		c = c.cursor
+		# Index names are per database, so the name is prefixed with the table name, like in CREATE TABLE.
+		name = '%s_%s' % (table, name)
+		if c.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone() is not None:
+			return False
+		c.execute('CREATE INDEX %s ON %s (%s)' % (name, table, ', '.join(columns)))
+		return True
+	# }}}
+	def union(self, selects): # {{{
+		'''Combine selects with UNION ALL; see query.union().
+		SQLite does not allow parentheses around the parts of a UNION, so every
+		select is a derived table; SQLite renames duplicate column names in it.'''
+		return ' UNION ALL '.join('SELECT * FROM (%s) AS u%d' % (select, i) for i, select in enumerate(selects))
+	# }}}
+	def owner_sizes(self, catalog, prefix, owners): # {{{
+		'''Return the query and arguments for reading the number of tables, records and bytes of owners; see db.bg_inventory().
+		SQLite keeps no statistics, so only the tables are counted.'''
+		return 'SELECT owner, COUNT(*), NULL, NULL FROM {} WHERE owner IN ({}) GROUP BY owner'.format(catalog, ', '.join(['%s'] * len(owners))), tuple(owners)
+	# }}}
+# }}}
+
+class SQLiteConnection: # {{{
+	'SQLite connection with the interface of a pymysql connection.'
+	def __init__(self, backend): # {{{
+		self.backend = backend
+		self.connection = None
+		self.ping(True)
+	# }}}
+	def ping(self, reconnect = False): # {{{
+		if self.connection is not None or not reconnect:
+			return
+		# Statements are prepared once per connection and kept in its statement cache.
+		self.connection = sqlite3.connect(self.backend.file, isolation_level = None, check_same_thread = False, cached_statements = self.backend.statement_cache)
+		self.connection.execute('PRAGMA journal_mode = WAL')
+		self.connection.execute('PRAGMA synchronous = NORMAL')
+		self.connection.execute('PRAGMA busy_timeout = 10000')
+		self.connection.execute('PRAGMA mmap_size = %d' % self.backend.mmap_size)
+	# }}}
+	def cursor(self, kind = None): # {{{
+		return SQLiteCursor(self.connection.cursor())
+	# }}}
+	def begin(self): # {{{
+		# Take the write lock immediately; upgrading a read lock later can fail when another connection writes.
+		self.connection.execute('BEGIN IMMEDIATE')
+	# }}}
+	def commit(self): # {{{
+		self.connection.commit()
+	# }}}
+	def rollback(self): # {{{
+		self.connection.rollback()
+	# }}}
+	def close(self): # {{{
+		if self.connection is not None:
+			self.connection.close()
+			self.connection = None
+	# }}}
+# }}}
+
+class SQLiteCursor: # {{{
+	'SQLite cursor that accepts the MySQL statements that userdata uses.'
+	def __init__(self, cursor): # {{{
+		self.cursor = cursor
+		self.rows = None	# Result of a statement that was not passed to SQLite.
+	# }}}
+	def __enter__(self): # {{{
+		return self
+	# }}}
+	def __exit__(self, *a): # {{{
+		self.close()
+	# }}}
+	def execute(self, cmd, args = ()): # {{{
+		self.rows = None
+		r = re.match(r'^\s*(DESCRIBE|SHOW\s+COLUMNS\s+FROM)\s+(\w+)\s*$', cmd, re.I)
+		if r is not None:
+			self.rows = [row[:6] for row in table_columns(self.cursor, r.group(2))]
+			return
+		r = re.match(r'^\s*SHOW\s+TABLES(\s+LIKE\s+%s)?\s*$', cmd, re.I)
+		if r is not None:
+			cmd = "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'"
+			if r.group(1) is not None:
+				cmd += " AND name LIKE ? ESCAPE '\\'"
+			self.cursor.execute(cmd + ' ORDER BY name', args)
+			return
+		r = re.match(r'^\s*CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?(\w+)\s*\((.*)\)\s*$', cmd, re.I | re.S)
+		if r is not None:
+			for statement in create_statements(r.group(2), r.group(3), r.group(1) is not None):
+				self.cursor.execute(statement)
+			return
+		r = re.match(r'^\s*ALTER\s+TABLE\s+(\w+)\s+(.*)$', cmd, re.I | re.S)
+		if r is not None:
+			alter_table(self.cursor, r.group(1), r.group(2))
+			return
+		if re.match(r'^\s*SELECT\s+@@auto_increment_increment\s*$', cmd, re.I):
+			self.rows = [(1,)]
+			return
+		self.cursor.execute(translate(cmd), args)
+	# }}}
+	def executemany(self, cmd, rows): # {{{
+		self.rows = None
+		self.cursor.executemany(translate(cmd), rows)
+	# }}}
+	def fetchone(self): # {{{
+		if self.rows is not None:
+			return self.rows.pop(0) if len(self.rows) > 0 else None
+		return self.cursor.fetchone()
+	# }}}
+	def fetchmany(self, count): # {{{
+		if self.rows is not None:
+			ret = self.rows[:count]
+			self.rows = self.rows[count:]
+			return tuple(ret)
+		return tuple(self.cursor.fetchmany(count))
+	# }}}
+	def fetchall(self): # {{{
+		if self.rows is not None:
+			ret = self.rows
+			self.rows = []
+			return tuple(ret)
+		return tuple(self.cursor.fetchall())
+	# }}}
+	@property
+	def lastrowid(self): # {{{
+		return self.cursor.lastrowid
+	# }}}
+	@property
+	def rowcount(self): # {{{
+		return self.cursor.rowcount
+	# }}}
+	def close(self): # {{{
+		self.cursor.close()
+	# }}}
+# }}}
+
+def translate(cmd): # {{{
+	'Convert a MySQL statement into SQLite syntax.'
+	cmd = re.sub(r'^(\s*)INSERT\s+IGNORE\b', r'\1INSERT OR IGNORE', cmd, flags = re.I)
+	# MySQL has no way to say "no limit", so query.compile_query() uses the maximum value, which is too large for SQLite.
+	cmd = cmd.replace('LIMIT 18446744073709551615', 'LIMIT -1')
+	return re.sub('%([s%])', lambda r: '?' if r.group(1) == 's' else '%', cmd)
+# }}}
+
+def split_definitions(body): # {{{
+	'Split the body of CREATE TABLE or ALTER TABLE at commas that are not inside parentheses or quotes.'
+	ret = []
+	depth = 0
+	quote = None
+	current = ''
+	for char in body:
+		if quote is not None:
+			if char == quote:
+				quote = None
+		elif char in '\'"`':
+			quote = char
+		elif char == '(':
+			depth += 1
+		elif char == ')':
+			depth -= 1
+		elif char == ',' and depth == 0:
+			ret.append(current.strip())
+			current = ''
+			continue
+		current += char
+	if current.strip() != '':
+		ret.append(current.strip())
+	return ret
+# }}}
+
+def trigger_name(table, column): # {{{
+	'Name of the trigger that fills an AUTO_INCREMENT column which is not the primary key.'
+	return '%s_%s_ai' % (table, column)
+# }}}
+
+def create_statements(table, body, if_not_exists): # {{{
+	'Return the SQLite statements for a MySQL CREATE TABLE statement.'
+	exists = ' IF NOT EXISTS' if if_not_exists else ''
+	columns = []
+	primary = []
+	constraints = []
+	indexes = []
+	for item in split_definitions(body):
+		r = re.match(r'^PRIMARY\s+KEY\s*\((.*)\)$', item, re.I)
+		if r is not None:
+			primary = [c.strip() for c in r.group(1).split(',')]
+			continue
+		r = re.match(r'^UNIQUE(?:\s+(?:KEY|INDEX))?(?:\s+\w+)?\s*\(\s*([a-zA-Z_]\w*(?:\s*,\s*[a-zA-Z_]\w*)*)\s*\)$', item, re.I)
+		if r is not None:
+			constraints.append('UNIQUE (%s)' % r.group(1))
+			continue
+		r = re.match(r'^(?:KEY|INDEX)(?:\s+(\w+))?\s*\(\s*([a-zA-Z_]\w*(?:\s*,\s*[a-zA-Z_]\w*)*)\s*\)$', item, re.I)
+		if r is not None:
+			cols = [c.strip() for c in r.group(2).split(',')]
+			# Index names are per database in SQLite, and per table in MySQL.
+			indexes.append('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' % (table, r.group(1) or '_'.join(cols), table, ', '.join(cols)))
+			continue
+		name, definition = item.split(None, 1)
+		column, plain = schema.parse_definition(name, definition)
+		columns.append((name, column, plain))
+		if column.primary:
+			primary.append(name)
+	definitions = []
+	triggers = []
+	for name, column, plain in columns:
+		plain = re.sub(r'\s+AUTO_INCREMENT\b', '', plain, flags = re.I)
+		if column.auto_increment:
+			if primary == [name]:
+				definitions.append('%s INTEGER PRIMARY KEY AUTOINCREMENT' % name)
+				primary = []
+				continue
+			# A NULL value is replaced by the trigger, so it must be allowed.
+			plain = re.sub(r'\s+NOT\s+NULL\b', '', plain, flags = re.I)
+			triggers.append('CREATE TRIGGER IF NOT EXISTS {0} AFTER INSERT ON {1} WHEN NEW.{2} IS NULL BEGIN UPDATE {1} SET {2} = NEW.rowid WHERE rowid = NEW.rowid; END'.format(trigger_name(table, name), table, name))
+		definitions.append('%s %s%s' % (name, plain, ' UNIQUE' if column.unique else ''))
+	if len(primary) > 0:
+		constraints.insert(0, 'PRIMARY KEY (%s)' % ', '.join(primary))
+	return ['CREATE TABLE%s %s (%s)' % (exists, table, ', '.join(definitions + constraints))] + indexes + triggers
+# }}}
+
+def table_columns(c, table): # {{{
+	'''Return the columns of a table in MySQL terms.
+	Each column is (name, type, nullable, key, default, extra, unique index or None, position in primary key).'''
+	sql = c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+	if sql is None:
+		raise sqlite3.OperationalError('no such table: %s' % table)
+	triggers = set(row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (table,)).fetchall())
+	unique = {}
+	for index in c.execute('PRAGMA index_list(%s)' % table).fetchall():
+		if not index[2] or index[3] == 'pk':
+			continue
+		cols = c.execute('PRAGMA index_info("%s")' % index[1]).fetchall()
+		if len(cols) == 1:
+			unique.setdefault(cols[0][2], index[1])
+	info = c.execute('PRAGMA table_info(%s)' % table).fetchall()
+	primary = [row[1] for row in info if row[5] > 0]
+	ret = []
+	for cid, name, type, notnull, default, pk in info:
+		auto = trigger_name(table, name) in triggers or (primary == [name] and type.upper() == 'INTEGER' and 'AUTOINCREMENT' in sql[0].upper())
+		key = 'PRI' if pk else 'UNI' if name in unique else ''
+		ret.append((name, type, 'NO' if notnull or pk or auto else 'YES', key, default, 'auto_increment' if auto else '', unique.get(name), pk))
+	return ret
+# }}}
+
+def alter_table(c, table, clauses): # {{{
+	'''Run a MySQL ALTER TABLE statement on an SQLite table.
+	SQLite can only add and remove simple columns, so the table is rebuilt with the new definition and the data is copied.'''
+	columns = collections.OrderedDict()
+	for name, type, nullable, key, default, extra, index, pk in table_columns(c, table):
+		plain = type
+		if nullable == 'NO':
+			plain += ' NOT NULL'
+		if default is not None:
+			plain += ' DEFAULT ' + default
+		if extra:
+			plain += ' AUTO_INCREMENT'
+		columns[name] = {'plain': plain, 'pk': pk, 'unique': index, 'copy': True}
+	for clause in split_definitions(clauses):
+		r = re.match(r'^(ADD|MODIFY)\s+COLUMN\s+(\w+)\s+(.*)$', clause, re.I | re.S)
+		if r is not None:
+			column, plain = schema.parse_definition(r.group(2), r.group(3))
+			if r.group(1).upper() == 'ADD':
+				columns[r.group(2)] = {'plain': plain, 'pk': 0, 'unique': column.unique, 'copy': False}
+			else:
+				columns[r.group(2)]['plain'] = plain
+			continue
+		r = re.match(r'^DROP\s+COLUMN\s+(\w+)$', clause, re.I)
+		if r is not None:
+			del columns[r.group(1)]
+			continue
+		if re.match(r'^DROP\s+PRIMARY\s+KEY$', clause, re.I):
+			for name in columns:
+				columns[name]['pk'] = 0
+			continue
+		r = re.match(r'^ADD\s+PRIMARY\s+KEY\s*\((.*)\)$', clause, re.I)
+		if r is not None:
+			for i, name in enumerate(c.strip() for c in r.group(1).split(',')):
+				columns[name]['pk'] = i + 1
+			continue
+		r = re.match(r'^ADD\s+UNIQUE\s*\(\s*(\w+)\s*\)$', clause, re.I)
+		if r is not None:
+			columns[r.group(1)]['unique'] = True
+			continue
+		r = re.match(r'^DROP\s+INDEX\s+(\w+)$', clause, re.I)
+		if r is not None:
+			for name in columns:
+				if columns[name]['unique'] == r.group(1):
+					columns[name]['unique'] = None
+			continue
+		raise ValueError('unsupported ALTER TABLE clause for sqlite: %s' % clause)
+	body = ['%s %s%s' % (name, col['plain'], ' UNIQUE' if col['unique'] else '') for name, col in columns.items()]
+	primary = sorted((col['pk'], name) for name, col in columns.items() if col['pk'])
+	if len(primary) > 0:
+		body.append('PRIMARY KEY (%s)' % ', '.join(name for pk, name in primary))
+	copy = ', '.join(name for name, col in columns.items() if col['copy'])
+	old = table + '__rebuild'
+	indexes = c.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,)).fetchall()
+	triggers = c.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (table,)).fetchall()
+	c.execute('SAVEPOINT rebuild')
+	try:
+		# Indexes and triggers keep their names when the table is renamed, so remove them first.
+		for name, sql in indexes:
+			c.execute('DROP INDEX %s' % name)
+		for name, in triggers:
+			c.execute('DROP TRIGGER %s' % name)
+		c.execute('ALTER TABLE %s RENAME TO %s' % (table, old))
+		for statement in create_statements(table, ', '.join(body), False):
+			c.execute(statement)
+		if copy != '':
+			c.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (table, copy, copy, old))
+		c.execute('DROP TABLE %s' % old)
+		for name, sql in indexes:
+			try:
+				c.execute(sql)
+			except sqlite3.OperationalError:
+				# The index used a column that was dropped.
+				pass
+	except:
+		c.execute('ROLLBACK TO rebuild')
+		c.execute('RELEASE rebuild')
+		raise
+	c.execute('RELEASE rebuild')
+# }}}
+# }}}
+
+backends = {'mysql': MySQL, 'sqlite': SQLite}
+
+# vim: set foldmethod=marker :
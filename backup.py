@@ -0,0 +1,406 @@
+# Backup and restore of all data of a user.
+# A backup is written and read in chunks, so its size is not limited by memory.
+
+# Imports {{{
+import re
+import sys
+import time
+import json
+import base64
+import db
+import schema
+import backends
+# }}}
+
+'''Format: {{{
+A backup is a text file with one JSON object per line. Every object has a
+'type' key; the other keys depend on it:
+	- 'userdata-backup': first line; 'version' is the format version, 'user'
+	  is the name of the user that the backup was made for.
+	- 'game': a game of the user, with 'id', 'name', 'fullname', 'password'
+	  (the stored hash) and 'shared' (whether its managed players use shared
+	  storage).
+	- 'player': an external player of the user, with 'id', 'url', 'name',
+	  'fullname', 'language' and 'is_default'.
+	- 'managed': a managed player of one of the games, with 'id', 'game',
+	  'name', 'fullname', 'language', 'email' and 'password'.
+	- 'table': a table, with 'owner' ('g' for a game, 'p' for an external
+	  player, 'm' for a managed player, 's' for the shared tables of a game),
+	  'id' (of the game or player), 'name', 'definition' (the body of the
+	  CREATE TABLE statement) and 'columns'.
+	- 'rows': records of the last table, as lists of values in the order of
+	  its columns; there is at most one chunk of records per line.
+	- 'end': last line; 'tables' and 'rows' are the numbers of tables and records.
+The ids are the ids at the time of the backup; restoring gives everything
+new ids. Games and players are listed before the tables that use them. Values
+are stored as JSON, except bytes, which are stored as {"base64": data}, and
+dates, times and decimals, which are stored as strings.
+}}}'''
+
+version = 1
+
+def encode(value): # {{{
+	'Convert a value that JSON does not support.'
+	if isinstance(value, (bytes, bytearray)):
+		return {'base64': base64.b64encode(value).decode('ascii')}
+	return str(value)
+# }}}
+
+def line(obj): # {{{
+	return json.dumps(obj, default = encode, separators = (',', ':'))
+# }}}
+
+def decode(value): # {{{
+	if isinstance(value, dict):
+		return base64.b64decode(value['base64'])
+	return value
+# }}}
+
+def table(name): # {{{
+	return db.global_prefix + name
+# }}}
+
+# Column types that a definition in a backup can have, after schema.normalize_type(): a name, optionally with numbers or quoted values in parentheses.
+type_re = re.compile(r"^[a-z]\w*(\((\d+(,\d+)*|'([^'\\]|'')*'(,'([^'\\]|'')*')*)\))?( (unsigned|signed|zerofill))*$")
+
+def parse_definition(definition, names): # {{{
+	'''Check the definition of a table in a backup, and return it as it must be passed to CREATE TABLE.
+	The definition must be written by schema.create_body(), like export
+	does; it is parsed into columns, which are written again with
+	create_body(), so nothing else can get into the statement. names is the list of columns of the
+	table in the backup; they must be the columns of the definition.'''
+	if not isinstance(definition, str):
+		raise ValueError('invalid table definition in backup')
+	columns = {}
+	primary = []
+	for item in backends.split_definitions(definition):
+		r = re.match(r'^PRIMARY\s+KEY\s*\((.*)\)$', item, re.I)
+		if r is not None:
+			primary.extend(c.strip() for c in r.group(1).split(','))
+			continue
+		if re.match(r'^KEY\s*\(\s*\w+\s*\)$', item, re.I):
+			# Index for an auto increment column; create_body() adds it again.
+			continue
+		parts = item.split(None, 1)
+		if len(parts) != 2 or not re.match('^[a-zA-Z_$][a-zA-Z_0-9$]*$', parts[0]) or parts[0] in columns:
+			raise ValueError('invalid column definition in backup: %s' % item[:100])
+		try:
+			column, plain = schema.parse_definition(*parts)
+		except AttributeError:
+			# The definition does not start with a type.
+			raise ValueError('invalid column definition in backup: %s' % item[:100])
+		if not type_re.match(column.type) or (column.default is not None and '\\' in column.default):
+			raise ValueError('invalid column definition in backup: %s' % item[:100])
+		# Anything that create_body() would not write, such as other attributes, is rejected.
+		if backends.split_definitions(schema.create_body({parts[0]: column}))[0] != item:
+			raise ValueError('invalid column definition in backup: %s' % item[:100])
+		columns[parts[0]] = column
+	for name in primary:
+		if name not in columns:
+			raise ValueError('invalid primary key in backup: %s' % name)
+		columns[name].primary = True
+		columns[name].nullable = False
+	if list(columns) != list(names):
+		raise ValueError('table definition in backup does not match its columns')
+	return schema.create_body(columns)
+# }}}
+
+class Export: # {{{
+	'''A backup that is being made.
+	Call next() until finished is True; every call returns lines of at most
+	one chunk of records. Close the export if it is not finished.
+	The records of the user, games and players are read first; their ids are
+	kept to find their tables, which are read one at a time with a stream.'''
+	def __init__(self, userid, name): # {{{
+		self.userid = userid
+		self.name = name
+		self.finished = False
+		self.started = False
+		# time.monotonic() of the end of the last call to next(), or None while it runs.
+		self.used = time.monotonic()
+		# Queries for the records, as (type, keys, query).
+		self.sections = [
+			('game', ('id', 'name', 'fullname', 'password', 'shared'), 'SELECT g.id, g.name, g.fullname, g.password, s.game IS NOT NULL FROM {} g LEFT JOIN {} s ON s.game = g.id WHERE g.user = %s ORDER BY g.id'.format(table('game'), table('shared'))),
+			('player', ('id', 'url', 'name', 'fullname', 'language', 'is_default'), 'SELECT id, url, name, fullname, language, is_default FROM {} WHERE user = %s ORDER BY id'.format(table('player'))),
+			('managed', ('id', 'game', 'name', 'fullname', 'language', 'email', 'password'), 'SELECT m.id, m.game, m.name, m.fullname, m.language, m.email, m.password FROM {} m JOIN {} g ON g.id = m.game WHERE g.user = %s ORDER BY m.id'.format(table('managed'), table('game'))),
+		]
+		# Owners of tables, as (owner letter, id); filled while the records are read.
+		self.owners = []
+		# Tables that have not been read yet, as (owner letter, id, name).
+		self.tables = None
+		# Columns of the tables of the current owner.
+		self.owner = None
+		self.columns = None
+		self.stream = None
+		self.kind = None
+		self.table_count = 0
+		self.row_count = 0
+	# }}}
+	def next(self, wake, count = None): # {{{
+		'Return the next lines; count is the maximum number of records (see db.bg_fetch()).'
+		self.used = None
+		try:
+			return (yield from self.next_lines(wake, count))
+		finally:
+			self.used = time.monotonic()
+	# }}}
+	def next_lines(self, wake, count): # {{{
+		ret = []
+		if not self.started:
+			self.started = True
+			ret.append(line({'type': 'userdata-backup', 'version': version, 'user': self.name}))
+		while not self.finished:
+			if self.stream is None:
+				yield from self.start_section(wake, ret)
+				continue
+			rows = (yield from db.bg_fetch(wake, self.stream, count))
+			if self.stream is None:
+				# The export was closed while the rows were fetched.
+				break
+			if self.stream.closed:
+				self.stream = None
+			if self.kind is None:
+				if len(rows) > 0:
+					ret.append(line({'type': 'rows', 'rows': rows}))
+					self.row_count += len(rows)
+			else:
+				for row in rows:
+					record = dict(zip(self.keys, row))
+					if self.kind == 'game':
+						record['shared'] = bool(record['shared'])
+						self.owners.append(('g', record['id']))
+						if record['shared']:
+							self.owners.append(('s', record['id']))
+					else:
+						self.owners.append(('p' if self.kind == 'player' else 'm', record['id']))
+					record['type'] = self.kind
+					ret.append(line(record))
+			if len(rows) > 0:
+				break
+		return ret
+	# }}}
+	def start_section(self, wake, ret): # {{{
+		'Open the stream for the next records or table, and add lines for it to ret; set finished at the end.'
+		if len(self.sections) > 0:
+			self.kind, self.keys, cmd = self.sections.pop(0)
+			yield from self.open_stream(wake, cmd, self.userid)
+			return
+		self.kind = None
+		if self.tables is None:
+			yield from self.find_tables(wake)
+		if len(self.tables) == 0:
+			ret.append(line({'type': 'end', 'tables': self.table_count, 'rows': self.row_count}))
+			self.finished = True
+			return
+		letter, id, name = self.tables.pop(0)
+		owner = '%s%x_' % (letter, id)
+		if owner != self.owner:
+			self.owner = owner
+			self.columns = schema.read_tables((yield from db.bg_describe_owner(wake, owner)), db.global_prefix + owner)
+		columns = self.columns.get(name)
+		if columns is None:
+			print('not exporting table %s, which is in the catalog but does not exist' % (db.global_prefix + owner + name), file = sys.stderr)
+			return
+		ret.append(line({'type': 'table', 'owner': letter, 'id': id, 'name': name, 'definition': schema.create_body(columns), 'columns': list(columns)}))
+		self.table_count += 1
+		yield from self.open_stream(wake, 'SELECT {} FROM {}'.format(', '.join(columns), db.global_prefix + owner + name))
+	# }}}
+	def open_stream(self, wake, cmd, *args): # {{{
+		stream = (yield from db.bg_stream(wake, cmd, *args))
+		if self.finished:
+			# The export was closed while the stream was opened.
+			db.close_stream(stream)
+			return
+		self.stream = stream
+	# }}}
+	def find_tables(self, wake): # {{{
+		'Read the names of the tables of all owners from the catalog.'
+		self.tables = []
+		owners = {'%s%x_' % owner: owner for owner in self.owners}
+		keys = list(owners)
+		# Keep the number of parameters per query reasonable.
+		for start in range(0, len(keys), 500):
+			part = keys[start:start + 500]
+			for owner, name in (yield from db.bg_read(wake, 'SELECT owner, name FROM {} WHERE owner IN ({}) ORDER BY owner, name'.format(table('catalog'), ', '.join(['%s'] * len(part))), *part)):
+				self.tables.append(owners[owner] + (name,))
+		self.owners = None
+	# }}}
+	def close(self): # {{{
+		'Stop the export before it is finished.'
+		if self.stream is not None:
+			db.close_stream(self.stream)
+			self.stream = None
+		self.finished = True
+	# }}}
+# }}}
+
+class Import: # {{{
+	'''A backup that is being restored into the data of a user.
+	Pass all lines in order to feed(), in as many calls as needed; it returns
+	True after the end line. If anything fails, call abort().
+	Records are inserted with multi-row inserts in one transaction. Creating
+	a table commits the transaction on MySQL, so abort() also removes
+	everything that was created explicitly.'''
+	def __init__(self, userid): # {{{
+		self.userid = userid
+		self.transaction = None
+		self.started = False
+		self.finished = False
+		self.aborted = False
+		self.busy = False
+		# Map of old to new ids, per type.
+		self.ids = {'game': {}, 'player': {}, 'managed': {}}
+		self.shared = set()
+		self.game_names = None
+		# Records that are waiting to be inserted; they all have the same type.
+		self.batch = []
+		# The table that records are inserted into: (prefixed name, columns, position of the owner column or None).
+		self.table = None
+		self.created = []
+		self.counts = {'games': 0, 'players': 0, 'managed': 0, 'tables': 0, 'rows': 0}
+	# }}}
+	def feed(self, wake, lines): # {{{
+		'Process lines of a backup. Returns True when the backup is complete and committed.'
+		if self.finished:
+			raise ValueError('data after end of backup')
+		self.busy = True
+		try:
+			if self.transaction is None:
+				self.transaction = (yield from db.bg_begin(wake))
+				if self.aborted:
+					yield from db.bg_rollback(wake, self.transaction)
+					raise ValueError('import was aborted')
+				self.game_names = set((yield from db.bg_read1(wake, 'SELECT name FROM {} WHERE user = %s'.format(table('game')), self.userid, transaction = self.transaction)))
+			for text in lines:
+				if text.strip() == '':
+					continue
+				obj = json.loads(text)
+				kind = obj.get('type')
+				if not self.started:
+					if kind != 'userdata-backup' or not isinstance(obj.get('version'), int) or obj['version'] > version:
+						raise ValueError('input is not a supported userdata backup')
+					self.started = True
+					continue
+				if len(self.batch) > 0 and kind != self.batch[0]['type']:
+					yield from self.flush(wake)
+				if kind in self.ids:
+					self.batch.append(obj)
+					if len(self.batch) >= db.stream_chunk:
+						yield from self.flush(wake)
+				elif kind == 'table':
+					yield from self.create(wake, obj)
+				elif kind == 'rows':
+					yield from self.insert(wake, obj['rows'])
+				elif kind == 'end':
+					yield from db.bg_commit(wake, self.transaction)
+					self.finished = True
+					return True
+				else:
+					raise ValueError('invalid line in backup: %s' % text[:100])
+			yield from self.flush(wake)
+			return False
+		finally:
+			self.busy = False
+	# }}}
+	def flush(self, wake): # {{{
+		'Insert the waiting records of games, players or managed players.'
+		if len(self.batch) == 0:
+			return
+		batch = self.batch
+		self.batch = []
+		kind = batch[0]['type']
+		if kind == 'game':
+			for obj in batch:
+				if obj['name'] in self.game_names:
+					raise ValueError('game %s already exists' % obj['name'])
+				self.game_names.add(obj['name'])
+			ids = (yield from db.bg_write_many(wake, 'INSERT INTO {} (user, name, fullname, password) VALUES (%s, %s, %s, %s)'.format(table('game')), [(self.userid, obj['name'], obj['fullname'], obj['password']) for obj in batch], transaction = self.transaction))
+			self.counts['games'] += len(batch)
+		elif kind == 'player':
+			for obj in batch:
+				if len((yield from db.bg_read(wake, 'SELECT id FROM {} WHERE url = %s AND name = %s'.format(table('player')), obj['url'], obj['name'], transaction = self.transaction))) > 0:
+					raise ValueError('player %s for game %s already exists' % (obj['name'], obj['url']))
+			ids = (yield from db.bg_write_many(wake, 'INSERT INTO {} (user, url, name, fullname, language, is_default) VALUES (%s, %s, %s, %s, %s, %s)'.format(table('player')), [(self.userid, obj['url'], obj['name'], obj['fullname'], obj['language'], int(obj['is_default'])) for obj in batch], transaction = self.transaction))
+			self.counts['players'] += len(batch)
+		else:
+			ids = (yield from db.bg_write_many(wake, 'INSERT INTO {} (game, name, fullname, language, email, password) VALUES (%s, %s, %s, %s, %s, %s)'.format(table('managed')), [(self.map('game', obj['game']), obj['name'], obj['fullname'], obj['language'], obj['email'], obj['password']) for obj in batch], transaction = self.transaction))
+			self.counts['managed'] += len(batch)
+		for obj, new in zip(batch, ids):
+			self.ids[kind][obj['id']] = new
+			if kind == 'game' and obj['shared']:
+				self.shared.add(new)
+		if kind == 'game':
+			shared = [(self.ids['game'][obj['id']],) for obj in batch if obj['shared']]
+			if len(shared) > 0:
+				yield from db.bg_write_many(wake, 'INSERT INTO {} (game) VALUES (%s)'.format(table('shared')), shared, transaction = self.transaction, ids = False)
+	# }}}
+	def map(self, kind, id): # {{{
+		'Return the new id for an old id.'
+		if id not in self.ids[kind]:
+			raise ValueError('backup refers to unknown %s %s' % (kind, id))
+		return self.ids[kind][id]
+	# }}}
+	def create(self, wake, obj): # {{{
+		'Create a table, and make it the target for the following records.'
+		letter = obj['owner']
+		if letter not in ('g', 'p', 'm', 's'):
+			raise ValueError('invalid table owner %s' % letter)
+		db.assert_is_id(obj['name'])
+		for column in obj['columns']:
+			db.assert_is_id(column)
+		definition = parse_definition(obj['definition'], obj['columns'])
+		owner = '%s%x_' % (letter, self.map({'g': 'game', 's': 'game', 'p': 'player', 'm': 'managed'}[letter], obj['id']))
+		t = db.global_prefix + owner + obj['name']
+		yield from db.bg_write(wake, 'CREATE TABLE {} ({})'.format(t, definition), transaction = self.transaction)
+		self.created.append(t)
+		yield from db.bg_catalog_add(wake, owner, obj['name'], transaction = self.transaction)
+		position = obj['columns'].index(schema.owner_column) if letter == 's' else None
+		self.table = (t, obj['columns'], position)
+		self.counts['tables'] += 1
+	# }}}
+	def insert(self, wake, rows): # {{{
+		'Insert records into the current table.'
+		if self.table is None:
+			raise ValueError('records without table in backup')
+		t, columns, position = self.table
+		rows = [[decode(value) for value in row] for row in rows]
+		for row in rows:
+			if len(row) != len(columns):
+				raise ValueError('record does not match columns of %s' % t)
+			if position is not None:
+				row[position] = self.map('managed', row[position])
+		if len(rows) > 0:
+			yield from db.bg_write_many(wake, 'INSERT INTO {} ({}) VALUES ({})'.format(t, ', '.join(columns), ', '.join(['%s'] * len(columns))), rows, transaction = self.transaction, ids = False)
+		self.counts['rows'] += len(rows)
+	# }}}
+	def abort(self, wake = None): # {{{
+		'Roll back the import, and remove what was created.'
+		if wake is None:
+			wake = (yield)
+		if self.aborted:
+			return
+		# The transaction is kept, so a running feed() fails on its next request.
+		self.aborted = True
+		self.finished = True
+		transaction = self.transaction
+		if transaction is not None and transaction.connection is not None:
+			try:
+				yield from db.bg_rollback(wake, transaction)
+			except Exception as e:
+				print('Error while rolling back import: %s' % e, file = sys.stderr)
+		for t in self.created:
+			yield from db.bg_write(wake, 'DROP TABLE IF EXISTS {}'.format(t))
+		games = list(self.ids['game'].values())
+		players = list(self.ids['player'].values())
+		managed = list(self.ids['managed'].values())
+		owners = ['g%x_' % id for id in games] + ['s%x_' % id for id in games] + ['p%x_' % id for id in players] + ['m%x_' % id for id in managed]
+		for name, column, values in (('catalog', 'owner', owners), ('shared', 'game', games), ('managed', 'game', games), ('game', 'id', games), ('player', 'id', players)):
+			for start in range(0, len(values), 500):
+				part = values[start:start + 500]
+				yield from db.bg_write(wake, 'DELETE FROM {} WHERE {} IN ({})'.format(table(name), column, ', '.join(['%s'] * len(part))), *part)
+		if len(self.created) > 0:
+			print('removed %d tables of failed import' % len(self.created), file = sys.stderr)
+	# }}}
+# }}}
+
+# vim: set foldmethod=marker :
@@ -1,11 +1,21 @@
 # Imports {{{
 import sys
 import os
+import time
+import traceback
 import fhs
 import re
-import pymysql
-import crypt
+import queue
+import threading
+import collections
+import concurrent.futures
 import getpass
+import websocketd
+import passwords
+import schema
+import backends
+import metrics
+import tracing
 # }}}
 
 '''Database setup: {{{
@@ -33,6 +43,12 @@ CREATE USER '$user'@'$host' IDENTIFIED BY '$password';
 GRANT ALL PRIVILEGES ON $database.* TO '$user'@'$host';
 FLUSH PRIVILEGES;
 EOF
+
+# Alternatively, use an embedded SQLite database; this does not need a server or pymysql.
+cat > db.ini <<EOF
+backend = sqlite
+file = /var/lib/userdata/userdata.sqlite
+EOF
 }}}'''
 
 # Global variables. {{{
@@ -47,12 +63,41 @@ db = None
 cursor = None
 database = None
 
+# Backend object for the configured database engine; see backends.py.
+backend = None
+
+# Pooled connections for use by the server; see bg_read() and bg_write().
+pool = None
+executor = None
+# Threads for connections that are pinned to a transaction or stream; see Pinned.
+pinned_executor = None
+hash_executor = None
+thread_executor = None
+pending = 0
+open_streams = 0
+open_transactions = 0
+# Whether the main loop reads notify_read; see start_pool().
+watching = False
+results = queue.SimpleQueue()
+notify_read, notify_write = os.pipe()
+os.set_blocking(notify_write, False)
+
 fhs.module_info('db', 'database handling', '0.1', 'Bas Wijnen <wijnen@debian.org>')
 fhs.module_option('db', 'prefix', 'global prefix for all database tables', default = '')
+fhs.module_option('db', 'pool-size', 'number of database connections (and worker threads) for handling requests; this must be more than max-streams plus max-transactions', default = 8, argtype = int)
+fhs.module_option('db', 'queue-depth', 'maximum number of database requests that can be waiting for a worker', default = 1000, argtype = int)
+fhs.module_option('db', 'reconnect', 'number of times to reconnect and retry a query when the database connection is lost', default = 1, argtype = int)
+fhs.module_option('db', 'max-streams', 'maximum number of streaming selects that can be open at the same time; each one holds a database connection', default = 2, argtype = int)
+fhs.module_option('db', 'max-transactions', 'maximum number of transactions that can be open at the same time; each one holds a database connection', default = 4, argtype = int)
+fhs.module_option('db', 'transaction-timeout', 'number of seconds after which a transaction that is not used is rolled back', default = 60, argtype = float)
+fhs.module_option('db', 'stream-chunk', 'maximum number of rows that a streaming select returns per call', default = 1000, argtype = int)
+fhs.module_option('db', 'hash-workers', 'number of processes for hashing passwords; 0 to hash in the main process', default = 2, argtype = int)
+fhs.module_option('db', 'hash-backend', 'password hashing backend for new hashes (%s)' % ', '.join(passwords.backends), default = passwords.DEFAULT_BACKEND)
+fhs.module_option('db', 'hash-cost', 'log2 of the cost parameter for scrypt password hashes', default = passwords.DEFAULT_COST, argtype = int)
 
 @fhs.atinit
 def init():
-	global config, userdefs, tabledefs
+	global config, userdefs, tabledefs, pool_size, queue_depth, reconnect_attempts, max_streams, max_transactions, transaction_timeout, stream_chunk, hash_workers, hash_backend, hash_cost
 	# The config file is in windows ini format (lines with key = value). # for comments. Empty lines allowed.
 	def find_config(env_key, default_filename):
 		e = os.environ.get(env_key)
@@ -60,7 +105,10 @@ def init():
 			return fhs.read_data(default_filename, opened = False)
 		return e
 
-	# Keys are host, user, password, database. All are required. No others are allowed.
+	# Key backend selects the database engine: mysql (the default) or sqlite.
+	# For mysql, keys are host, user, password, database. All are required.
+	# For sqlite, key file is required; mmap-size and statement-cache are optional.
+	# No others are allowed.
 	config = find_config('DBCONFIG', 'db.ini')
 
 	# These files can be used using the setup functions. This is optional.
@@ -72,6 +120,24 @@ def init():
 			print('DB prefix from commandline is ignored because DBPREFIX is defined in environment', file = sys.stderr)
 	else:
 		global_prefix = values['prefix']
+	pool_size = values['pool-size']
+	queue_depth = values['queue-depth']
+	reconnect_attempts = values['reconnect']
+	max_streams = values['max-streams']
+	max_transactions = values['max-transactions']
+	transaction_timeout = values['transaction-timeout']
+	stream_chunk = values['stream-chunk']
+	hash_workers = values['hash-workers']
+	hash_backend = values['hash-backend']
+	hash_cost = values['hash-cost']
+	assert pool_size > 0
+	assert max_streams >= 0 and max_transactions >= 0
+	# At least one connection is always available for requests that are not pinned.
+	assert max_streams + max_transactions < pool_size
+	assert transaction_timeout > 0
+	assert stream_chunk > 0
+	assert hash_workers >= 0
+	assert hash_backend in passwords.backends
 # }}}
 
 def connect(reconnect = False): # {{{
@@ -84,16 +150,42 @@ def connect(reconnect = False): # {{{
 		else:
 			# ignore request.
 			return
-	cfg = {key.strip(): value.strip() for key, value in (x.split('=', 1) for x in open(config).read().split('\n') if '=' in x and not x.strip().startswith('#'))}
-	host = cfg.pop('host')
-	user = cfg.pop('user')
-	password = cfg.pop('password')
-	database = cfg.pop('database')
-	assert len(cfg) == 0
-	db = pymysql.connect(host = host, user = user, password = password, database = database)
+	cfg = read_config()
+	database = cfg.get('database', cfg.get('file'))
+	db = backend.connect()
 	cursor = db.cursor()
 # }}}
 
+def disconnect(): # {{{
+	'''Close the connection and the pool; they are opened again by the next request.
+	This must be done before forking, so processes do not share a connection.'''
+	global db, cursor, pool, executor, pinned_executor
+	if db is not None:
+		db.close()
+	db = None
+	cursor = None
+	if pool is not None:
+		executor.shutdown(wait = True)
+		pinned_executor.shutdown(wait = True)
+		while not pool.empty():
+			pool.get().close()
+		pool = None
+		executor = None
+		pinned_executor = None
+# }}}
+
+def read_config(): # {{{
+	'''Parse the config file and return the connection parameters as a dict.
+	The backend is created from it when this is first called.'''
+	global backend
+	cfg = {key.strip(): value.strip() for key, value in (x.split('=', 1) for x in open(config).read().split('\n') if '=' in x and not x.strip().startswith('#'))}
+	kind = cfg.pop('backend', 'mysql')
+	assert kind in backends.backends
+	if backend is None:
+		backend = backends.backends[kind](dict(cfg))
+	return cfg
+# }}}
+
 def assert_is_id(name): # {{{
 	'Check that a name is a valid id (mostly to protect against injections)'
 	assert isinstance(name, str)
@@ -104,28 +196,32 @@ def assert_is_id(name): # {{{
 def write(cmd, *args): # {{{
 	if debug_db:
 		print('db writing: %s%s)' % (cmd, repr(args)), file = sys.stderr)
+	start = time.monotonic()
 	try:
 		cursor.execute(cmd, args)
 		db.commit()
-	except pymysql.OperationalError:
+	except backend.OperationalError:
 		print('Error ignored on write')
 		connect(True)
 		cursor.execute(cmd, args)
 		db.commit()
+	tracing.query(tracing.current, 'write', cmd, query_owner(cmd), row_count(cursor.rowcount), 0, time.monotonic() - start, False)
 # }}}
 
 def read(cmd, *args): # {{{
 	if debug_db:
 		print('db reading: %s%s' % (cmd, repr(args)), file = sys.stderr)
+	start = time.monotonic()
 	try:
 		cursor.execute(cmd, args)
 		db.commit()
-	except pymysql.OperationalError:
+	except backend.OperationalError:
 		print('Error ignored on read')
 		connect(True)
 		cursor.execute(cmd, args)
 		db.commit()
 	ret = cursor.fetchall()
+	tracing.query(tracing.current, 'read', cmd, query_owner(cmd), len(ret), 0, time.monotonic() - start, False)
 	if debug_db:
 		print('db returns: %s' % repr(ret), file = sys.stderr)
 	return ret
@@ -134,6 +230,830 @@ def read(cmd, *args): # {{{
 def read1(cmd, *args): # {{{
 	return [x[0] for x in read(cmd, *args)]
 # }}}
+
+def query_owner(cmd): # {{{
+	'Return the owner part of the first table prefix in cmd, or None; this is only used for logging.'
+	r = re.search(r'\b%s([gpms][0-9a-f]+_)' % re.escape(global_prefix), cmd)
+	return None if r is None else r.group(1)
+# }}}
+
+def row_count(count): # {{{
+	'Return a row count from a cursor, or None if the database does not report it.'
+	return None if count is None or count < 0 else count
+# }}}
+# }}}
+
+# Pooled access from the server. {{{
+# The functions in this section are generators. They run the query on a
+# connection from the pool in a worker thread, so the main loop keeps serving
+# other requests while the database is busy. The result is passed back to the
+# main thread through a pipe, which wakes the calling RPC generator.
+# Use them from an RPC function as: result = (yield from db.bg_read(wake, cmd, *args))
+#
+# Pooled connections use autocommit, so a read does not need a commit.
+# Statements can be grouped by passing a Transaction; see bg_begin().
+
+class Failure: # {{{
+	'Exception raised in a worker thread, to be raised again in the main thread.'
+	def __init__(self, error):
+		self.error = error
+# }}}
+
+class Pinned: # {{{
+	'''A connection from the pool that is used by one channel; see Transaction and Stream.
+	Commands for it are run in order, one at a time, by the threads of
+	pinned_executor. That executor has a thread for every connection and for
+	every pinned connection that can be waiting for one, so the commands can
+	always make progress, even when all other workers are waiting for a
+	connection.'''
+	def __init__(self):
+		self.connection = None
+		self.closed = False
+		# time.monotonic() of the end of the last command, or None while a command is running.
+		self.used = time.monotonic()
+		self.jobs = collections.deque()
+		self.lock = threading.Lock()
+		self.running = False
+	def submit(self, job):
+		'Queue job to be run after all earlier jobs of this connection.'
+		with self.lock:
+			self.jobs.append(job)
+			if self.running:
+				return
+			self.running = True
+		pinned_executor.submit(self.run)
+	def run(self):
+		'Run the queued jobs. This runs in a thread of pinned_executor.'
+		while True:
+			with self.lock:
+				if len(self.jobs) == 0:
+					self.running = False
+					return
+				job = self.jobs.popleft()
+			job()
+# }}}
+
+class Transaction(Pinned): # {{{
+	'A connection from the pool, pinned to one channel between bg_begin() and bg_commit() or bg_rollback().'
+	pass
+# }}}
+
+def start_pool(): # {{{
+	'''Open the connection pool and start the worker threads.
+	If the pool is active, nothing happens.'''
+	global pool, executor, pinned_executor, watching
+	if pool is not None:
+		return
+	read_config()
+	pool = queue.Queue()
+	for i in range(pool_size):
+		pool.put(backend.connect(autocommit = True))
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers = pool_size, thread_name_prefix = 'db')
+	pinned_executor = concurrent.futures.ThreadPoolExecutor(max_workers = pool_size + max_streams + max_transactions, thread_name_prefix = 'db-pinned')
+	if not watching:
+		websocketd.add_read(notify_read, deliver)
+		watching = True
+# }}}
+
+def deliver(): # {{{
+	'Pass results from worker threads to their generators. This runs in the main thread.'
+	global pending
+	try:
+		os.read(notify_read, 4096)
+	except BlockingIOError:
+		pass
+	while True:
+		try:
+			wake, ret = results.get_nowait()
+		except queue.Empty:
+			break
+		pending -= 1
+		if wake is None:
+			# Nobody is waiting for this result.
+			if isinstance(ret, Failure):
+				print('Error in background database request: %s' % ret.error, file = sys.stderr)
+			continue
+		try:
+			wake(ret)
+		except:
+			print('Error in request after database reply', file = sys.stderr)
+			traceback.print_exc()
+	return True
+# }}}
+
+def run_action(action, connection, c, cmd, args, in_transaction, info): # {{{
+	'Run action, and record when it ran and the number of rows it affected in info (for tracing).'
+	info['start'] = time.monotonic()
+	ret = action(connection, c, cmd, args, in_transaction)
+	info['end'] = time.monotonic()
+	info['rows'] = row_count(c.rowcount)
+	return ret
+# }}}
+
+def run_pooled(action, cmd, args, info): # {{{
+	'Run action on a pooled connection. This runs in a worker thread.'
+	connection = pool.get()
+	try:
+		attempt = 0
+		while True:
+			try:
+				with connection.cursor() as c:
+					return run_action(action, connection, c, cmd, args, False, info)
+			except backend.OperationalError:
+				if attempt >= reconnect_attempts:
+					raise
+				attempt += 1
+				print('Error ignored on pooled query; reconnecting', file = sys.stderr)
+				connection.ping(reconnect = True)
+	finally:
+		pool.put(connection)
+# }}}
+
+def run_pinned(transaction, action, cmd, args, info): # {{{
+	'''Run action on the connection of a transaction. This runs in a thread of pinned_executor.
+	A lost connection is not retried, because the transaction is lost with it.'''
+	with transaction.connection.cursor() as c:
+		return run_action(action, transaction.connection, c, cmd, args, True, info)
+# }}}
+
+def submit(wake, func, transaction = None): # {{{
+	'''Queue func for a worker thread; wake will be called with the result in the main thread.
+	If transaction is not None, func is run on the connection of that Transaction (or Stream), after its earlier jobs.'''
+	global pending
+	start_pool()
+	if pending >= queue_depth:
+		raise RuntimeError('database request queue is full')
+	pending += 1
+	def job():
+		try:
+			ret = func()
+		except Exception as e:
+			ret = Failure(e)
+		notify(wake, ret)
+	if transaction is None:
+		executor.submit(job)
+	else:
+		transaction.submit(job)
+# }}}
+
+def notify(wake, ret): # {{{
+	'Pass a result to the main thread. This can be called from any thread.'
+	results.put((wake, ret))
+	try:
+		os.write(notify_write, b'\0')
+	except BlockingIOError:
+		# The pipe is full, so the main thread will wake anyway.
+		pass
+# }}}
+
+def run_sync(func, *args): # {{{
+	'''Run func(wake, *args), a generator function that uses the bg_* functions, and return its result.
+	The results of the workers are waited for here instead of in the main
+	loop, so this can be used by command line modes before the server runs.
+	func must not wait for anything else than its own requests.'''
+	global pending
+	start_pool()
+	done = []
+	def wake(ret):
+		try:
+			gen.send(ret)
+		except StopIteration as e:
+			done.append(e.value)
+	gen = func(wake, *args)
+	wake(None)
+	while len(done) == 0:
+		target, ret = results.get()
+		pending -= 1
+		if target is not None:
+			target(ret)
+		elif isinstance(ret, Failure):
+			print('Error in background database request: %s' % ret.error, file = sys.stderr)
+	return done[0]
+# }}}
+
+def pooled_write(connection, c, cmd, args, in_transaction): # {{{
+	if debug_db:
+		print('db writing (pooled): %s%s)' % (cmd, repr(args)), file = sys.stderr)
+	c.execute(cmd, args)
+	return c.lastrowid
+# }}}
+
+def pooled_write_many(connection, c, cmd, rows, in_transaction): # {{{
+	'''Run cmd once for every row, and commit once.
+	Returns the list of inserted ids for an INSERT, or the number of affected rows otherwise.'''
+	if debug_db:
+		print('db writing (pooled, %d rows): %s%s)' % (len(rows), cmd, repr(rows)), file = sys.stderr)
+	if not in_transaction:
+		connection.begin()
+	try:
+		if cmd.startswith('INSERT'):
+			ret = backend.insert_many(connection, c, cmd, rows)
+		else:
+			c.executemany(cmd, rows)
+			ret = c.rowcount
+	except:
+		if not in_transaction:
+			connection.rollback()
+		raise
+	if not in_transaction:
+		connection.commit()
+	return ret
+# }}}
+
+def pooled_write_bulk(connection, c, cmd, rows, in_transaction): # {{{
+	'''Like pooled_write_many(), but an INSERT is sent as one multi-row statement where the backend can.
+	This is faster, but the ids are not known, so the number of affected rows is returned.'''
+	if debug_db:
+		print('db writing (pooled, bulk, %d rows): %s%s)' % (len(rows), cmd, repr(rows)), file = sys.stderr)
+	if not in_transaction:
+		connection.begin()
+	try:
+		c.executemany(cmd, rows)
+	except:
+		if not in_transaction:
+			connection.rollback()
+		raise
+	if not in_transaction:
+		connection.commit()
+	return c.rowcount
+# }}}
+
+def pooled_read(connection, c, cmd, args, in_transaction): # {{{
+	if debug_db:
+		print('db reading (pooled): %s%s' % (cmd, repr(args)), file = sys.stderr)
+	c.execute(cmd, args)
+	ret = c.fetchall()
+	if debug_db:
+		print('db returns: %s' % repr(ret), file = sys.stderr)
+	return ret
+# }}}
+
+def pooled_describe(connection, c, prefix, args, in_transaction): # {{{
+	'Read the columns of all tables that start with prefix; see bg_describe_owner().'
+	if debug_db:
+		print('db describing (pooled): %s' % prefix, file = sys.stderr)
+	return backend.describe_owner(c, prefix)
+# }}}
+
+def bg_wait(wake, action, cmd, args, transaction): # {{{
+	'Submit a job and wait for it to finish. Exceptions from the worker are raised here.'
+	kind = 'read' if action in (pooled_read, pooled_describe) else 'write'
+	# The call must be read before yielding, because after that another call may be running.
+	call = tracing.current
+	info = {}
+	submitted = time.monotonic()
+	with metrics.db_latency.time(kind):
+		if transaction is None:
+			submit(wake, lambda: run_pooled(action, cmd, args, info))
+		else:
+			if transaction.connection is None:
+				raise ValueError('transaction is not active')
+			transaction.used = None
+			submit(wake, lambda: run_pinned(transaction, action, cmd, args, info), transaction)
+		ret = (yield)
+		if transaction is not None:
+			transaction.used = time.monotonic()
+	if 'end' in info:
+		if action is pooled_describe:
+			# cmd is the table prefix.
+			rows = len(ret)
+			cmd = 'DESCRIBE %s*' % cmd
+		elif action is pooled_read:
+			rows = len(ret)
+		else:
+			rows = info['rows']
+		tracing.query(call, kind, cmd, query_owner(cmd), rows, info['start'] - submitted, info['end'] - info['start'], transaction is not None)
+	if isinstance(ret, Failure):
+		raise ret.error
+	return ret
+# }}}
+
+def bg_write(wake, cmd, *args, transaction = None): # {{{
+	'''Generator version of write().
+	Returns the id of the last inserted row, if any.'''
+	return (yield from bg_wait(wake, pooled_write, cmd, args, transaction))
+# }}}
+
+def bg_write_many(wake, cmd, rows, transaction = None, ids = True): # {{{
+	'''Run a write command for each row of arguments, with a single commit.
+	For INSERT, returns the list of inserted ids; otherwise returns the number of affected rows.
+	If ids is False, the ids of an INSERT are not needed; it is written in bulk and the number of rows is returned.'''
+	return (yield from bg_wait(wake, pooled_write_many if ids else pooled_write_bulk, cmd, [tuple(row) for row in rows], transaction))
+# }}}
+
+def bg_read(wake, cmd, *args, transaction = None): # {{{
+	'Generator version of read().'
+	return (yield from bg_wait(wake, pooled_read, cmd, args, transaction))
+# }}}
+
+def bg_read1(wake, cmd, *args, transaction = None): # {{{
+	'Generator version of read1().'
+	return [x[0] for x in (yield from bg_read(wake, cmd, *args, transaction = transaction))]
+# }}}
+
+# Transactions. {{{
+def transaction_begin(transaction): # {{{
+	'Take a connection from the pool and start a transaction on it. This runs in a thread of pinned_executor.'
+	connection = pool.get()
+	try:
+		connection.ping(reconnect = True)
+		connection.begin()
+	except:
+		pool.put(connection)
+		raise
+	transaction.connection = connection
+# }}}
+
+def transaction_end(transaction, commit): # {{{
+	'Commit or roll back, and return the connection to the pool. This runs in a thread of pinned_executor.'
+	connection = transaction.connection
+	if connection is None:
+		# The transaction was already ended.
+		return
+	transaction.connection = None
+	try:
+		if commit:
+			connection.commit()
+		else:
+			connection.rollback()
+	finally:
+		pool.put(connection)
+# }}}
+
+def bg_begin(wake): # {{{
+	'''Start a transaction. Returns a Transaction object, which must be passed to
+	the other bg_* functions to run commands in it, and to bg_commit() or bg_rollback() to end it.
+	At most max-transactions transactions can be open at the same time.'''
+	global open_transactions
+	start_pool()
+	if open_transactions >= max_transactions:
+		raise RuntimeError('too many open transactions')
+	transaction = Transaction()
+	open_transactions += 1
+	submit(wake, lambda: transaction_begin(transaction), transaction)
+	ret = (yield)
+	if isinstance(ret, Failure):
+		release(transaction)
+		raise ret.error
+	return transaction
+# }}}
+
+def release(transaction): # {{{
+	'Mark a transaction as closed, so it no longer counts as open. Releasing it more than once has no effect.'
+	global open_transactions
+	if not transaction.closed:
+		transaction.closed = True
+		open_transactions -= 1
+# }}}
+
+def bg_end(wake, transaction, commit): # {{{
+	if transaction.connection is None or transaction.closed:
+		raise ValueError('transaction is not active')
+	submit(wake, lambda: transaction_end(transaction, commit), transaction)
+	release(transaction)
+	ret = (yield)
+	if isinstance(ret, Failure):
+		raise ret.error
+# }}}
+
+def bg_commit(wake, transaction): # {{{
+	'Commit a transaction and return its connection to the pool.'
+	yield from bg_end(wake, transaction, True)
+# }}}
+
+def bg_rollback(wake, transaction): # {{{
+	'Roll back a transaction and return its connection to the pool.'
+	yield from bg_end(wake, transaction, False)
+# }}}
+
+def abort(transaction): # {{{
+	'Roll back a transaction without waiting for the result. This is used when a channel is closed.'
+	if transaction.closed:
+		return
+	submit(None, lambda: transaction_end(transaction, False), transaction)
+	release(transaction)
+# }}}
+# }}}
+
+# Streaming reads. {{{
+class Stream(Pinned): # {{{
+	'''An unbuffered server-side cursor on a connection from the pool.
+	Rows are fetched in chunks with bg_fetch(), so at most one chunk of the
+	result is in memory at any time. Like a Transaction, a stream holds its
+	connection until all rows are fetched or it is closed.'''
+	def __init__(self):
+		super().__init__()
+		self.cursor = None
+# }}}
+
+def stream_open(stream, cmd, args): # {{{
+	'Take a connection from the pool and run the query on an unbuffered cursor. This runs in a thread of pinned_executor.'
+	if debug_db:
+		print('db reading (streamed): %s%s' % (cmd, repr(args)), file = sys.stderr)
+	connection = pool.get()
+	try:
+		connection.ping(reconnect = True)
+		cursor = backend.stream_cursor(connection)
+		cursor.execute(cmd, args)
+	except:
+		pool.put(connection)
+		raise
+	stream.connection = connection
+	stream.cursor = cursor
+# }}}
+
+def stream_fetch(stream, count): # {{{
+	'Fetch up to count rows. When the result is exhausted, the connection is returned to the pool. This runs in a thread of pinned_executor.'
+	if stream.cursor is None:
+		return []
+	ret = stream.cursor.fetchmany(count)
+	if len(ret) < count:
+		stream_close(stream)
+	return ret
+# }}}
+
+def stream_close(stream): # {{{
+	'Return the connection of a stream to the pool. This runs in a thread of pinned_executor.'
+	connection = stream.connection
+	if connection is None:
+		return
+	cursor = stream.cursor
+	stream.connection = None
+	stream.cursor = None
+	try:
+		if cursor.fetchone() is None:
+			cursor.close()
+		else:
+			# Closing the cursor would read the rest of the result;
+			# dropping the connection is cheaper for a large result.
+			connection.close()
+			connection.ping(reconnect = True)
+	except backend.Error as e:
+		print('Error while closing stream: %s' % e, file = sys.stderr)
+	finally:
+		pool.put(connection)
+# }}}
+
+def bg_stream(wake, cmd, *args): # {{{
+	'''Start a streaming read. Returns a Stream object, to be passed to bg_fetch() and close_stream().
+	A stream is never part of a transaction.'''
+	global open_streams
+	start_pool()
+	if open_streams >= max_streams:
+		raise RuntimeError('too many open streams')
+	stream = Stream()
+	open_streams += 1
+	submit(wake, lambda: stream_open(stream, cmd, args), stream)
+	ret = (yield)
+	if isinstance(ret, Failure):
+		open_streams -= 1
+		stream.closed = True
+		raise ret.error
+	return stream
+# }}}
+
+def bg_fetch(wake, stream, count = None): # {{{
+	'''Fetch the next rows of a stream; at most count, and never more than the stream-chunk option.
+	If fewer rows than requested are returned, the stream is finished and closed.'''
+	if stream.closed:
+		return []
+	if count is None or count > stream_chunk:
+		count = stream_chunk
+	stream.used = None
+	submit(wake, lambda: stream_fetch(stream, count), stream)
+	ret = (yield)
+	stream.used = time.monotonic()
+	if isinstance(ret, Failure):
+		close_stream(stream)
+		raise ret.error
+	if len(ret) < count:
+		close_stream(stream)
+	return ret
+# }}}
+
+def close_stream(stream): # {{{
+	'Close a stream without waiting for the result. Closing a stream that was already closed has no effect.'
+	global open_streams
+	if stream.closed:
+		return
+	submit(None, lambda: stream_close(stream), stream)
+	stream.closed = True
+	open_streams -= 1
+# }}}
+# }}}
+# }}}
+
+# Password hashing. {{{
+# Hashing is cpu bound, so it is done in worker processes. The functions
+# that store passwords accept a Hashed instance, which is stored as is, so
+# RPC functions can compute the hash with bg_hash() before calling them.
+
+class Hashed(str): # {{{
+	'A password hash, as opposed to a plain text password.'
+	pass
+# }}}
+
+def make_hash(password): # {{{
+	'Return the hash to store for password. This runs in the main process.'
+	if isinstance(password, Hashed):
+		return str(password)
+	return passwords.hash_password(password, hash_backend, hash_cost)
+# }}}
+
+def bg_process(wake, func, *args): # {{{
+	'Run func(*args) in a worker process and wait for the result.'
+	global hash_executor, pending
+	if hash_workers == 0:
+		return func(*args)
+	if hash_executor is None:
+		hash_executor = concurrent.futures.ProcessPoolExecutor(max_workers = hash_workers)
+		start_pool()
+	if pending >= queue_depth:
+		raise RuntimeError('database request queue is full')
+	pending += 1
+	def done(future):
+		e = future.exception()
+		notify(wake, future.result() if e is None else Failure(e))
+	hash_executor.submit(func, *args).add_done_callback(done)
+	ret = (yield)
+	if isinstance(ret, Failure):
+		raise ret.error
+	return ret
+# }}}
+
+def bg_thread(wake, func, *args): # {{{
+	'''Run func(*args) in a separate thread and wait for the result.
+	This is for blocking work that is not a database request, such as connecting to a remote host, so it does not use the database workers.'''
+	global thread_executor, pending
+	if thread_executor is None:
+		thread_executor = concurrent.futures.ThreadPoolExecutor(max_workers = pool_size, thread_name_prefix = 'blocking')
+		start_pool()
+	if pending >= queue_depth:
+		raise RuntimeError('database request queue is full')
+	pending += 1
+	def job():
+		try:
+			ret = func(*args)
+		except Exception as e:
+			ret = Failure(e)
+		notify(wake, ret)
+	thread_executor.submit(job)
+	ret = (yield)
+	if isinstance(ret, Failure):
+		raise ret.error
+	return ret
+# }}}
+
+def bg_hash(wake, password): # {{{
+	'Generator that computes a password hash in a worker process. Returns a Hashed instance, or None if password is None.'
+	if password is None:
+		return None
+	return Hashed((yield from bg_process(wake, passwords.hash_password, password, hash_backend, hash_cost)))
+# }}}
+
+def bg_verify(wake, table, id, password, stored): # {{{
+	'''Generator that checks a password in a worker process. Returns True if it matches.
+	If the stored hash is outdated, it is replaced in the given table.'''
+	ok, rehash = (yield from bg_process(wake, passwords.verify_password, password, stored, hash_backend, hash_cost))
+	if ok and rehash is not None:
+		yield from bg_write(wake, 'UPDATE {} SET password = %s WHERE id = %s'.format(global_prefix + table), rehash, id)
+	return ok
+# }}}
+# }}}
+
+# Table catalog. {{{
+# The catalog records which tables exist for each owner (game, external player,
+# managed player or shared tables of a game), so they can be found without listing all tables in the
+# database. The owner is the part of the table prefix that identifies it (for
+# example 'g1f_'); the name is the table name without any prefix.
+# The catalog is rebuilt from the live schema when the server starts.
+
+catalog_definition = (
+	'owner VARCHAR(32) NOT NULL, ' +
+	'name VARCHAR(255) NOT NULL, ' +
+	'PRIMARY KEY (owner, name)'
+)
+
+# The fingerprint table stores, per owner, the hash of the last definition that was applied by setup_db().
+fingerprint_definition = (
+	'owner VARCHAR(32) NOT NULL PRIMARY KEY, ' +
+	'hash CHAR(64) NOT NULL'
+)
+
+def rebuild_catalog(): # {{{
+	'Create the catalog if it does not exist, and fill it from the list of tables in the database.'
+	connect()
+	table = global_prefix + 'catalog'
+	write('CREATE TABLE IF NOT EXISTS {} ({})'.format(table, catalog_definition))
+	write('CREATE TABLE IF NOT EXISTS {} ({})'.format(global_prefix + 'fingerprint', fingerprint_definition))
+	write('CREATE TABLE IF NOT EXISTS {} ({})'.format(global_prefix + 'shared', shared_definition))
+	entries = []
+	for t in read1('SHOW TABLES'):
+		if not t.startswith(global_prefix):
+			continue
+		r = re.match('^([gpms][0-9a-f]+_)(.+)$', t[len(global_prefix):])
+		if r is not None:
+			entries.append((r.group(1), r.group(2)))
+	db.begin()
+	cursor.execute('DELETE FROM {}'.format(table))
+	if len(entries) > 0:
+		cursor.executemany('INSERT INTO {} (owner, name) VALUES (%s, %s)'.format(table), entries)
+	db.commit()
+	return len(entries)
+# }}}
+
+def add_index(table, name, columns): # {{{
+	'Add a non-unique index to a table, unless it has an index with that name. Returns whether the index was added.'
+	connect()
+	for column in (table, name) + tuple(columns):
+		assert_is_id(column)
+	ret = backend.add_index(cursor, table, name, columns)
+	db.commit()
+	return ret
+# }}}
+
+def list_owner_tables(owner): # {{{
+	'Return the names (without prefix) of all tables of an owner.'
+	return read1('SELECT name FROM {} WHERE owner = %s'.format(global_prefix + 'catalog'), owner)
+# }}}
+
+def drop_owner_tables(owner): # {{{
+	'Drop all tables of an owner.'
+	for name in list_owner_tables(owner):
+		write('DROP TABLE IF EXISTS %s' % (global_prefix + owner + name))
+	write('DELETE FROM {} WHERE owner = %s'.format(global_prefix + 'catalog'), owner)
+	write('DELETE FROM {} WHERE owner = %s'.format(global_prefix + 'fingerprint'), owner)
+# }}}
+
+def bg_drop_owner_tables(wake, owner): # {{{
+	'Generator version of drop_owner_tables().'
+	for name in (yield from bg_catalog_list(wake, owner)):
+		yield from bg_write(wake, 'DROP TABLE IF EXISTS %s' % (global_prefix + owner + name))
+	yield from bg_write(wake, 'DELETE FROM {} WHERE owner = %s'.format(global_prefix + 'catalog'), owner)
+	yield from bg_write(wake, 'DELETE FROM {} WHERE owner = %s'.format(global_prefix + 'fingerprint'), owner)
+# }}}
+
+def bg_catalog_list(wake, owner, transaction = None): # {{{
+	'Generator version of list_owner_tables().'
+	return (yield from bg_read1(wake, 'SELECT name FROM {} WHERE owner = %s'.format(global_prefix + 'catalog'), owner, transaction = transaction))
+# }}}
+
+def bg_catalog_add(wake, owner, name, transaction = None): # {{{
+	'Record a new table in the catalog.'
+	yield from bg_write(wake, 'INSERT IGNORE INTO {} (owner, name) VALUES (%s, %s)'.format(global_prefix + 'catalog'), owner, name, transaction = transaction)
+# }}}
+
+def bg_catalog_remove(wake, owner, name, transaction = None): # {{{
+	'Remove a dropped table from the catalog.'
+	yield from bg_write(wake, 'DELETE FROM {} WHERE owner = %s AND name = %s'.format(global_prefix + 'catalog'), owner, name, transaction = transaction)
+# }}}
+
+def bg_get_fingerprint(wake, owner, transaction = None): # {{{
+	'Return the fingerprint of the last definition that was applied to the tables of owner, or None.'
+	ret = (yield from bg_read1(wake, 'SELECT hash FROM {} WHERE owner = %s'.format(global_prefix + 'fingerprint'), owner, transaction = transaction))
+	return ret[0] if len(ret) == 1 else None
+# }}}
+
+def bg_set_fingerprint(wake, owner, fingerprint, transaction = None): # {{{
+	'Record the fingerprint of the definition that was applied; None removes it.'
+	if fingerprint is None:
+		yield from bg_write(wake, 'DELETE FROM {} WHERE owner = %s'.format(global_prefix + 'fingerprint'), owner, transaction = transaction)
+	else:
+		yield from bg_write(wake, 'REPLACE INTO {} (owner, hash) VALUES (%s, %s)'.format(global_prefix + 'fingerprint'), owner, fingerprint, transaction = transaction)
+# }}}
+
+def bg_describe_owner(wake, owner, transaction = None): # {{{
+	'''Read the columns and keys of all tables of an owner in a single query.
+	Returns rows of (table, column, type, nullable, default, extra, key, unique index name or None),
+	ordered by table and column position. A column can occur more than once if it has more than one unique index.
+	Use schema.read_tables() to parse the result.'''
+	return (yield from bg_wait(wake, pooled_describe, global_prefix + owner, (), transaction))
+# }}}
+# }}}
+
+# Shared storage. {{{
+# Games in the shared table list store the tables of their managed players in
+# shared tables, with owner 's<game id>_' (see schema.py). A game is switched
+# to shared storage with migrate_shared(), which moves the existing tables of
+# its managed players into the shared tables.
+
+shared_definition = 'game INT NOT NULL PRIMARY KEY'
+
+def list_shared(): # {{{
+	'Return the set of ids of games that use shared storage.'
+	connect()
+	return set(read1('SELECT game FROM {}'.format(global_prefix + 'shared')))
+# }}}
+
+def create_shared_like(source, target): # {{{
+	'''Create a shared table with the same columns and keys as source, unless it exists.
+	The owner column is added in front of the primary key and of all unique keys.
+	This is only supported by the mysql backend.'''
+	if not isinstance(backend, backends.MySQL):
+		raise ValueError('migration to shared storage requires the mysql backend')
+	if len(read1('SHOW TABLES LIKE %s', backends.like_prefix(target)[:-1])) > 0:
+		return
+	write('CREATE TABLE {} LIKE {}'.format(target, source))
+	keys = {}
+	for row in read('SHOW INDEX FROM {}'.format(target)):
+		if row[1] == 0:
+			keys.setdefault(row[2], []).append((row[3], row[4]))
+	changes = ['ADD COLUMN {} INT NOT NULL FIRST'.format(schema.owner_column)]
+	if 'PRIMARY' not in keys:
+		changes.append('ADD KEY ({})'.format(schema.owner_column))
+	for name, columns in keys.items():
+		columns = [schema.owner_column] + [c for seq, c in sorted(columns)]
+		if name == 'PRIMARY':
+			changes.extend(['DROP PRIMARY KEY', 'ADD PRIMARY KEY ({})'.format(', '.join(columns))])
+		else:
+			changes.extend(['DROP INDEX {}'.format(name), 'ADD UNIQUE {} ({})'.format(name, ', '.join(columns))])
+	for row in read('SHOW COLUMNS FROM {}'.format(target)):
+		if 'auto_increment' in row[5].lower():
+			# InnoDB requires an auto increment column to be the first column of an index.
+			changes.append('ADD KEY ({})'.format(row[0]))
+	write('ALTER TABLE {} {}'.format(target, ', '.join(changes)))
+# }}}
+
+def column_signature(table, skip = ()): # {{{
+	'Return the columns of a table as a dict of name: (type, null, default, extra), from SHOW COLUMNS.'
+	return {row[0]: (row[1].lower(), row[2], row[4], row[5].lower()) for row in read('SHOW COLUMNS FROM {}'.format(table)) if row[0] not in skip}
+# }}}
+
+def migrate_shared(gameid): # {{{
+	'''Move the tables of all managed players of a game into shared tables, and switch the game to shared storage.
+	All tables with the same name must have the same columns, with the same
+	types; otherwise, nothing is moved and ValueError is raised. The records
+	of each table are copied in a transaction, and the table is only dropped
+	if all its records were copied. An interrupted migration can be run again.
+	The server must not be running while this is done. Returns the number of tables that were moved.'''
+	connect()
+	owner = 's%x_' % gameid
+	sources = []
+	# Check all tables before anything is changed.
+	signatures = {}
+	for player in setup_list_managed_players(gameid):
+		source_owner = 'm%x_' % player['id']
+		for name in list_owner_tables(source_owner):
+			source = global_prefix + source_owner + name
+			signature = column_signature(source)
+			if name not in signatures:
+				target = global_prefix + owner + name
+				if len(read1('SHOW TABLES LIKE %s', backends.like_prefix(target)[:-1])) > 0:
+					# Left by an interrupted migration.
+					signatures[name] = (target, column_signature(target, (schema.owner_column,)))
+				else:
+					signatures[name] = (source, signature)
+			if signature != signatures[name][1]:
+				raise ValueError('columns of {} do not match those of {}; not migrating'.format(source, signatures[name][0]))
+			sources.append((player['id'], source_owner, name))
+	count = 0
+	for managedid, source_owner, name in sources:
+		source = global_prefix + source_owner + name
+		target = global_prefix + owner + name
+		create_shared_like(source, target)
+		columns = ', '.join(signatures[name][1])
+		try:
+			# Records of an interrupted migration of this table are replaced.
+			cursor.execute('DELETE FROM {} WHERE {} = %s'.format(target, schema.owner_column), (managedid,))
+			cursor.execute('INSERT INTO {} ({}, {}) SELECT %s, {} FROM {}'.format(target, schema.owner_column, columns, columns, source), (managedid,))
+			cursor.execute('SELECT COUNT(*) FROM {}'.format(source))
+			expected = cursor.fetchone()[0]
+			cursor.execute('SELECT COUNT(*) FROM {} WHERE {} = %s'.format(target, schema.owner_column), (managedid,))
+			copied = cursor.fetchone()[0]
+			if copied != expected:
+				raise ValueError('copied {} of {} records of {}; not migrating'.format(copied, expected, source))
+		except:
+			db.rollback()
+			raise
+		db.commit()
+		write('DROP TABLE {}'.format(source))
+		write('INSERT IGNORE INTO {} (owner, name) VALUES (%s, %s)'.format(global_prefix + 'catalog'), owner, name)
+		write('DELETE FROM {} WHERE owner = %s AND name = %s'.format(global_prefix + 'catalog'), source_owner, name)
+		write('DELETE FROM {} WHERE owner = %s'.format(global_prefix + 'fingerprint'), source_owner)
+		count += 1
+	write('INSERT IGNORE INTO {} (game) VALUES (%s)'.format(global_prefix + 'shared'), gameid)
+	return count
+# }}}
+
+def delete_shared_rows(managedid): # {{{
+	'Delete all records of a managed player from the shared tables of its game, if it uses them.'
+	games = read1('SELECT game FROM {} WHERE id = %s'.format(global_prefix + 'managed'), managedid)
+	if len(games) != 1 or games[0] not in list_shared():
+		return
+	owner = 's%x_' % games[0]
+	for name in list_owner_tables(owner):
+		write('DELETE FROM {} WHERE {} = %s'.format(global_prefix + owner + name, schema.owner_column), managedid)
+# }}}
+
+def bg_delete_shared_rows(wake, managedid): # {{{
+	'Generator version of delete_shared_rows().'
+	games = (yield from bg_read1(wake, 'SELECT game FROM {} WHERE id = %s'.format(global_prefix + 'managed'), managedid))
+	if len(games) != 1 or len((yield from bg_read1(wake, 'SELECT game FROM {} WHERE game = %s'.format(global_prefix + 'shared'), games[0]))) == 0:
+		return
+	owner = 's%x_' % games[0]
+	for name in (yield from bg_catalog_list(wake, owner)):
+		yield from bg_write(wake, 'DELETE FROM {} WHERE {} = %s'.format(global_prefix + owner + name, schema.owner_column), managedid)
+# }}}
 # }}}
 
 # Setting up the database. {{{
@@ -147,8 +1067,11 @@ def setup_reset(): # {{{
 		write('DROP TABLE ' + t)
 # }}}
 
-def setup(clean = False, create_globals = True): # {{{
-	'''Create tables; optionally remove obsolete tables. Add a user table if user is True and it is not in defs.'''
+def setup(clean = False, create_globals = True, dry_run = False, keep_passwords = False): # {{{
+	'''Create tables; optionally remove obsolete tables. Add a user table if user is True and it is not in defs.
+	If create_globals is True, also add and update the records from the user definition file; see provision().
+	Returns the summary from provision(), or None if there is no user definition file.
+	If dry_run is True, nothing is changed; only the summary is computed. For keep_passwords, see provision().'''
 	connect()
 	if tabledefs is not None and os.path.isfile(tabledefs):
 		defs = {key.strip(): value.strip() for key, value in (x.split('=', 1) for x in open(tabledefs).read().split('\n') if '=' in x and not x.strip().startswith('#'))}
@@ -181,7 +1104,9 @@ def setup(clean = False, create_globals = True): # {{{
 				'language VARCHAR(255) DEFAULT NULL, ' +
 				'is_default INT(1) NOT NULL'
 			)
-		if 'managed' not in defs:
+		# Tables that were created before the index was part of the definition get it when setup() runs.
+		managed_index = 'managed' not in defs
+		if managed_index:
 			defs['managed'] = (
 				'id INT PRIMARY KEY NOT NULL AUTO_INCREMENT, ' +
 				'game INT, ' +
@@ -189,105 +1114,350 @@ def setup(clean = False, create_globals = True): # {{{
 				'fullname VARCHAR(255) NOT NULL, ' +
 				'language VARCHAR(255) DEFAULT NULL, ' +
 				'password VARCHAR(255) NOT NULL, ' +
-				'email VARCHAR(255) NOT NULL'
+				'email VARCHAR(255) NOT NULL, ' +
+				'KEY game_name (game, name)'
 			)
+		if 'catalog' not in defs:
+			defs['catalog'] = catalog_definition
+		if 'fingerprint' not in defs:
+			defs['fingerprint'] = fingerprint_definition
+		if 'shared' not in defs:
+			defs['shared'] = shared_definition
 	tables = read1('SHOW TABLES')
-	if clean:
+	if clean and not dry_run:
 		for t in tables:
 			if not t.startswith(global_prefix):
 				continue
 			if t[len(global_prefix):] not in defs:
 				write('DROP TABLE ' + t)
 	for t in defs:
-		if global_prefix + t not in tables:
+		if global_prefix + t not in tables and not dry_run:
 			write('CREATE TABLE %s (%s)' % (global_prefix + t, defs[t]))
+	if create_globals and managed_index and global_prefix + 'managed' in tables and not dry_run:
+		if add_index(global_prefix + 'managed', 'game_name', ('game', 'name')):
+			print('added index game_name to %s' % (global_prefix + 'managed'), file = sys.stderr)
 
-	def handle_section(indent, section, state): # {{{
-		# Newline found or indentation changed; handle section.
+	if create_globals and os.path.isfile(userdefs):
+		return provision(userdefs, dry_run, keep_passwords)
+	return None
+# }}}
+
+# Bulk provisioning. {{{
+# setup() reads the whole user definition file (db-user.ini) before it uses
+# the database. The definitions are compared to the existing records with one
+# query per kind of record, passwords are checked and hashed in worker
+# processes, and the changes are written in batches, one transaction per batch.
+# The file has sections of "key: value" lines, which end at an empty line, a
+# comment or a change of indentation:
+#
+# user: name
+# name: full name
+# email: e-mail address
+# password: password
+# 	game: name
+# 	name: full name
+# 	password: password
+# 		player: name
+# 		name: full name
+# 		email: e-mail address
+# 		password: password
+# 		language: language (optional)
+# 	player: name
+# 	url: url of the game
+# 	name: full name
+# 	is_default: 0 or 1
+# 	language: language (optional)
+#
+# Games and external players (indented once) belong to the user above them;
+# managed players (indented twice) belong to the game above them. A record
+# that is defined more than once gets the values of the last definition.
+# Instead of a plain text password, a hash that was made with
+# passwords.hash_password() can be given. Rerunning a large file is much
+# faster with hashes, because plain text passwords must be checked against
+# the stored hashes.
 
+# Maximum number of records that are written in one transaction.
+provision_batch = 1000
+
+# Columns that are written for each kind of record, besides the name and the owner.
+provision_columns = {
+	'user': ('fullname', 'email', 'password'),
+	'game': ('fullname', 'password'),
+	'player': ('url', 'fullname', 'language', 'is_default'),
+	'managed': ('fullname', 'language', 'email', 'password'),
+}
+
+def fold(name): # {{{
+	'''Return the key for matching a name with the database.
+	MySQL compares names without regard to case, so the definitions are matched the same way.'''
+	return name.lower()
+# }}}
+
+def read_userdefs(filename): # {{{
+	'''Parse a user definition file. Returns a dict of user name: user.
+	Users, games and players are dicts with the columns from provision_columns
+	and name. Users also have games (a dict by name) and players (a dict by
+	(url, name)); games have managed (a dict by name). All keys are folded
+	(see fold()), so names that differ only in case are the same record.'''
+	users = {}
+	state = {'user': None, 'game': None}
+	def handle_section(indent, section, lineno): # {{{
 		if len(section) == 0:
 			# Empty section (multiple newlines); ignore.
 			return
-
-		if indent == 0:
-			# Top level: user definition.
-			user = section['user']
-			fullname = section['name']
-			email = section['email']
-			password = section['password']
-			if user not in read1('SELECT name FROM {}'.format(global_prefix + 'user')):
-				setup_add_user(user, fullname, email, password)
-				state['user'] = read1('SELECT id FROM {} WHERE name = %s'.format(global_prefix + 'user'), user)[0]
+		def fields(kind, key, required):
+			for k in (key, 'name') + required:
+				if k not in section:
+					raise ValueError('%s:%d: %s definition without %s' % (filename, lineno, kind, k))
+			ret = {'name': section[key], 'fullname': section['name']}
+			for k in required:
+				ret[k] = section[k]
+			return ret
+		def merge(records, key, record):
+			if key in records:
+				records[key].update(record)
 			else:
-				userid = find_user(user)
-				setup_update_user(userid, user, fullname, email, password)
-				state['user'] = userid
-
+				records[key] = record
+			return records[key]
+		if indent == 0:
+			user = fields('user', 'user', ('email', 'password'))
+			user = merge(users, fold(user['name']), user)
+			user.setdefault('games', {})
+			user.setdefault('players', {})
+			state['user'] = user
+			state['game'] = None
 		elif indent == 1:
-			# Indented: game or player definition (part of user).
+			if state['user'] is None:
+				raise ValueError('%s:%d: definition without user' % (filename, lineno))
 			if 'game' in section:
-				game = section['game']
-				fullname = section['name']
-				password = section['password']
-				if game not in [x['name'] for x in setup_list_games(state['user'])]:
-					setup_add_game(state['user'], game, fullname, password)
-					state['game'] = read1('SELECT id FROM {} WHERE name = %s'.format(global_prefix + 'game'), game)[0]
-				else:
-					gameid = find_game(state['user'], game)
-					setup_update_game(gameid, state['user'], game, fullname, password)
-					state['game'] = gameid
+				game = fields('game', 'game', ('password',))
+				game = merge(state['user']['games'], fold(game['name']), game)
+				game.setdefault('managed', {})
+				state['game'] = game
 			else:
-				player = section['player']
-				url = section['url']
-				fullname = section['name']
-				language = section.get('language')
-				is_default = int(section['is_default'])
+				player = fields('player', 'player', ('url', 'is_default'))
+				player['language'] = section.get('language')
+				player['is_default'] = int(player['is_default'])
+				merge(state['user']['players'], (fold(player['url']), fold(player['name'])), player)
 				state['game'] = None
-				setup_add_player(state['user'], url, player, fullname, language, is_default)
-
+		elif indent == 2:
+			if state['game'] is None:
+				raise ValueError('%s:%d: managed player definition without game' % (filename, lineno))
+			player = fields('managed player', 'player', ('email', 'password'))
+			player['language'] = section.get('language')
+			merge(state['game']['managed'], fold(player['name']), player)
 		else:
-			# Doubly indented: managed player definition.
-			assert indent == 2
-			player = section['player']
-			fullname = section['name']
-			language = section.get('language')
-			password = section['password']
-			email = section['email']
-			if player not in [x['name'] for x in setup_list_managed_players(state['game'])]:
-				setup_add_managed_player(state['game'], player, fullname, email, password)
-			else:
-				setup_update_managed_player(state['user'], state['game'], player, fullname, language, email, password)
+			raise ValueError('%s:%d: invalid indentation' % (filename, lineno))
 	# }}}
+	with open(filename) as f:
+		current_indent = None
+		section = {}
+		section_line = None
+		for lineno, line in enumerate(f, 1):
+			if line.strip() == '' or line.strip().startswith('#'):
+				handle_section(current_indent, section, section_line)
+				section = {}
+				current_indent = None
+				continue
 
-	if create_globals and os.path.isfile(userdefs):
-		state = {'user': None, 'game': None}
-		with open(userdefs) as f:
-			current_indent = None
-			section = {}
-			for line in f:
-				if line.strip() == '' or line.strip().startswith('#'):
-					handle_section(current_indent, section, state)
-					section = {}
-					current_indent = None
-					continue
+			indent = len(line) - len(line.lstrip())
+			if ':' not in line:
+				raise ValueError('%s:%d: line is not of the form key: value' % (filename, lineno))
+			key, value = line.split(':', 1)
+			key = key.strip()
+			value = value.strip()
+
+			if indent != current_indent:
+				handle_section(current_indent, section, section_line)
+				section = {}
+				current_indent = indent
+				section_line = lineno
+
+			if key in section:
+				raise ValueError('%s:%d: duplicate key %s' % (filename, lineno, key))
+			section[key] = value
+
+		handle_section(current_indent, section, section_line)
+	return users
+# }}}
 
-				indent = len(line) - len(line.lstrip())
-				key, value = line.split(':', 1)
-				key = key.strip()
-				value = value.strip()
+def bg_provision_diff(wake, users, tables): # {{{
+	'''Find the existing records for the definitions from read_userdefs().
+	Every user, game and player gets id (None for a new record) and stored (a
+	dict of its current columns, or None). tables is the set of tables in the
+	database; missing tables are treated as empty.
+	Returns a list of (id,) of external players that must lose their default
+	flag, and a list of conflicts (as messages).'''
+	clear = []
+	conflicts = []
+	def found(record, id, values, kind):
+		record['id'] = id
+		record['stored'] = dict(zip(provision_columns[kind], values))
+	for record in users.values():
+		record['id'] = None
+		record['stored'] = None
+	if global_prefix + 'user' in tables:
+		for id, name, *values in (yield from bg_read_in(wake, 'SELECT id, name, fullname, email, password FROM {} WHERE name IN ({{}})'.format(global_prefix + 'user'), [user['name'] for user in users.values()])):
+			user = users.get(fold(name))
+			if user is not None and user['id'] is None:
+				found(user, id, values, 'user')
+	userids = {user['id']: user for user in users.values() if user['id'] is not None}
 
-				if indent != current_indent:
-					handle_section(current_indent, section, state)
-					section = {}
-					current_indent = indent
+	# Games.
+	for user in users.values():
+		for game in user['games'].values():
+			game['id'] = None
+			game['stored'] = None
+	if global_prefix + 'game' in tables:
+		for id, userid, name, *values in (yield from bg_read_in(wake, 'SELECT id, user, name, fullname, password FROM {} WHERE user IN ({{}})'.format(global_prefix + 'game'), list(userids))):
+			game = userids[userid]['games'].get(fold(name))
+			if game is not None and game['id'] is None:
+				found(game, id, values, 'game')
+	gameids = {game['id']: game for user in users.values() for game in user['games'].values() if game['id'] is not None}
 
-				assert key not in section
-				section[key] = value
+	# Managed players. The names are not unique, so the first record with the name is used, like find_managed() does.
+	for user in users.values():
+		for game in user['games'].values():
+			for player in game['managed'].values():
+				player['id'] = None
+				player['stored'] = None
+	if global_prefix + 'managed' in tables:
+		for id, gameid, name, *values in (yield from bg_read_in(wake, 'SELECT id, game, name, fullname, language, email, password FROM {} WHERE game IN ({{}}) ORDER BY id'.format(global_prefix + 'managed'), list(gameids))):
+			player = gameids[gameid]['managed'].get(fold(name))
+			if player is not None and player['id'] is None:
+				found(player, id, values, 'managed')
 
-			handle_section(current_indent, section, state)
+	# External players. The url and name of a player must be unique over all users, so they are searched by url.
+	defined = {}
+	for user in users.values():
+		defaults = {}
+		for key, player in list(user['players'].items()):
+			player['id'] = None
+			player['stored'] = None
+			if key in defined:
+				conflicts.append('external player %s @ %s is defined for more than one user' % (player['name'], player['url']))
+				user['players'].pop(key)
+				continue
+			defined[key] = user
+			if player['is_default']:
+				# Only one player per url can be the default; the last definition wins.
+				if key[0] in defaults:
+					defaults[key[0]]['is_default'] = 0
+				defaults[key[0]] = player
+		user['defaults'] = defaults
+	if global_prefix + 'player' in tables:
+		urls = set(player['url'] for user in users.values() for player in user['players'].values())
+		for id, userid, name, *values in (yield from bg_read_in(wake, 'SELECT id, user, name, url, fullname, language, is_default FROM {} WHERE url IN ({{}})'.format(global_prefix + 'player'), list(urls))):
+			url = values[0]
+			key = (fold(url), fold(name))
+			user = defined.get(key)
+			if user is not None:
+				if key not in user['players'] or user['players'][key]['id'] is not None:
+					# Already handled.
+					continue
+				if user['id'] != userid:
+					conflicts.append('external player %s @ %s exists for another user' % (name, url))
+					user['players'].pop(key)
+				else:
+					found(user['players'][key], id, values, 'player')
+			elif userid in userids and values[3] and fold(url) in userids[userid]['defaults']:
+				# The definitions set another default player for this url.
+				clear.append((id,))
+	return clear, conflicts
+# }}}
+
+def bg_provision_apply(wake, plan): # {{{
+	'''Write the records of a plan from provision(). Each batch of records is written in its own transaction.'''
+	def batches(rows):
+		for start in range(0, len(rows), provision_batch):
+			yield rows[start:start + provision_batch]
+	def insert(kind, owner, records):
+		columns = ('name',) + ((owner,) if owner is not None else ()) + provision_columns[kind]
+		cmd = 'INSERT INTO {} ({}) VALUES ({})'.format(global_prefix + kind, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+		for batch in batches(records):
+			ids = (yield from bg_write_many(wake, cmd, [(r['name'],) + ((r['owner'],) if owner is not None else ()) + tuple(r[c] for c in provision_columns[kind]) for r in batch]))
+			for r, id in zip(batch, ids):
+				r['id'] = id
+	def update(kind, records):
+		cmd = 'UPDATE {} SET {} WHERE id = %s'.format(global_prefix + kind, ', '.join('%s = %%s' % c for c in provision_columns[kind]))
+		for batch in batches(records):
+			yield from bg_write_many(wake, cmd, [tuple(r[c] for c in provision_columns[kind]) + (r['id'],) for r in batch])
+	yield from insert('user', None, plan['user']['add'])
+	yield from update('user', plan['user']['update'])
+	for kind, owner, parent in (('game', 'user', 'user'), ('player', 'user', 'user'), ('managed', 'game', 'game')):
+		for r in plan[kind]['add']:
+			r['owner'] = r[parent]['id']
+		if kind == 'player':
+			for batch in batches(plan['player']['clear']):
+				yield from bg_write_many(wake, 'UPDATE {} SET is_default = 0 WHERE id = %s'.format(global_prefix + 'player'), batch)
+		yield from insert(kind, owner, plan[kind]['add'])
+		yield from update(kind, plan[kind]['update'])
+# }}}
+
+def provision(filename, dry_run = False, keep_passwords = False): # {{{
+	'''Add and update the users, games and players that are defined in filename.
+	Records that are not in the file are not changed, except that an external
+	player loses its default flag if the file sets another default for its
+	user and url. Passwords are only replaced if they do not match the stored hash.
+	A password in the file can also be a hash (see passwords.is_hash()); it
+	is compared to the stored hash as a string, which costs nothing. Checking
+	a plain text password costs as much as hashing it; if keep_passwords is
+	True, plain text passwords are only used for new records.
+	If dry_run is True, nothing is written.
+	Returns a summary: a dict with for user, game, player and managed a dict
+	of add, update and unchanged counts, and conflicts, a list of messages for definitions that were skipped.'''
+	connect()
+	users = read_userdefs(filename)
+	tables = set(read1('SHOW TABLES'))
+	clear, conflicts = run_sync(bg_provision_diff, users, tables)
+	records = {kind: [] for kind in provision_columns}
+	for user in users.values():
+		records['user'].append(user)
+		for game in user['games'].values():
+			game['user'] = user
+			records['game'].append(game)
+			for player in game['managed'].values():
+				player['game'] = game
+				records['managed'].append(player)
+		for player in user['players'].values():
+			player['user'] = user
+			records['player'].append(player)
+	# Plain text passwords are checked against the stored hashes, and hashed if they do not match, in worker processes.
+	hashed = []
+	for kind in ('user', 'game', 'managed'):
+		for r in records[kind]:
+			if passwords.is_hash(r['password']):
+				continue
+			if keep_passwords and r['stored'] is not None:
+				r['password'] = r['stored']['password']
+				continue
+			hashed.append(r)
+	jobs = ([r['password'] for r in hashed], [None if r['stored'] is None else r['stored']['password'] for r in hashed], [hash_backend] * len(hashed), [hash_cost] * len(hashed))
+	if hash_workers == 0 or len(hashed) < 2:
+		hashes = list(map(passwords.refresh_hash, *jobs))
+	else:
+		with concurrent.futures.ProcessPoolExecutor(max_workers = hash_workers) as executor:
+			hashes = list(executor.map(passwords.refresh_hash, *jobs, chunksize = max(1, len(hashed) // (hash_workers * 16))))
+	for r, h in zip(hashed, hashes):
+		r['password'] = h
+	plan = {}
+	summary = {'conflicts': conflicts}
+	for kind, rows in records.items():
+		add = [r for r in rows if r['id'] is None]
+		changed = [r for r in rows if r['id'] is not None and any(r[c] != r['stored'][c] for c in provision_columns[kind])]
+		plan[kind] = {'add': add, 'update': changed}
+		summary[kind] = {'add': len(add), 'update': len(changed), 'unchanged': len(rows) - len(add) - len(changed)}
+	plan['player']['clear'] = clear
+	summary['player']['update'] += len(clear)
+	if not dry_run:
+		run_sync(bg_provision_apply, plan)
+	return summary
+# }}}
 # }}}
 
 # User management. {{{
+# The setup_* and find_* functions use the global cursor, for the command line
+# modes; the server uses their bg_* versions, so it does not wait for them.
 def find_user(name): # {{{
 	users = read1('SELECT id FROM {} WHERE name = %s'.format(global_prefix + 'user'), name)
 	if len(users) != 1:
@@ -306,7 +1476,18 @@ def setup_add_user(user, fullname, email, password = None): # {{{
 			password = getpass.getpass('Enter password for %s: ' % user, stream = sys.stderr)
 		else:
 			password = sys.stdin.readline().rstrip('\n').rstrip('\r')
-	write('INSERT INTO {} (name, fullname, email, password) VALUES (%s, %s, %s, %s)'.format(global_prefix + 'user'), user, fullname, email, crypt.crypt(password))
+	write('INSERT INTO {} (name, fullname, email, password) VALUES (%s, %s, %s, %s)'.format(global_prefix + 'user'), user, fullname, email, make_hash(password))
+	return None
+# }}}
+
+def bg_add_user(wake, user, fullname, email, password): # {{{
+	'Generator version of setup_add_user(); the password must be given, because it cannot be asked for.'
+	assert password is not None
+	users = (yield from bg_read1(wake, 'SELECT name FROM {} WHERE name = %s'.format(global_prefix + 'user'), user))
+	if len(users) != 0:
+		print('not creating duplicate user %s' % user, file = sys.stderr)
+		return 'Registration failed: user name already exists.'
+	yield from bg_write(wake, 'INSERT INTO {} (name, fullname, email, password) VALUES (%s, %s, %s, %s)'.format(global_prefix + 'user'), user, fullname, email, make_hash(password))
 	return None
 # }}}
 
@@ -327,7 +1508,7 @@ def setup_update_user(userid, name, fullname, email, password): # {{{
 	if password is None:
 		write('UPDATE {} SET name = %s, fullname = %s, email = %s WHERE id = %s'.format(global_prefix + 'user'), name, fullname, email, userid)
 	else:
-		write('UPDATE {} SET name = %s, fullname = %s, email = %s, password = %s WHERE id = %s'.format(global_prefix + 'user'), name, fullname, email, crypt.crypt(password), userid)
+		write('UPDATE {} SET name = %s, fullname = %s, email = %s, password = %s WHERE id = %s'.format(global_prefix + 'user'), name, fullname, email, make_hash(password), userid)
 	return None
 # }}}
 
@@ -355,6 +1536,14 @@ def find_game(userid, name): # {{{
 	return games[0]
 # }}}
 
+def bg_find_game(wake, userid, name): # {{{
+	'Generator version of find_game().'
+	games = (yield from bg_read1(wake, 'SELECT id FROM {} WHERE user = %s AND name = %s'.format(global_prefix + 'game'), userid, name))
+	if len(games) != 1:
+		return None
+	return games[0]
+# }}}
+
 def setup_add_game(userid, name, fullname, password): # {{{
 	connect()
 	users = read1('SELECT id FROM {} WHERE id = %s'.format(global_prefix + 'user'), userid)
@@ -365,7 +1554,21 @@ def setup_add_game(userid, name, fullname, password): # {{{
 	if len(game) != 0:
 		print('not creating duplicate game %s' % name, file = sys.stderr)
 		return 'Game registration failed: game already exists.'
-	write('INSERT INTO {} (user, name, fullname, password) VALUES (%s, %s, %s, %s)'.format(global_prefix + 'game'), userid, name, fullname, crypt.crypt(password))
+	write('INSERT INTO {} (user, name, fullname, password) VALUES (%s, %s, %s, %s)'.format(global_prefix + 'game'), userid, name, fullname, make_hash(password))
+	return None
+# }}}
+
+def bg_add_game(wake, userid, name, fullname, password): # {{{
+	'Generator version of setup_add_game().'
+	users = (yield from bg_read1(wake, 'SELECT id FROM {} WHERE id = %s'.format(global_prefix + 'user'), userid))
+	if len(users) == 0:
+		print('not creating game for nonexistent user %x' % userid, file = sys.stderr)
+		return 'Game registration failed: user does not exist.'
+	game = (yield from bg_read1(wake, 'SELECT name FROM {} WHERE user = %s AND name = %s'.format(global_prefix + 'game'), userid, name))
+	if len(game) != 0:
+		print('not creating duplicate game %s' % name, file = sys.stderr)
+		return 'Game registration failed: game already exists.'
+	yield from bg_write(wake, 'INSERT INTO {} (user, name, fullname, password) VALUES (%s, %s, %s, %s)'.format(global_prefix + 'game'), userid, name, fullname, make_hash(password))
 	return None
 # }}}
 
@@ -383,7 +1586,24 @@ def setup_update_game(gameid, userid, name, fullname, password): # {{{
 	if password is None:
 		write('UPDATE {} SET user = %s, name = %s, fullname = %s WHERE id = %s'.format(global_prefix + 'game'), userid, name, fullname, gameid)
 	else:
-		write('UPDATE {} SET user = %s, name = %s, fullname = %s, password = %s WHERE id = %s'.format(global_prefix + 'game'), userid, name, fullname, crypt.crypt(password), gameid)
+		write('UPDATE {} SET user = %s, name = %s, fullname = %s, password = %s WHERE id = %s'.format(global_prefix + 'game'), userid, name, fullname, make_hash(password), gameid)
+	return None
+# }}}
+
+def bg_update_game(wake, gameid, userid, name, fullname, password): # {{{
+	'Generator version of setup_update_game().'
+	users = (yield from bg_read1(wake, 'SELECT id FROM {} WHERE id = %s'.format(global_prefix + 'user'), userid))
+	if len(users) == 0:
+		print('not updating game to nonexistent user %x' % userid, file = sys.stderr)
+		return 'Game registration failed: user does not exist.'
+	ids = (yield from bg_read1(wake, 'SELECT id FROM {} WHERE user = %s AND name = %s'.format(global_prefix + 'game'), userid, name))
+	if len(ids) != 0 and gameid != ids[0]:
+		print('not updating to existing game %s' % name, file = sys.stderr)
+		return 'Game update failed: game already exists.'
+	if password is None:
+		yield from bg_write(wake, 'UPDATE {} SET user = %s, name = %s, fullname = %s WHERE id = %s'.format(global_prefix + 'game'), userid, name, fullname, gameid)
+	else:
+		yield from bg_write(wake, 'UPDATE {} SET user = %s, name = %s, fullname = %s, password = %s WHERE id = %s'.format(global_prefix + 'game'), userid, name, fullname, make_hash(password), gameid)
 	return None
 # }}}
 
@@ -391,17 +1611,33 @@ def setup_remove_game(gameid): # {{{
 	connect()
 	for player in setup_list_managed_players(gameid):
 		setup_remove_managed_player(player['id'])
-	tables = [x for x in read1('SHOW TABLES') if x.startswith(global_prefix + 'g%x_' % gameid)]
-	for table in tables:
-		write('DROP TABLE %s' % table)
+	drop_owner_tables('g%x_' % gameid)
+	drop_owner_tables('s%x_' % gameid)
+	write('DELETE FROM {} WHERE game = %s'.format(global_prefix + 'shared'), gameid)
 	write('DELETE FROM {} WHERE id = %s'.format(global_prefix + 'game'), gameid)
 # }}}
 
+def bg_remove_game(wake, gameid): # {{{
+	'Generator version of setup_remove_game().'
+	for player in (yield from bg_list_managed_players(wake, gameid)):
+		yield from bg_remove_managed_player(wake, player['id'])
+	yield from bg_drop_owner_tables(wake, 'g%x_' % gameid)
+	yield from bg_drop_owner_tables(wake, 's%x_' % gameid)
+	yield from bg_write(wake, 'DELETE FROM {} WHERE game = %s'.format(global_prefix + 'shared'), gameid)
+	yield from bg_write(wake, 'DELETE FROM {} WHERE id = %s'.format(global_prefix + 'game'), gameid)
+# }}}
+
 def setup_list_games(userid): # {{{
 	connect()
 	data = read('SELECT id, name, fullname FROM {} WHERE user = %s'.format(global_prefix + 'game'), userid)
 	return [{'id': id, 'name': name, 'fullname': fullname} for id, name, fullname in data]
 # }}}
+
+def bg_list_games(wake, userid): # {{{
+	'Generator version of setup_list_games().'
+	data = (yield from bg_read(wake, 'SELECT id, name, fullname FROM {} WHERE user = %s'.format(global_prefix + 'game'), userid))
+	return [{'id': id, 'name': name, 'fullname': fullname} for id, name, fullname in data]
+# }}}
 # }}}
 
 # Remote player management (for connect()). {{{
@@ -412,6 +1648,14 @@ def find_player(userid, url, name): # {{{
 	return {'id': players[0][0], 'name': players[0][1], 'language': players[0][2], 'is_default': players[0][3]}
 # }}}
 
+def bg_find_player(wake, userid, url, name): # {{{
+	'Generator version of find_player().'
+	players = (yield from bg_read(wake, 'SELECT id, fullname, language, is_default FROM {} WHERE user = %s AND url = %s AND name = %s'.format(global_prefix + 'player'), userid, url, name))
+	if len(players) != 1:
+		return None
+	return {'id': players[0][0], 'name': players[0][1], 'language': players[0][2], 'is_default': players[0][3]}
+# }}}
+
 def setup_add_player(userid, url, name, fullname, language, is_default): # {{{
 	connect()
 	# Check that user exists.
@@ -432,6 +1676,25 @@ def setup_add_player(userid, url, name, fullname, language, is_default): # {{{
 	return None
 # }}}
 
+def bg_add_player(wake, userid, url, name, fullname, language, is_default): # {{{
+	'Generator version of setup_add_player().'
+	# Check that user exists.
+	ids = (yield from bg_read1(wake, 'SELECT id FROM {} WHERE id = %s'.format(global_prefix + 'user'), userid))
+	if len(ids) != 1:
+		print('not creating player for unknown user %x' % userid, file = sys.stderr)
+		return 'Registration failed: user does not exist.'
+	# Check that player does not exist yet.
+	ids = (yield from bg_read1(wake, 'SELECT id FROM {} WHERE url = %s AND name = %s'.format(global_prefix + 'player'), url, name))
+	if len(ids) > 0:
+		print('not creating duplicate player %x for game %s @ %s' % (userid, name, url), file = sys.stderr)
+		return 'Not creating duplicate player %x for game %s @ %s' % (userid, name, url)
+	# If default is set, clear any other default that was set.
+	if is_default != 0:
+		yield from bg_write(wake, 'UPDATE {} SET is_default = 0 WHERE user = %s AND url = %s'.format(global_prefix + 'player'), userid, url)
+	yield from bg_write(wake, 'INSERT INTO {} (user, url, name, fullname, language, is_default) VALUES (%s, %s, %s, %s, %s, %s)'.format(global_prefix + 'player'), userid, url, name, fullname, language, int(is_default))
+	return None
+# }}}
+
 def setup_update_player(playerid, userid, url, name, fullname, language, is_default): # {{{
 	connect()
 	if len(read1('SELECT id FROM {} WHERE id = %s'.format(global_prefix + 'player'), playerid)) == 0:
@@ -454,14 +1717,39 @@ def setup_update_player(playerid, userid, url, name, fullname, language, is_defa
 	return None
 # }}}
 
+def bg_update_player(wake, playerid, userid, url, name, fullname, language, is_default): # {{{
+	'Generator version of setup_update_player().'
+	if len((yield from bg_read1(wake, 'SELECT id FROM {} WHERE id = %s'.format(global_prefix + 'player'), playerid))) == 0:
+		print('unknown player', file = sys.stderr)
+		return 'unknown player'
+	# Check that new user exists.
+	if len((yield from bg_read1(wake, 'SELECT id FROM {} WHERE id = %s'.format(global_prefix + 'user'), userid))) != 1:
+		print('not updating player: new user does not exist.', file = sys.stderr)
+		return 'Update failed: new user does not exist.'
+	# Check that name is not valid for user yet.
+	ids = (yield from bg_read1(wake, 'SELECT id FROM {} WHERE user = %s AND name = %s'.format(global_prefix + 'player'), userid, name))
+	if len(ids) > 0 and ids[0] != playerid:
+		print('not updating player: new name already exists.', file = sys.stderr)
+		return 'Update failed: new name already exists.'
+	# If default is now set: clear all other defaults.
+	if is_default:
+		yield from bg_write(wake, 'UPDATE {} SET is_default = 0 WHERE user = %s AND url = %s'.format(global_prefix + 'player'), userid, url)
+	yield from bg_write(wake, 'UPDATE {} SET user = %s, url = %s, name = %s, fullname = %s, language = %s, is_default = %s WHERE id = %s'.format(global_prefix + 'player'), userid, url, name, fullname, language, int(is_default), playerid)
+	return None
+# }}}
+
 def setup_remove_player(playerid): # {{{
 	connect()
-	tables = [x for x in read1('SHOW TABLES') if x.startswith(global_prefix + 'p%x_' % playerid)]
-	for table in tables:
-		write('DROP TABLE %s' % table)
+	drop_owner_tables('p%x_' % playerid)
 	write('DELETE FROM {} WHERE id = %s'.format(global_prefix + 'player'), playerid)
 # }}}
 
+def bg_remove_player(wake, playerid): # {{{
+	'Generator version of setup_remove_player().'
+	yield from bg_drop_owner_tables(wake, 'p%x_' % playerid)
+	yield from bg_write(wake, 'DELETE FROM {} WHERE id = %s'.format(global_prefix + 'player'), playerid)
+# }}}
+
 def setup_list_players(userid, url = None): # {{{
 	connect()
 	if url is None:
@@ -472,6 +1760,15 @@ def setup_list_players(userid, url = None): # {{{
 		return [{'id': id, 'name': name, 'fullname': fullname, 'is_default': bool(is_default)} for id, name, fullname, is_default in data]
 # }}}
 
+def bg_list_players(wake, userid, url = None): # {{{
+	'Generator version of setup_list_players().'
+	if url is None:
+		data = (yield from bg_read(wake, 'SELECT id, url, name, fullname, is_default FROM {} WHERE user = %s'.format(global_prefix + 'player'), userid))
+		return [{'id': id, 'url': url, 'name': name, 'fullname': fullname, 'is_default': bool(is_default)} for id, url, name, fullname, is_default in data]
+	data = (yield from bg_read(wake, 'SELECT id, name, fullname, is_default FROM {} WHERE user = %s AND url = %s'.format(global_prefix + 'player'), userid, url))
+	return [{'id': id, 'name': name, 'fullname': fullname, 'is_default': bool(is_default)} for id, name, fullname, is_default in data]
+# }}}
+
 def setup_get_default_player(userid, url): # {{{
 	connect()
 	# Find row that is marked as default.
@@ -497,6 +1794,17 @@ def setup_get_player(userid, url, name): # {{{
 	id, fullname, language, is_default = data[0]
 	return {'id': id, 'user': userid, 'name': name, 'fullname': fullname, 'language': language, 'url': url, 'is_default': is_default}
 # }}}
+
+def bg_get_player(wake, userid, url, name): # {{{
+	'Generator version of setup_get_player().'
+	data = (yield from bg_read(wake, 'SELECT id, fullname, language, is_default FROM {} WHERE user = %s AND url = %s AND name = %s'.format(global_prefix + 'player'), userid, url, name))
+	if len(data) == 0:
+		# Player does not exist.
+		return None
+	assert len(data) == 1
+	id, fullname, language, is_default = data[0]
+	return {'id': id, 'user': userid, 'name': name, 'fullname': fullname, 'language': language, 'url': url, 'is_default': is_default}
+# }}}
 # }}}
 
 # Managed player management (for login_player()). {{{
@@ -507,6 +1815,14 @@ def find_managed(gameid, name): # {{{
 	return {'id': players[0][0], 'name': players[0][1], 'language': players[0][2], 'email': players[0][3]}
 # }}}
 
+def bg_find_managed(wake, gameid, name): # {{{
+	'Generator version of find_managed().'
+	players = (yield from bg_read(wake, 'SELECT id, fullname, language, email FROM {} WHERE game = %s AND name = %s'.format(global_prefix + 'managed'), gameid, name))
+	if len(players) != 1:
+		return None
+	return {'id': players[0][0], 'name': players[0][1], 'language': players[0][2], 'email': players[0][3]}
+# }}}
+
 def setup_add_managed_player(gameid, name, fullname, email, password): # {{{
 	connect()
 	# Check that game exists.
@@ -517,7 +1833,17 @@ def setup_add_managed_player(gameid, name, fullname, email, password): # {{{
 	if len(read1('SELECT id FROM {} WHERE game = %s AND name = %s'.format(global_prefix + 'managed'), gameid, name)) != 0:
 		print('not creating duplicate player %s for game %x' % (name, gameid), file = sys.stderr)
 		return 'Not creating duplicate player %s for game %x' % (name, gameid)
-	write('INSERT INTO {} (game, name, fullname, email, password) VALUES (%s, %s, %s, %s, %s)'.format(global_prefix + 'managed'), gameid, name, fullname, email, crypt.crypt(password))
+	write('INSERT INTO {} (game, name, fullname, email, password) VALUES (%s, %s, %s, %s, %s)'.format(global_prefix + 'managed'), gameid, name, fullname, email, make_hash(password))
+	return None
+# }}}
+
+def bg_add_managed_player(wake, gameid, name, fullname, email, password): # {{{
+	'Generator version of setup_add_managed_player().'
+	# Check that player does not exist yet.
+	if len((yield from bg_read1(wake, 'SELECT id FROM {} WHERE game = %s AND name = %s'.format(global_prefix + 'managed'), gameid, name))) != 0:
+		print('not creating duplicate player %s for game %x' % (name, gameid), file = sys.stderr)
+		return 'Not creating duplicate player %s for game %x' % (name, gameid)
+	yield from bg_write(wake, 'INSERT INTO {} (game, name, fullname, email, password) VALUES (%s, %s, %s, %s, %s)'.format(global_prefix + 'managed'), gameid, name, fullname, email, make_hash(password))
 	return None
 # }}}
 
@@ -535,76 +1861,197 @@ def setup_update_managed_player(managedid, gameid, name, fullname, language, ema
 	if password is None:
 		write('UPDATE {} SET game = %s, name = %s, fullname = %s, language = %s, email = %s WHERE id = %s'.format(global_prefix + 'managed'), gameid, name, fullname, language, email, managedid)
 	else:
-		write('UPDATE {} SET game = %s, name = %s, fullname = %s, language = %s, email = %s, password = %s WHERE id = %s'.format(global_prefix + 'managed'), gameid, name, fullname, language, email, crypt.crypt(password), managedid)
+		write('UPDATE {} SET game = %s, name = %s, fullname = %s, language = %s, email = %s, password = %s WHERE id = %s'.format(global_prefix + 'managed'), gameid, name, fullname, language, email, make_hash(password), managedid)
+	return None
+# }}}
+
+def bg_update_managed_player(wake, managedid, gameid, name, fullname, language, email, password): # {{{
+	'Generator version of setup_update_managed_player().'
+	# Check that the new game exists.
+	if len((yield from bg_read1(wake, 'SELECT id FROM {} WHERE id = %s'.format(global_prefix + 'game'), gameid))) != 1:
+		print('not updating managed player to unknown game %x' % gameid, file = sys.stderr)
+		return 'Not updating managed player to unknown game.'
+	# Check that player does not exist yet.
+	ids = (yield from bg_read1(wake, 'SELECT id FROM {} WHERE game = %s AND name = %s'.format(global_prefix + 'managed'), gameid, name))
+	if len(ids) > 0 and ids[0] != managedid:
+		print('not updating duplicate player %s for game %x' % (name, gameid), file = sys.stderr)
+		return 'Not updating duplicate player %s for game %x' % (name, gameid)
+	if password is None:
+		yield from bg_write(wake, 'UPDATE {} SET game = %s, name = %s, fullname = %s, language = %s, email = %s WHERE id = %s'.format(global_prefix + 'managed'), gameid, name, fullname, language, email, managedid)
+	else:
+		yield from bg_write(wake, 'UPDATE {} SET game = %s, name = %s, fullname = %s, language = %s, email = %s, password = %s WHERE id = %s'.format(global_prefix + 'managed'), gameid, name, fullname, language, email, make_hash(password), managedid)
 	return None
 # }}}
 
 def setup_remove_managed_player(managedid): # {{{
 	connect()
-	tables = [x for x in read1('SHOW TABLES') if x.startswith(global_prefix + 'm%x_' % managedid)]
-	for table in tables:
-		write('DROP TABLE %s' % table)
+	drop_owner_tables('m%x_' % managedid)
+	delete_shared_rows(managedid)
 	write('DELETE FROM {} WHERE managedid = %s'.format(global_prefix + 'managed'), managedid)
 # }}}
 
+def bg_remove_managed_player(wake, managedid): # {{{
+	'Generator version of setup_remove_managed_player().'
+	yield from bg_drop_owner_tables(wake, 'm%x_' % managedid)
+	yield from bg_delete_shared_rows(wake, managedid)
+	yield from bg_write(wake, 'DELETE FROM {} WHERE id = %s'.format(global_prefix + 'managed'), managedid)
+# }}}
+
 def setup_list_managed_players(gameid): # {{{
 	connect()
 	data = read('SELECT id, name, fullname, email FROM {} WHERE game = %s'.format(global_prefix + 'managed'), gameid)
 	return [{'id': id, 'name': name, 'fullname': fullname, 'email': email} for id, name, fullname, email in data]
 # }}}
+
+def bg_list_managed_players(wake, gameid): # {{{
+	'Generator version of setup_list_managed_players().'
+	data = (yield from bg_read(wake, 'SELECT id, name, fullname, email FROM {} WHERE game = %s'.format(global_prefix + 'managed'), gameid))
+	return [{'id': id, 'name': name, 'fullname': fullname, 'email': email} for id, name, fullname, email in data]
+# }}}
 # }}}
 # }}}
 
-def authenticate_user(name, password): # {{{
-	'Check user credentials. Return user dict on success, None on failure.'
-	connect()
-	data = read('SELECT id, fullname, email, password FROM {} WHERE name = %s'.format(global_prefix + 'user'), name)
+# Inventory. {{{
+def bg_read_in(wake, cmd, values, *args): # {{{
+	'''Run a read with "IN ({})" in cmd for a list of values, and return all rows.
+	args are the arguments before the values. Long lists are split over several queries.'''
+	ret = []
+	for start in range(0, len(values), 500):
+		part = values[start:start + 500]
+		ret.extend((yield from bg_read(wake, cmd.format(', '.join(['%s'] * len(part))), *args, *part)))
+	return ret
+# }}}
+
+def bg_inventory(wake, user = None, game = None, offset = 0, limit = 100, managed = True, userid = None, managed_limit = 1000): # {{{
+	'''Return users with their external players, games and managed players, with the size of their tables.
+	user and game are names, userid is an id; if they are given, only matching users and games are returned.
+	Results are paginated by game: a page holds at most limit games, starting
+	at offset (a user without games counts as one). A user whose games are on
+	more than one page is on each of those pages.
+	Returns {'users': [...], 'next': offset of the next page, or None}. Users
+	are dicts with id, name, fullname, email, players and games. Every
+	external player, game and managed player has 'tables', 'rows' and 'bytes'
+	for its tables; rows and bytes are None if the backend does not know them.
+	For games, this includes their shared tables. If managed is False, the
+	games have no list of managed players; they always have managed_count.
+	If managed is True, a page ends before the game that would bring the
+	number of managed players over managed_limit. A game that has more
+	managed players on its own is alone on its page, and its list holds only
+	the first managed_limit of them; it is complete if its length is managed_count.
+	Everything is read with one query per kind of record, independent of the number of users and games.'''
+	conditions = []
+	args = []
+	if user is not None:
+		conditions.append('u.name = %s')
+		args.append(user)
+	if userid is not None:
+		conditions.append('u.id = %s')
+		args.append(userid)
+	# Users without games are only listed if no game was requested.
+	if game is None:
+		join = 'LEFT JOIN {} g ON g.user = u.id'.format(global_prefix + 'game')
+	else:
+		join = 'JOIN {} g ON g.user = u.id AND g.name = %s'.format(global_prefix + 'game')
+		args.insert(0, game)
+	rows = (yield from bg_read(wake, '''SELECT u.id, u.name, u.fullname, u.email, g.id, g.name, g.fullname, s.game IS NOT NULL, (SELECT COUNT(*) FROM {} m WHERE m.game = g.id)
+		FROM {} u {} LEFT JOIN {} s ON s.game = g.id{}
+		ORDER BY u.id, g.id LIMIT %s OFFSET %s'''.format(global_prefix + 'managed', global_prefix + 'user', join, global_prefix + 'shared', ' WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else ''), *args, limit + 1, offset))
+	next_offset = offset + limit if len(rows) > limit else None
+	rows = rows[:limit]
+	if managed:
+		total = 0
+		for i, row in enumerate(rows):
+			total += row[8] or 0
+			if total > managed_limit and i > 0:
+				rows = rows[:i]
+				next_offset = offset + i
+				break
+	users = {}
+	games = {}
+	owners = {}
+	def sized(owner, record):
+		owners.setdefault(owner, []).append(record)
+		record.update({'tables': 0, 'rows': None, 'bytes': None})
+		return record
+	for uid, uname, ufullname, email, gid, gname, gfullname, shared, count in rows:
+		if uid not in users:
+			users[uid] = {'id': uid, 'name': uname, 'fullname': ufullname, 'email': email, 'players': [], 'games': []}
+		if gid is None:
+			continue
+		record = sized('g%x_' % gid, {'id': gid, 'name': gname, 'fullname': gfullname, 'shared': bool(shared), 'managed_count': count})
+		if shared:
+			owners.setdefault('s%x_' % gid, []).append(record)
+		if managed:
+			record['managed'] = []
+		games[gid] = record
+		users[uid]['games'].append(record)
+	for id, uid, url, name, fullname, language, is_default in (yield from bg_read_in(wake, 'SELECT id, user, url, name, fullname, language, is_default FROM {} WHERE user IN ({{}}) ORDER BY user, id'.format(global_prefix + 'player'), list(users))):
+		users[uid]['players'].append(sized('p%x_' % id, {'id': id, 'url': url, 'name': name, 'fullname': fullname, 'language': language, 'is_default': bool(is_default)}))
+	if managed:
+		# The limit is only reached for a game that is alone on its page, or if managed players were added since the count.
+		for id, gid, name, fullname, email in (yield from bg_read_in(wake, 'SELECT id, game, name, fullname, email FROM {} WHERE game IN ({{}}) ORDER BY game, id LIMIT {:d}'.format(global_prefix + 'managed', managed_limit), list(games))):
+			games[gid]['managed'].append(sized('m%x_' % id, {'id': id, 'name': name, 'fullname': fullname, 'email': email}))
+	keys = list(owners)
+	for start in range(0, len(keys), 500):
+		cmd, args = backend.owner_sizes(global_prefix + 'catalog', global_prefix, keys[start:start + 500])
+		for owner, tables, records, size in (yield from bg_read(wake, cmd, *args)):
+			for record in owners[owner]:
+				record['tables'] += tables
+				if records is not None:
+					record['rows'] = (record['rows'] or 0) + int(records)
+				if size is not None:
+					record['bytes'] = (record['bytes'] or 0) + int(size)
+	return {'users': list(users.values()), 'next': next_offset}
+# }}}
+# }}}
+
+def authenticate_user(wake, name, password): # {{{
+	'''Check user credentials. Return user dict on success, None on failure.
+	This is a generator; the queries and the password check do not block the main loop.'''
+	data = (yield from bg_read(wake, 'SELECT id, fullname, email, password FROM {} WHERE name = %s'.format(global_prefix + 'user'), name))
 	if len(data) == 0:
 		print('Login failed: no such user.', file = sys.stderr)
 		return None
 	assert len(data) == 1
 	id, fullname, email, stored_password = data[0]
-	attempt = crypt.crypt(password, stored_password)
-	if stored_password != attempt:
+	if not (yield from bg_verify(wake, 'user', id, password, stored_password)):
 		print('Login failed: incorrect password.', file = sys.stderr)
 		return None
 	return {'id': id, 'name': name, 'fullname': fullname, 'email': email}
 # }}}
 
-def authenticate_game(username, name, password): # {{{
-	'Check game credentials. Return game dict on success, None on failure.'
-	connect()
-	users = read1('SELECT id FROM {} WHERE name = %s'.format(global_prefix + 'user'), username)
+def authenticate_game(wake, username, name, password): # {{{
+	'''Check game credentials. Return game dict on success, None on failure.
+	This is a generator; the queries and the password check do not block the main loop.'''
+	users = (yield from bg_read1(wake, 'SELECT id FROM {} WHERE name = %s'.format(global_prefix + 'user'), username))
 	if len(users) == 0:
 		print('Login failed: no such user.', file = sys.stderr)
 		return None
-	games = read('SELECT id, fullname, password FROM {} WHERE user = %s AND name = %s'.format(global_prefix + 'game'), users[0], name)
+	games = (yield from bg_read(wake, 'SELECT id, fullname, password FROM {} WHERE user = %s AND name = %s'.format(global_prefix + 'game'), users[0], name))
 	if len(games) != 1:
 		print('Login failed: no such game', file = sys.stderr)
 		return None
 	id, fullname, stored_password = games[0]
-	attempt = crypt.crypt(password, stored_password)
-	if stored_password != attempt:
+	if not (yield from bg_verify(wake, 'game', id, password, stored_password)):
 		print('Login failed: incorrect password.', file = sys.stderr)
 		return None
 	return {'id': id, 'user': users[0], 'name': name, 'fullname': fullname}
 # }}}
 
-def authenticate_player(gameid, name, password): # {{{
-	'Check managed player credentials. Return player dict on success, None on failure.'
-	connect()
-	games = read1('SELECT id FROM {} WHERE id = %s'.format(global_prefix + 'game'), gameid)
+def authenticate_player(wake, gameid, name, password): # {{{
+	'''Check managed player credentials. Return player dict on success, None on failure.
+	This is a generator; the queries and the password check do not block the main loop.'''
+	games = (yield from bg_read1(wake, 'SELECT id FROM {} WHERE id = %s'.format(global_prefix + 'game'), gameid))
 	if len(games) != 1:
 		print('Login failed: no such game.', file = sys.stderr)
 		return None
-	data = read('SELECT id, fullname, email, language, password FROM {} WHERE game = %s AND name = %s'.format(global_prefix + 'managed'), gameid, name)
+	data = (yield from bg_read(wake, 'SELECT id, fullname, email, language, password FROM {} WHERE game = %s AND name = %s'.format(global_prefix + 'managed'), gameid, name))
 	if len(data) == 0:
 		print('Login failed: no such player.', file = sys.stderr)
 		return None
 	assert len(data) == 1
 	id, fullname, email, language, stored_password = data[0]
-	attempt = crypt.crypt(password, stored_password)
-	if stored_password != attempt:
+	if not (yield from bg_verify(wake, 'managed', id, password, stored_password)):
 		print('Login failed: incorrect password.', file = sys.stderr)
 		return None
 	return {'id': id, 'game': gameid, 'name': name, 'fullname': fullname, 'email': email, 'language': language}
@@ -0,0 +1,278 @@
+# Metrics for userdata.
+# The server can export these in the Prometheus text format, on a separate port; see serve().
+
+# Imports {{{
+import sys
+import time
+import bisect
+import types
+import inspect
+import functools
+import threading
+import http.server
+import tracing
+# }}}
+
+'''Metrics: {{{
+Metrics are updated by the main thread, and read by the thread that serves
+the endpoint. Updates take a lock, so a scrape always sees complete
+observations. Gauges are computed from a function when they are scraped, so
+they cost nothing until then; the function runs in the scrape thread, so it
+must only read values (such as the length of a dict).
+
+Nothing is recorded unless enabled is True; the server sets it when the
+metrics port is configured.
+}}}'''
+
+enabled = False
+lock = threading.Lock()
+
+# All metrics, in the order that they are exported.
+registry = []
+
+# Upper bounds of histogram buckets, in seconds.
+latency_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+def escape(value): # {{{
+	'Escape a label value.'
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+# }}}
+
+def format_labels(names, values, extra = ''): # {{{
+	items = ['%s="%s"' % (name, escape(value)) for name, value in zip(names, values)]
+	if extra != '':
+		items.append(extra)
+	return '{%s}' % ','.join(items) if len(items) > 0 else ''
+# }}}
+
+def format_value(value): # {{{
+	if value == float('inf'):
+		return '+Inf'
+	return repr(value) if isinstance(value, float) else str(value)
+# }}}
+
+class Counter: # {{{
+	'Number of events, optionally split by labels.'
+	kind = 'counter'
+	def __init__(self, name, help, labels = ()): # {{{
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.values = {}
+		registry.append(self)
+	# }}}
+	def inc(self, *labels, amount = 1): # {{{
+		if not enabled:
+			return
+		with lock:
+			self.values[labels] = self.values.get(labels, 0) + amount
+	# }}}
+	def lines(self): # {{{
+		with lock:
+			values = list(self.values.items())
+		return ['%s%s %s' % (self.name, format_labels(self.labels, key), format_value(value)) for key, value in sorted(values)]
+	# }}}
+# }}}
+
+class Gauge: # {{{
+	'''Current value, computed when the metrics are scraped.
+	func returns a number, or (if labels are defined) a dict of label value tuples to numbers.'''
+	kind = 'gauge'
+	def __init__(self, name, help, func, labels = ()): # {{{
+		self.name = name
+		self.help = help
+		self.func = func
+		self.labels = labels
+		registry.append(self)
+	# }}}
+	def lines(self): # {{{
+		value = self.func()
+		if len(self.labels) == 0:
+			return ['%s %s' % (self.name, format_value(value))]
+		return ['%s%s %s' % (self.name, format_labels(self.labels, key), format_value(v)) for key, v in sorted(value.items())]
+	# }}}
+# }}}
+
+class Histogram: # {{{
+	'Distribution of durations (in seconds), optionally split by labels.'
+	kind = 'histogram'
+	def __init__(self, name, help, labels = (), buckets = latency_buckets): # {{{
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.buckets = buckets
+		# Values are [bucket counts (not cumulative, with one extra for +Inf), sum, count].
+		self.values = {}
+		registry.append(self)
+	# }}}
+	def observe(self, value, *labels): # {{{
+		if not enabled:
+			return
+		index = bisect.bisect_left(self.buckets, value)
+		with lock:
+			data = self.values.get(labels)
+			if data is None:
+				data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+			data[0][index] += 1
+			data[1] += value
+			data[2] += 1
+	# }}}
+	def time(self, *labels): # {{{
+		'Return a context manager that observes the time that its block takes.'
+		return Timer(self, labels)
+	# }}}
+	def lines(self): # {{{
+		with lock:
+			values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+		ret = []
+		for key, (counts, total, count) in sorted(values):
+			cumulative = 0
+			for bound, n in zip(self.buckets + (float('inf'),), counts):
+				cumulative += n
+				ret.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, key, 'le="%s"' % format_value(bound)), cumulative))
+			ret.append('%s_sum%s %s' % (self.name, format_labels(self.labels, key), format_value(total)))
+			ret.append('%s_count%s %d' % (self.name, format_labels(self.labels, key), count))
+		return ret
+	# }}}
+# }}}
+
+class Timer: # {{{
+	def __init__(self, histogram, labels): # {{{
+		self.histogram = histogram
+		self.labels = labels
+	# }}}
+	def __enter__(self): # {{{
+		self.start = time.monotonic()
+	# }}}
+	def __exit__(self, *a): # {{{
+		self.histogram.observe(time.monotonic() - self.start, *self.labels)
+	# }}}
+# }}}
+
+# Metrics that are recorded by more than one module.
+rpc_latency = Histogram('userdata_rpc_duration_seconds', 'Time from an RPC call until its result is returned; the _count is the number of calls', ('method',))
+rpc_errors = Counter('userdata_rpc_errors_total', 'Number of RPC calls that raised an exception', ('method',))
+db_latency = Histogram('userdata_db_request_duration_seconds', 'Time from submitting a database request until its result is handled, including waiting for a worker', ('kind',))
+auth = Counter('userdata_auth_total', 'Number of login attempts', ('kind', 'result'))
+
+def render(): # {{{
+	'Return all metrics in the Prometheus text format.'
+	ret = []
+	for metric in registry:
+		ret.append('# HELP %s %s' % (metric.name, metric.help))
+		ret.append('# TYPE %s %s' % (metric.name, metric.kind))
+		try:
+			ret.extend(metric.lines())
+		except Exception as e:
+			print('Error while reading metric %s: %s' % (metric.name, e), file = sys.stderr)
+	return '\n'.join(ret) + '\n'
+# }}}
+
+# Recording RPC calls. {{{
+# Instrumented methods, by (class, name).
+wrappers = {}
+
+class Instrumented: # {{{
+	'''Proxy for a connection object, which records the calls that are made through it.
+	The server gives this object to websocketd, so only calls from the remote
+	side are recorded, not calls that the object makes to its own methods.
+	While a call runs, tracing.current is set to it; this links database requests to their call.'''
+	def __init__(self, obj): # {{{
+		object.__setattr__(self, '_instrumented', obj)
+	# }}}
+	def __getattr__(self, attr): # {{{
+		obj = self._instrumented
+		value = getattr(obj, attr)
+		if attr.startswith('_') or not inspect.ismethod(value):
+			return value
+		key = (type(obj), attr)
+		if key not in wrappers:
+			wrappers[key] = instrument(attr, value.__func__)
+		return types.MethodType(wrappers[key], obj)
+	# }}}
+	def __setattr__(self, attr, value): # {{{
+		setattr(self._instrumented, attr, value)
+	# }}}
+# }}}
+
+def instrument(name, func): # {{{
+	'''Return a version of func (a method) which records its duration as a call of method name.
+	If the first argument of the method is called channel, it is recorded with the call for tracing.
+	Generator methods get their wake function from websocketd in a wake
+	argument; the remote side is not allowed to pass it.'''
+	parameters = list(inspect.signature(func).parameters)
+	has_channel = parameters[1:2] == ['channel']
+	wake_index = parameters.index('wake') if 'wake' in parameters else None
+	def begin(a, ka):
+		if wake_index is not None and (len(a) > wake_index or 'wake' in ka):
+			raise TypeError('%s() got an unexpected argument wake' % name)
+		return tracing.begin(name, a[1] if len(a) > 1 else ka.get('channel')) if has_channel else tracing.begin(name, None)
+	def end(call, start):
+		duration = time.monotonic() - start
+		rpc_latency.observe(duration, name)
+		tracing.end(call, duration)
+	if inspect.isgeneratorfunction(func):
+		# The call is finished when the generator is.
+		@functools.wraps(func)
+		def ret(*a, **ka):
+			call = begin(a, ka)
+			start = time.monotonic()
+			try:
+				return (yield from tracing.run(call, func(*a, **ka)))
+			except Exception:
+				rpc_errors.inc(name)
+				raise
+			finally:
+				end(call, start)
+		return ret
+	@functools.wraps(func)
+	def ret(*a, **ka):
+		call = begin(a, ka)
+		start = time.monotonic()
+		previous = tracing.current
+		tracing.current = call
+		try:
+			return func(*a, **ka)
+		except Exception:
+			rpc_errors.inc(name)
+			raise
+		finally:
+			tracing.current = previous
+			end(call, start)
+	return ret
+# }}}
+# }}}
+
+# Endpoint. {{{
+class Handler(http.server.BaseHTTPRequestHandler): # {{{
+	def do_GET(self): # {{{
+		if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+			self.send_error(404)
+			return
+		body = render().encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	# }}}
+	def log_message(self, format, *args): # {{{
+		# Do not log every scrape.
+		pass
+	# }}}
+# }}}
+
+def serve(port, address = 'localhost'): # {{{
+	'''Start recording metrics, and serve them on port of address (at / and /metrics).
+	The default address only accepts local connections; use '' for all interfaces.
+	Requests are handled by a separate thread, so scrapes do not delay the main loop.'''
+	global enabled
+	enabled = True
+	httpd = http.server.ThreadingHTTPServer((address, int(port)), Handler)
+	httpd.daemon_threads = True
+	threading.Thread(target = httpd.serve_forever, name = 'metrics', daemon = True).start()
+	return httpd
+# }}}
+# }}}
+
+# vim: set foldmethod=marker :
@@ -4,10 +4,11 @@
 # Imports {{{
 import sys
 import os
-import io
-import subprocess
+import re
+import ast
+import json
+import hashlib
 import importlib.resources
-import gettext
 import secrets
 import traceback
 import fhs
@@ -44,27 +45,97 @@ Interface:
 }}} '''
 
 # Translations. {{{
+# Parsed catalogs are cached as JSON files in this directory (created by fhs_init); when it is None, nothing is cached.
+catalog_cache = None
+
+def compile_translation(definition): # {{{
+	'''Parse the text of a po file (bytes) into a dict, like msgfmt does.
+	Fuzzy and untranslated entries are skipped. Plural forms are stored with
+	(msgid, n) keys and strings with a context with "context\x04msgid" keys,
+	as in gettext. The header is not included.
+	'''
+	charset = re.search(rb'charset=([-\w]+)', definition)
+	lines = definition.decode(charset.group(1).decode('ascii') if charset is not None else 'utf-8').split('\n')
+	ret = {}
+	entry = {}
+	fuzzy = False
+	key = None
+	def finish():
+		if 'msgid' in entry and not fuzzy:
+			msgid = entry['msgid'] if 'msgctxt' not in entry else entry['msgctxt'] + '\x04' + entry['msgid']
+			if 'msgid_plural' in entry:
+				forms = {k[1]: v for k, v in entry.items() if isinstance(k, tuple)}
+				if all(v != '' for v in forms.values()):
+					ret.update({(msgid, n): v for n, v in forms.items()})
+			elif entry.get('msgstr', '') != '':
+				ret[msgid] = entry['msgstr']
+		entry.clear()
+	for num, line in enumerate(lines):
+		line = line.strip()
+		if line.startswith('#'):
+			if key is not None:
+				finish()
+				fuzzy = False
+				key = None
+			if line.startswith('#,') and 'fuzzy' in (flag.strip() for flag in line[2:].split(',')):
+				fuzzy = True
+			continue
+		if line == '':
+			continue
+		if not line.startswith('"'):
+			keyword, line = line.split(None, 1)
+			if keyword in ('msgctxt', 'msgid') and any(k != 'msgctxt' for k in entry):
+				finish()
+				fuzzy = False
+			if keyword.startswith('msgstr['):
+				key = ('msgstr', int(keyword[7:-1]))
+			elif keyword in ('msgctxt', 'msgid', 'msgid_plural', 'msgstr'):
+				key = keyword
+			else:
+				raise ValueError('line %d: unknown keyword %s' % (num + 1, keyword))
+			entry[key] = ''
+		if key is None:
+			raise ValueError('line %d: string without keyword' % (num + 1))
+		entry[key] += ast.literal_eval(line)
+	finish()
+	ret.pop('', None)
+	return ret
+# }}}
+
 def parse_translation(definition): # {{{
 	'''Convert a single po file into a dict.
-	definition is a str or file.
-	Returns the dict.
+	definition is a filename or the contents of the file (bytes).
+	If catalog_cache is set, the result is stored there, with the hash of the
+	contents as its name; when the same file is parsed again, the stored result
+	is used.
+	Returns the dict, or None if the file could not be parsed.
 	'''
 	if not isinstance(definition, bytes):
-		with open(definition) as f:
+		with open(definition, 'rb') as f:
 			definition = f.read()
+	if catalog_cache is not None:
+		cachename = os.path.join(catalog_cache, hashlib.sha256(definition).hexdigest() + os.extsep + 'json')
+		try:
+			with open(cachename) as f:
+				return {(k[0], k[1]) if isinstance(k, list) else k: v for k, v in json.load(f)}
+		except FileNotFoundError:
+			pass
+		except (OSError, ValueError):
+			print('Warning: ignoring invalid cached translation %s' % cachename, file = sys.stderr)
 	try:
-		data = subprocess.run(('msgfmt', '-o', '-', '-'), input = definition, close_fds = True, stdout = subprocess.PIPE).stdout
-		assert len(data) > 0
+		ret = compile_translation(definition)
 	except:
 		print('Warning: translation could not be read', file = sys.stderr)
 		traceback.print_exc()
 		return None
-	terms = gettext.GNUTranslations()
-	terms._parse(io.BytesIO(data))
-	# Convert catalog to regular dict, just in case it wasn't.
-	ret = {k: v for k, v in terms._catalog.items()}
-	# Remove info node.
-	del ret['']
+	if catalog_cache is not None:
+		# Write to a temporary file first, so other processes never read a partial file.
+		try:
+			with open(cachename + '.tmp%d' % os.getpid(), 'w') as f:
+				json.dump(list(ret.items()), f)
+			os.replace(f.name, cachename)
+		except OSError as e:
+			print('Warning: unable to cache translation: %s' % e, file = sys.stderr)
 	return ret
 # }}}
 
@@ -92,6 +163,16 @@ def read_translations(path): # {{{
 	return ret
 # }}}
 
+# Templates for _(), split into parts: even items are text, odd items are argument numbers.
+compiled_templates = {}
+
+def compile_template(template): # {{{
+	parts = re.split(r'\$(\d)', template)
+	parts[1::2] = [int(n) for n in parts[1::2]]
+	compiled_templates[template] = parts
+	return parts
+# }}}
+
 def _(template, *args): # {{{
 	'''Translate a string into the currenly selected language.
 	This function is not used by the module. It is meant to be imported by the game using:
@@ -102,13 +183,18 @@ def _(template, *args): # {{{
 	else:
 		print('Warning: translation for "%s" not found in dictionary' % template, file = sys.stderr)
 	# Handle template the same as in javascript.
-	def replace(match):
-		n = int(match.group(1))
+	parts = compiled_templates.get(template) or compile_template(template)
+	if len(parts) == 1:
+		return template
+	ret = parts[:]
+	for i in range(1, len(parts), 2):
+		n = parts[i]
 		if not 1 <= n <= len(args):
 			print('Warning: translation template "%s" references invalid argument %d' % (template, n), file = sys.stderr)
-			return b'[%d]' % n
-		return args[n - 1]
-	return re.sub(rb'\$(\d)', template, replace)
+			ret[i] = '[%d]' % n
+		else:
+			ret[i] = str(args[n - 1])
+	return ''.join(ret)
 # }}}
 
 def N_(template): # {{{
@@ -118,6 +204,9 @@ def N_(template): # {{{
 # }}}
 
 class Access: # {{{
+	'''Access to the data on one channel of a userdata connection.
+	All database functions of the userdata (select, insert, insert_many, update_many, delete_many, etc.)
+	can be called on this object without the channel argument.'''
 	def __init__(self, obj, channel): # {{{
 		self.obj = obj
 		self.channel = channel
@@ -134,7 +223,50 @@ class Access: # {{{
 			return func.event(self.channel, *a, **ka)
 		# }}}
 		return ret
+	# }}}
+	def select_iter(self, *a, **ka): # {{{
+		'Return a Stream for a select_stream() call with the given arguments.'
+		return Stream(self, a, ka)
+	# }}}
 # }}}
+
+class Stream: # {{{
+	'''Iterator over the chunks of rows of a large select.
+	Use it from a generator:
+		stream = access.select_iter(table, columns, condition, chunk = 100)
+		while True:
+			rows = (yield from stream.next(wake = wake))
+			if rows is None:
+				break
+	Call close() to stop before all rows are retrieved.'''
+	def __init__(self, access, args, kwargs): # {{{
+		self.access = access
+		self.args = args
+		self.kwargs = kwargs
+		self.chunk = kwargs.get('chunk')
+		self.started = False
+		self.token = None
+	# }}}
+	def next(self, wake): # {{{
+		'Return the next list of rows, or None when all rows have been retrieved.'
+		if not self.started:
+			self.started = True
+			reply = (yield from self.access.select_stream(*self.args, wake = wake, **self.kwargs))
+		elif self.token is None:
+			return None
+		else:
+			reply = (yield from self.access.select_next(self.token, self.chunk, wake = wake))
+		self.token = reply['token']
+		if len(reply['rows']) == 0 and self.token is None:
+			return None
+		return reply['rows']
+	# }}}
+	def close(self): # {{{
+		if self.token is not None:
+			self.access.obj.select_close.event(self.access.channel, self.token)
+			self.token = None
+		self.started = True
+	# }}}
 # }}}
 
 class Player: # {{{
@@ -444,7 +576,11 @@ def fhs_init(url, name, *a, **ka): # {{{
 	assert '.' not in config['default-userdata'].split('/')[-1]
 
 	# Read translations. {{{
-	global system_strings, game_strings_html, game_strings_python
+	global system_strings, game_strings_html, game_strings_python, catalog_cache
+	try:
+		catalog_cache = fhs.write_cache('translations', dir = True)
+	except Exception as e:
+		print('Warning: not caching translations: %s' % e, file = sys.stderr)
 	# System translations.
 	langfiles = importlib.resources.files(__package__).joinpath('lang')
 	print('lang', langfiles)
@@ -0,0 +1,142 @@
+# Password hashing for userdata.
+# This module only contains pure functions, so they can be run in worker processes.
+
+# Imports {{{
+import sys
+import os
+import hmac
+import base64
+import hashlib
+try:
+	import crypt
+except ImportError:
+	# The crypt module was removed from Python; legacy hashes can not be verified without it.
+	crypt = None
+# }}}
+
+'''Hash format: {{{
+New hashes use the scrypt backend and are stored as:
+	$scrypt$ln=<log2 of cost>,r=<block size>,p=<parallelism>$<salt>$<hash>
+Salt and hash are base64 encoded without padding.
+
+Hashes that do not start with $scrypt$ are legacy hashes, created by
+crypt.crypt(). They are still accepted, and are replaced by a hash from the
+configured backend on the next successful login.
+}}}'''
+
+# Default settings. These can be changed through the db module options.
+DEFAULT_BACKEND = 'scrypt'
+DEFAULT_COST = 14
+BLOCK_SIZE = 8
+PARALLELISM = 1
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+def _b64encode(data): # {{{
+	return base64.b64encode(data).decode('ascii').rstrip('=')
+# }}}
+
+def _b64decode(data): # {{{
+	return base64.b64decode(data + '=' * (-len(data) % 4))
+# }}}
+
+# Backends. {{{
+def _scrypt(password, salt, cost, r, p): # {{{
+	n = 1 << cost
+	# Allow enough memory for the requested cost; hashlib defaults to 32 MiB.
+	return hashlib.scrypt(password.encode('utf-8'), salt = salt, n = n, r = r, p = p, maxmem = 256 * r * n + (1 << 20), dklen = KEY_SIZE)
+# }}}
+
+def _scrypt_hash(password, cost): # {{{
+	salt = os.urandom(SALT_SIZE)
+	key = _scrypt(password, salt, cost, BLOCK_SIZE, PARALLELISM)
+	return '$scrypt$ln=%d,r=%d,p=%d$%s$%s' % (cost, BLOCK_SIZE, PARALLELISM, _b64encode(salt), _b64encode(key))
+# }}}
+
+def _scrypt_parse(stored): # {{{
+	'Return (cost, r, p, salt, key) for a stored scrypt hash.'
+	empty, name, params, salt, key = stored.split('$')
+	assert empty == '' and name == 'scrypt'
+	params = dict(x.split('=', 1) for x in params.split(','))
+	return int(params['ln']), int(params['r']), int(params['p']), _b64decode(salt), _b64decode(key)
+# }}}
+
+def _scrypt_verify(password, stored): # {{{
+	cost, r, p, salt, key = _scrypt_parse(stored)
+	return hmac.compare_digest(_scrypt(password, salt, cost, r, p), key)
+# }}}
+
+def _scrypt_current(stored, cost): # {{{
+	'Check if a stored hash uses the current parameters.'
+	return _scrypt_parse(stored)[:3] == (cost, BLOCK_SIZE, PARALLELISM)
+# }}}
+
+def _crypt_hash(password, cost): # {{{
+	if crypt is None:
+		raise NotImplementedError('crypt backend is not available in this version of Python')
+	return crypt.crypt(password)
+# }}}
+
+def _crypt_verify(password, stored): # {{{
+	if crypt is None:
+		print('Unable to verify legacy password hash: crypt module is not available', file = sys.stderr)
+		return False
+	return hmac.compare_digest(crypt.crypt(password, stored), stored)
+# }}}
+
+def _crypt_current(stored, cost): # {{{
+	return True
+# }}}
+
+# Each backend is a tuple of (prefix, hash, verify, current).
+# The prefix identifies stored hashes; None is used for crypt, which is the fallback.
+backends = {
+	'scrypt': ('$scrypt$', _scrypt_hash, _scrypt_verify, _scrypt_current),
+	'crypt': (None, _crypt_hash, _crypt_verify, _crypt_current),
+}
+# }}}
+
+def identify(stored): # {{{
+	'Return the name of the backend that created a stored hash.'
+	for name, (prefix, h, v, c) in backends.items():
+		if prefix is not None and stored.startswith(prefix):
+			return name
+	return 'crypt'
+# }}}
+
+def is_hash(value): # {{{
+	'Return True if value is a hash from a backend that marks its hashes with a prefix, as opposed to a plain text password.'
+	return any(prefix is not None and value.startswith(prefix) for prefix, h, v, c in backends.values())
+# }}}
+
+def hash_password(password, backend = DEFAULT_BACKEND, cost = DEFAULT_COST): # {{{
+	'Create a new hash for password, to be stored in the database.'
+	return backends[backend][1](password, cost)
+# }}}
+
+def verify_password(password, stored, backend = DEFAULT_BACKEND, cost = DEFAULT_COST): # {{{
+	'''Check password against a stored hash.
+	Returns a 2-tuple (ok, rehash). ok is True if the password matches.
+	rehash is None, or a new hash that should replace the stored hash because
+	it was not created by the configured backend with the configured cost.
+	'''
+	name = identify(stored)
+	prefix, h, verify, current = backends[name]
+	if not verify(password, stored):
+		return (False, None)
+	if name == backend and current(stored, cost):
+		return (True, None)
+	return (True, hash_password(password, backend, cost))
+# }}}
+
+def refresh_hash(password, stored, backend = DEFAULT_BACKEND, cost = DEFAULT_COST): # {{{
+	'''Return the hash to store for password, if stored (which may be None) is the hash that is stored now.
+	This is stored itself if it matches and is current, so unchanged passwords are not written again.'''
+	if stored is not None:
+		ok, rehash = verify_password(password, stored, backend, cost)
+		if ok:
+			return stored if rehash is None else rehash
+	return hash_password(password, backend, cost)
+# }}}
+
+# vim: set foldmethod=marker :
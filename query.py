@@ -0,0 +1,418 @@
+# Query building for userdata.
+# This module converts the arguments of the data access RPCs into SQL, and caches the result per query shape.
+
+# Imports {{{
+import sys
+import time
+import collections
+import fhs
+import db
+import schema
+# }}}
+
+'''Query shapes: {{{
+The shape of a query is everything about it except the values: the kind of
+query, the table name (without prefix), the columns and the structure of the
+condition. Games issue the same shapes over and over, so the SQL for each
+shape is built and validated once, and stored in an LRU cache. For each call,
+only the shape and the values are extracted from the arguments.
+
+The table prefix is not part of the shape, so the same entry is used for all
+owners. A compiled query is a 2-tuple of the SQL before and after the table
+name.
+
+For shared tables (see schema.py), the shape includes a flag, and queries are
+restricted to the owner: the owner id is the first value for select, update
+and delete, and the last value for insert.
+
+Optionally, the results of select queries are cached as well, keyed by
+prefixed table name, compiled query and values. The server invalidates a
+table whenever it writes to it, but it does not see writes from other
+processes: the command line tools, provisioning, or another server on the
+same database. Results therefore expire after result-cache-ttl seconds,
+which bounds how old a result can be after such a write. A ttl of 0 keeps
+results until they are invalidated; that is only correct if all writes to the
+player and game tables go through the same server process.
+}}}'''
+
+fhs.module_info('query', 'query building', '0.1', 'Bas Wijnen <wijnen@debian.org>')
+fhs.module_option('query', 'query-cache-size', 'maximum number of query shapes to keep in the cache', default = 1024, argtype = int)
+fhs.module_option('query', 'result-cache-size', 'maximum number of bytes of select results to keep in memory; 0 disables the result cache', default = 0, argtype = int)
+fhs.module_option('query', 'result-cache-entries', 'maximum number of select results to keep in memory', default = 10000, argtype = int)
+fhs.module_option('query', 'result-cache-ttl', 'number of seconds after which a cached select result expires; writes by other processes (command line tools, provisioning, other servers) are only seen after this time. 0 keeps results until this server writes to the table, which is only correct if no other process writes to it', default = 5, argtype = float)
+
+@fhs.atinit
+def init():
+	values, present = fhs.module_get_config('query', True)
+	cache.size = values['query-cache-size']
+	results.max_bytes = values['result-cache-size']
+	results.size = values['result-cache-entries']
+	results.ttl = values['result-cache-ttl']
+	assert results.ttl >= 0
+
+class Cache: # {{{
+	'LRU cache with hit and miss counters.'
+	def __init__(self, size): # {{{
+		self.size = size
+		self.data = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+	# }}}
+	def get(self, key): # {{{
+		'Return cached value, or None.'
+		ret = self.data.get(key)
+		if ret is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.data.move_to_end(key)
+		return ret
+	# }}}
+	def put(self, key, value): # {{{
+		self.data[key] = value
+		while len(self.data) > self.size:
+			self.data.popitem(last = False)
+	# }}}
+	def stats(self): # {{{
+		'Return a dict with the cache statistics.'
+		return {'size': len(self.data), 'max-size': self.size, 'hits': self.hits, 'misses': self.misses, 'hit-rate': hit_rate(self.hits, self.misses)}
+	# }}}
+# }}}
+
+def hit_rate(hits, misses): # {{{
+	if hits + misses == 0:
+		return None
+	return hits / (hits + misses)
+# }}}
+
+def result_size(rows): # {{{
+	'Estimate the memory used by a query result.'
+	return sys.getsizeof(rows) + sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row) for row in rows)
+# }}}
+
+class ResultCache: # {{{
+	'''LRU cache of select results, limited by number of entries and by size.
+	Entries are indexed by their (prefixed) table name, so writes to a table
+	can drop exactly the results that read from it.
+	Every invalidation increments generation. A result must only be stored if
+	the generation did not change while it was being read, because it may be
+	older than the write that caused the invalidation.
+	If ttl is not 0, entries expire ttl seconds after they were stored, so
+	writes that the server does not see are not hidden for longer than that.'''
+	def __init__(self, max_bytes, size, ttl = 0): # {{{
+		self.max_bytes = max_bytes
+		self.size = size
+		self.ttl = ttl
+		self.data = collections.OrderedDict()	# key -> (table, rows, size, expiry time or None)
+		self.tables = {}	# table -> set of keys
+		self.bytes = 0
+		self.generation = 0
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+	# }}}
+	def enabled(self): # {{{
+		return self.max_bytes > 0 and self.size > 0
+	# }}}
+	def key(self, table, compiled, values): # {{{
+		'Return the key for a result, or None if it cannot be cached.'
+		key = (table, compiled, tuple(values))
+		try:
+			hash(key)
+		except TypeError:
+			return None
+		return key
+	# }}}
+	def get(self, key): # {{{
+		'Return cached rows, or None.'
+		ret = self.data.get(key)
+		if ret is not None and ret[3] is not None and time.monotonic() >= ret[3]:
+			self.remove(key)
+			ret = None
+		if ret is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.data.move_to_end(key)
+		return ret[1]
+	# }}}
+	def put(self, key, rows, generation): # {{{
+		'Store rows, if no invalidation happened since generation.'
+		if generation != self.generation or key in self.data:
+			return
+		size = result_size(rows)
+		if size > self.max_bytes:
+			return
+		table = key[0]
+		self.data[key] = (table, rows, size, time.monotonic() + self.ttl if self.ttl > 0 else None)
+		self.tables.setdefault(table, set()).add(key)
+		self.bytes += size
+		while len(self.data) > self.size or self.bytes > self.max_bytes:
+			self.remove(next(iter(self.data)))
+	# }}}
+	def remove(self, key): # {{{
+		table, rows, size, expiry = self.data.pop(key)
+		self.bytes -= size
+		keys = self.tables[table]
+		keys.discard(key)
+		if len(keys) == 0:
+			del self.tables[table]
+	# }}}
+	def invalidate(self, table): # {{{
+		'Drop all results of a table.'
+		self.generation += 1
+		self.invalidations += 1
+		for key in self.tables.pop(table, ()):
+			self.bytes -= self.data.pop(key)[2]
+	# }}}
+	def invalidate_prefix(self, prefix): # {{{
+		'Drop all results of tables that start with prefix; this is used for all tables of an owner.'
+		for table in [t for t in self.tables if t.startswith(prefix)]:
+			self.invalidate(table)
+		self.generation += 1
+	# }}}
+	def stats(self): # {{{
+		'Return a dict with the cache statistics.'
+		return {'size': len(self.data), 'max-size': self.size, 'bytes': self.bytes, 'max-bytes': self.max_bytes, 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses, 'hit-rate': hit_rate(self.hits, self.misses), 'invalidations': self.invalidations}
+	# }}}
+# }}}
+
+cache = Cache(1024)
+results = ResultCache(0, 10000, 5)
+
+# Conditions. {{{
+# A condition argument is an RPN expression tree.
+# Nodes are ('and' | 'or', branch1, branch2, ...) or ('not', branch).
+# Leaves are:
+#	('=' | '>' | '<' | '>=' | '<=' | '<>' | 'like', column, value)
+#	('in', column, [value, ...])
+#	('between', column, low, high)
+# A comparison of = or <> with None becomes IS NULL or IS NOT NULL.
+comparisons = ('=', '<', '>', '<=', '>=', '<>', 'LIKE')
+
+def condition_shape(condition, values): # {{{
+	'''Return the shape of a condition, and append its values to values.
+	Comparisons with None are part of the shape, because they become IS NULL.'''
+	if not isinstance(condition, (list, tuple)):
+		raise ValueError('condition must be a list')
+	if len(condition) == 0:
+		return ()
+	if not isinstance(condition[0], str):
+		raise ValueError('condition must start with an operator')
+	op = condition[0].upper()
+	if op in ('AND', 'OR'):
+		if len(condition) < 3:
+			raise ValueError('%s needs at least two branches' % op)
+		return (op,) + tuple(condition_shape(c, values) for c in condition[1:])
+	if op == 'NOT':
+		if len(condition) != 2:
+			raise ValueError('NOT needs exactly one branch')
+		return (op, condition_shape(condition[1], values))
+	if op not in comparisons + ('IN', 'BETWEEN'):
+		raise ValueError('unsupported condition: %s' % op)
+	if len(condition) < 2 or not isinstance(condition[1], str):
+		raise ValueError('%s needs a column name' % op)
+	if op == 'IN':
+		if len(condition) != 3 or not isinstance(condition[2], (list, tuple)):
+			raise ValueError('IN needs a column and a list of values')
+		values.extend(condition[2])
+		return (op, condition[1], len(condition[2]))
+	if op == 'BETWEEN':
+		if len(condition) != 4:
+			raise ValueError('BETWEEN needs a column and two values')
+		values.extend(condition[2:])
+		return (op, condition[1], 2)
+	if len(condition) != 3:
+		raise ValueError('comparison needs a column and a value')
+	if op in ('=', '<>') and condition[2] is None:
+		return (op, condition[1], None)
+	values.append(condition[2])
+	return (op, condition[1], 1)
+# }}}
+
+def compile_condition(shape): # {{{
+	'Return the SQL for a condition shape, without WHERE.'
+	op = shape[0]
+	if op in ('AND', 'OR'):
+		return '(' + (' ' + op + ' ').join(compile_condition(c) for c in shape[1:]) + ')'
+	if op == 'NOT':
+		return 'NOT (' + compile_condition(shape[1]) + ')'
+	db.assert_is_id(shape[1])
+	if op == 'IN':
+		if shape[2] == 0:
+			# An empty list matches nothing; IN () is not valid SQL.
+			return '(1 = 0)'
+		return '%s IN (%s)' % (shape[1], ', '.join('%s' for i in range(shape[2])))
+	if op == 'BETWEEN':
+		return shape[1] + ' BETWEEN %s AND %s'
+	if op not in comparisons:
+		raise ValueError('unsupported condition: %s' % op)
+	if shape[2] is None:
+		return shape[1] + ' IS' + ('' if op == '=' else ' NOT') + ' NULL'
+	return shape[1] + ' ' + op + ' %s'
+# }}}
+
+def where(shape, shared = False): # {{{
+	conditions = []
+	if shared:
+		conditions.append(schema.owner_column + ' = %s')
+	if len(shape) > 0:
+		conditions.append(compile_condition(shape))
+	if len(conditions) == 0:
+		return ''
+	return ' WHERE ' + ' AND '.join(conditions)
+# }}}
+# }}}
+
+# Columns, grouping and ordering. {{{
+# Selected columns are column names, or (function, column) for aggregates,
+# where function is one of count, sum, min, max. Only count accepts '*' as column.
+# Order entries are a column (as for selected columns), or (column, 'asc' | 'desc').
+aggregates = ('COUNT', 'SUM', 'MIN', 'MAX')
+
+def names(value, what): # {{{
+	'''Return a tuple of column names from a name or a list of names.
+	Anything else raises ValueError here, before it is used in a cache key.'''
+	if isinstance(value, str):
+		return (value,)
+	if not isinstance(value, (list, tuple)) or not all(isinstance(v, str) for v in value):
+		raise ValueError('%s must be a column name or a list of column names' % what)
+	return tuple(value)
+# }}}
+
+def column_shape(column): # {{{
+	if isinstance(column, str):
+		return column
+	if not isinstance(column, (list, tuple)) or len(column) != 2 or not all(isinstance(x, str) for x in column):
+		raise ValueError('aggregate column must be (function, column)')
+	return (column[0].upper(), column[1])
+# }}}
+
+def compile_column(shape): # {{{
+	if isinstance(shape, str):
+		db.assert_is_id(shape)
+		return shape
+	func, column = shape
+	if func not in aggregates:
+		raise ValueError('invalid aggregate function')
+	if column == '*':
+		if func != 'COUNT':
+			raise ValueError('only COUNT accepts *')
+	else:
+		db.assert_is_id(column)
+	return '%s(%s)' % (func, column)
+# }}}
+
+def order_shape(order): # {{{
+	if isinstance(order, str):
+		order = (order,)
+	if not isinstance(order, (list, tuple)):
+		raise ValueError('order must be a list')
+	ret = []
+	for entry in order:
+		if isinstance(entry, str):
+			ret.append((entry, 'ASC'))
+		else:
+			if not isinstance(entry, (list, tuple)) or len(entry) != 2 or not isinstance(entry[1], str):
+				raise ValueError('order entry must be a column or (column, direction)')
+			ret.append((column_shape(entry[0]), entry[1].upper()))
+	return tuple(ret)
+# }}}
+
+def compile_order(shape): # {{{
+	for column, direction in shape:
+		if direction not in ('ASC', 'DESC'):
+			raise ValueError('invalid order direction')
+	return ', '.join('%s %s' % (compile_column(column), direction) for column, direction in shape)
+# }}}
+
+def check_count(value, name): # {{{
+	'Validate a limit or offset value.'
+	if value is None:
+		return False
+	if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+		raise ValueError('%s must be a non-negative integer' % name)
+	return True
+# }}}
+# }}}
+
+def compile_query(kind, table, columns, shape, group = (), order = (), limit = False, offset = False, shared = False): # {{{
+	'Build and validate the SQL for a query shape.'
+	db.assert_is_id(table)
+	if kind == 'select':
+		tail = where(shape, shared)
+		if len(group) > 0:
+			for c in group:
+				db.assert_is_id(c)
+			tail += ' GROUP BY ' + ', '.join(group)
+		if len(order) > 0:
+			tail += ' ORDER BY ' + compile_order(order)
+		if limit:
+			tail += ' LIMIT %s'
+		if offset:
+			if not limit:
+				# MySQL does not allow OFFSET without LIMIT; this is the documented way to select all remaining rows.
+				tail += ' LIMIT 18446744073709551615'
+			tail += ' OFFSET %s'
+		return ('SELECT %s FROM ' % ', '.join(compile_column(c) for c in columns), tail)
+	for c in columns:
+		db.assert_is_id(c)
+		if shared and c == schema.owner_column:
+			raise ValueError('owner column cannot be changed')
+	if kind == 'insert':
+		if shared:
+			columns += (schema.owner_column,)
+		return ('INSERT INTO ', ' (%s) VALUES (%s)' % (', '.join(columns), ', '.join('%s' for c in columns)))
+	if kind == 'update':
+		return ('UPDATE ', ' SET %s%s' % (', '.join('%s = %%s' % c for c in columns), where(shape, shared)))
+	if kind == 'delete':
+		return ('DELETE FROM ', where(shape, shared))
+	raise ValueError('invalid query kind')
+# }}}
+
+def build(kind, table, columns, condition = (), group = (), order = (), limit = None, offset = None, owner = None): # {{{
+	'''Return the compiled query and the list of values.
+	kind is 'select', 'insert', 'update' or 'delete'. Aggregates, group, order, limit and offset are only allowed for select.
+	If owner is not None, the table is a shared table and owner is the id of the owner.
+	The full query is ret[0][0] + prefixed_table_name + ret[0][1].'''
+	if not isinstance(table, str):
+		raise ValueError('table must be a string')
+	values = []
+	shared = owner is not None
+	if shared and kind != 'insert':
+		values.append(owner)
+	if kind == 'select':
+		if isinstance(columns, str):
+			columns = (columns,)
+		if not isinstance(columns, (list, tuple)):
+			raise ValueError('columns must be a list')
+		columns = tuple(column_shape(c) for c in columns)
+		has_limit = check_count(limit, 'limit')
+		has_offset = check_count(offset, 'offset')
+		key = (kind, table, columns, condition_shape(condition, values), names(group, 'group'), order_shape(order), has_limit, has_offset, shared)
+		if has_limit:
+			values.append(limit)
+		if has_offset:
+			values.append(offset)
+	else:
+		key = (kind, table, names(columns, 'columns'), condition_shape(condition, values), (), (), False, False, shared)
+		if shared and kind == 'insert':
+			values.append(owner)
+	compiled = cache.get(key)
+	if compiled is None:
+		compiled = compile_query(*key)
+		cache.put(key, compiled)
+	return compiled, values
+# }}}
+
+def union(compiled, tables): # {{{
+	'''Return the SQL for a compiled select over several (prefixed) tables, combined with UNION ALL.
+	Every row starts with an extra column, which is bound to the first value for each table.
+	So the values are: tag1, *values, tag2, *values, etc.
+	Order and limit apply to each table separately; the backend decides how the parts are combined.'''
+	head, tail = compiled
+	assert head.startswith('SELECT ')
+	return db.backend.union(['SELECT %s, ' + head[len('SELECT '):] + t + tail for t in tables])
+# }}}
+
+# vim: set foldmethod=marker :
@@ -0,0 +1,307 @@
+# Schema comparison for userdata.
+# This module computes the changes that are needed to make the tables of an
+# owner match a definition, as passed to Connection.setup_db().
+
+# Imports {{{
+import re
+import json
+import hashlib
+# }}}
+
+'''Definitions: {{{
+A definition is a dict of table name to a list of (column name, column
+definition) pairs. Column definitions are MySQL column definitions, such as
+'VARCHAR(255) NOT NULL UNIQUE' or 'INT PRIMARY KEY AUTO_INCREMENT'.
+
+Both the definition and the current state of the database are converted into
+Column objects, which can be compared independent of spelling (for example,
+'int' and 'INT(11)' are the same type).
+
+A plan is a list of steps. Each step is a dict with keys:
+	- 'table': table name without prefix.
+	- 'action': 'create', 'drop', 'alter' or (for shared tables, see restrict_shared()) 'delete'.
+	- 'changes': for 'alter', the list of clauses for the ALTER TABLE statement; for 'create', the list of column definitions; for 'drop' and 'delete', an empty list.
+}}}'''
+
+class Column: # {{{
+	'''Normalized column description.
+	For columns that are read from the database, unique is the name of the
+	unique index on the column, or False; for definitions it is a bool.'''
+	def __init__(self, name, type, nullable = True, default = None, auto_increment = False, primary = False, unique = False): # {{{
+		self.name = name
+		self.type = normalize_type(type)
+		self.nullable = nullable and not primary
+		self.default = normalize_default(default)
+		self.auto_increment = auto_increment
+		self.primary = primary
+		self.unique = unique
+	# }}}
+	def same_definition(self, other): # {{{
+		'Check if the column definition (excluding keys) matches.'
+		return (self.type, self.nullable, self.default, self.auto_increment) == (other.type, other.nullable, other.default, other.auto_increment)
+	# }}}
+# }}}
+
+def normalize_type(type): # {{{
+	'Return a canonical form of a column type.'
+	type = ' '.join(type.lower().split())
+	type = re.sub(r'^integer\b', 'int', type)
+	type = re.sub(r'^bool(ean)?\b', 'tinyint', type)
+	# Display widths of integer types have no effect on storage.
+	type = re.sub(r'^(tinyint|smallint|mediumint|int|bigint)\s*\(\s*\d+\s*\)', r'\1', type)
+	type = re.sub(r'\s*\(\s*', '(', type)
+	type = re.sub(r'\s*,\s*', ',', type)
+	type = re.sub(r'\s*\)', ')', type)
+	return type
+# }}}
+
+def normalize_default(default): # {{{
+	'Return a canonical form of a column default; None for no default or NULL.'
+	if default is None:
+		return None
+	default = default.strip()
+	if default.upper() == 'NULL':
+		return None
+	if len(default) >= 2 and default[0] == default[-1] and default[0] in '\'"':
+		default = default[1:-1].replace(default[0] * 2, default[0])
+	if re.match(r'^current_timestamp(\(\))?$', default, re.I):
+		return 'current_timestamp'
+	return default
+# }}}
+
+# Column attributes that are recognized in a definition. Anything after the type that is not one of these is kept, but not compared.
+attribute_re = re.compile(r"\s*(NOT\s+NULL|NULL|AUTO_INCREMENT|PRIMARY\s+KEY|UNIQUE(\s+KEY)?|DEFAULT\s+('(?:[^']|'')*'|\"[^\"]*\"|\S+))", re.I)
+
+def parse_definition(name, definition): # {{{
+	'''Parse a column definition from a setup_db() argument.
+	Returns a 2-tuple of the Column and the definition without key attributes (for use in ALTER TABLE).'''
+	m = re.match(r'^\s*(\w+(\s*\([^)]*\))?(\s+(unsigned|signed|zerofill))*)', definition, re.I)
+	type = m.group(1)
+	rest = definition[m.end():]
+	column = {'nullable': True, 'default': None, 'auto_increment': False, 'primary': False, 'unique': False}
+	plain = [type]
+	while True:
+		a = attribute_re.match(rest)
+		if a is None:
+			break
+		rest = rest[a.end():]
+		word = ' '.join(a.group(1).upper().split())
+		if word == 'NOT NULL':
+			column['nullable'] = False
+		elif word == 'NULL':
+			column['nullable'] = True
+		elif word == 'AUTO_INCREMENT':
+			column['auto_increment'] = True
+		elif word == 'PRIMARY KEY':
+			column['primary'] = True
+			continue
+		elif word.startswith('UNIQUE'):
+			column['unique'] = True
+			continue
+		else:
+			column['default'] = a.group(3)
+		plain.append(a.group(1))
+	if rest.strip() != '':
+		plain.append(rest.strip())
+	if column['primary'] and column['nullable']:
+		# Primary keys are always NOT NULL; keep that when the key is removed from the definition.
+		column['nullable'] = False
+		plain.insert(1, 'NOT NULL')
+	return Column(name, type, **column), ' '.join(plain)
+# }}}
+
+def read_tables(rows, prefix): # {{{
+	'''Convert the result of db.bg_describe_owner() into a dict of table name (without prefix) to dict of column name to Column.
+	Column order is preserved.'''
+	ret = {}
+	for table, name, type, nullable, default, extra, key, index in rows:
+		columns = ret.setdefault(table[len(prefix):], {})
+		if name not in columns:
+			columns[name] = Column(name, type, nullable == 'YES', default, 'auto_increment' in extra.lower(), key == 'PRI', False)
+		if index is not None:
+			columns[name].unique = index
+	return ret
+# }}}
+
+def quote_default(default): # {{{
+	'Return a normalized default (see normalize_default()) as it must be written in a column definition.'
+	if default == 'current_timestamp':
+		return 'CURRENT_TIMESTAMP'
+	return "'%s'" % default.replace("'", "''")
+# }}}
+
+def create_body(columns): # {{{
+	'''Return the body of a CREATE TABLE statement for a table that was read with read_tables().
+	Only the keys that read_tables() reports are included: the primary key, and unique keys on single columns.'''
+	body = []
+	primary = [name for name, column in columns.items() if column.primary]
+	for name, column in columns.items():
+		parts = [name, column.type]
+		if not column.nullable:
+			parts.append('NOT NULL')
+		if column.default is not None:
+			parts.append('DEFAULT ' + quote_default(column.default))
+		if column.auto_increment:
+			parts.append('AUTO_INCREMENT')
+		if column.unique:
+			parts.append('UNIQUE')
+		body.append(' '.join(parts))
+	if len(primary) > 0:
+		body.append('PRIMARY KEY (%s)' % ', '.join(primary))
+	for name, column in columns.items():
+		if column.auto_increment and primary[:1] != [name]:
+			# InnoDB requires an auto increment column to be the first column of an index.
+			body.append('KEY (%s)' % name)
+	return ', '.join(body)
+# }}}
+
+def diff_table(table, current, desired, remove, add): # {{{
+	'''Compute the ALTER TABLE clauses to change a table.
+	current is a dict of column name to Column, desired is the list of (name, definition) pairs.
+	Returns the list of clauses (which may be empty) and a list of warnings about changes that were not allowed.'''
+	wanted = {}
+	plain = {}
+	for name, definition in desired:
+		wanted[name], plain[name] = parse_definition(name, definition)
+	drop_index = []
+	drop_columns = []
+	changes = []
+	add_keys = []
+	warnings = []
+	# Columns that are no longer defined.
+	for name in current:
+		if name in wanted:
+			continue
+		if remove:
+			drop_columns.append('DROP COLUMN %s' % name)
+		else:
+			warnings.append('obsolete column %s in table %s' % (name, table))
+	kept = [name for name in current if name in wanted or not remove]
+	# New and changed columns.
+	for name, definition in desired:
+		if name not in current:
+			if add:
+				changes.append('ADD COLUMN %s %s' % (name, plain[name]))
+			else:
+				warnings.append('extra column %s defined in table %s' % (name, table))
+		elif not wanted[name].same_definition(current[name]):
+			if add:
+				changes.append('MODIFY COLUMN %s %s' % (name, plain[name]))
+			else:
+				warnings.append('column %s in table %s does not match its definition' % (name, table))
+	if add:
+		# Primary key.
+		current_pk = [name for name in current if current[name].primary]
+		wanted_pk = [name for name, d in desired if wanted[name].primary]
+		if set(current_pk) != set(wanted_pk):
+			if any(name in kept for name in current_pk):
+				drop_index.append('DROP PRIMARY KEY')
+			if len(wanted_pk) > 0:
+				add_keys.append('ADD PRIMARY KEY (%s)' % ', '.join(wanted_pk))
+		# Unique keys on single columns.
+		for name, d in desired:
+			if wanted[name].unique and (name not in current or not current[name].unique):
+				add_keys.append('ADD UNIQUE (%s)' % name)
+		for name in kept:
+			if name in wanted and current[name].unique and not wanted[name].unique:
+				drop_index.append('DROP INDEX %s' % current[name].unique)
+	return drop_index + drop_columns + changes + add_keys, warnings
+# }}}
+
+def fingerprint(data, remove, add): # {{{
+	'''Return a hash of a definition and the options that it is applied with.
+	If it is equal to the stored fingerprint of an owner, the tables already match and setup_db() has nothing to do.'''
+	return hashlib.sha256(json.dumps([data, bool(remove), bool(add)], sort_keys = True, separators = (',', ':')).encode('utf-8')).hexdigest()
+# }}}
+
+# Shared storage. {{{
+# In shared storage mode, the managed players of a game do not have their own
+# tables. Instead, each logical table is one physical table for all of them,
+# with an extra owner column that holds the id of the managed player.
+owner_column = '_owner'
+
+def shared_definition(columns): # {{{
+	'''Convert a table definition into the definition of the shared table, for use with plan().
+	The owner column is added, and is part of the primary key (if the table has one).
+	Unique keys must include the owner column, so they are not part of the
+	result; this means that plan() does not add or remove them on shared tables.'''
+	ret = []
+	has_primary = False
+	for name, definition in columns:
+		column, plain = parse_definition(name, definition)
+		if column.primary:
+			has_primary = True
+			plain += ' PRIMARY KEY'
+		ret.append((name, plain))
+	return [(owner_column, 'INT NOT NULL' + (' PRIMARY KEY' if has_primary else ''))] + ret
+# }}}
+
+def shared_create(columns): # {{{
+	'Return the column and key definitions for CREATE TABLE of a shared table, from a table definition.'
+	parts = [owner_column + ' INT NOT NULL']
+	primary = [owner_column]
+	keys = []
+	for name, definition in columns:
+		column, plain = parse_definition(name, definition)
+		parts.append('%s %s' % (name, plain))
+		if column.primary:
+			primary.append(name)
+		if column.unique:
+			keys.append('UNIQUE (%s, %s)' % (owner_column, name))
+		if column.auto_increment:
+			# InnoDB requires an auto increment column to be the first column of an index.
+			keys.append('KEY (%s)' % name)
+	if len(primary) > 1:
+		parts.append('PRIMARY KEY (%s)' % ', '.join(primary))
+	else:
+		parts.append('KEY (%s)' % owner_column)
+	return ', '.join(parts + keys)
+# }}}
+
+def restrict_shared(steps): # {{{
+	'''Change a plan for shared tables so that it removes nothing that other managed players of the game may use.
+	Dropping a table becomes a 'delete' step, which deletes the records of
+	one player. Columns are not dropped. Returns the new plan and a list of
+	warnings for the changes that were left out.'''
+	ret = []
+	warnings = []
+	for step in steps:
+		if step['action'] == 'drop':
+			ret.append({'table': step['table'], 'action': 'delete', 'changes': []})
+			continue
+		if step['action'] == 'alter':
+			changes = [c for c in step['changes'] if not c.startswith('DROP COLUMN ')]
+			for c in step['changes']:
+				if c.startswith('DROP COLUMN '):
+					warnings.append('not dropping column %s of shared table %s' % (c[len('DROP COLUMN '):], step['table']))
+			if len(changes) == 0:
+				continue
+			step = dict(step, changes = changes)
+		ret.append(step)
+	return ret, warnings
+# }}}
+# }}}
+
+def plan(tables, data, remove = True, add = True, replace = False): # {{{
+	'''Compute the plan to change the tables into the definition in data.
+	tables is a dict of table name to dict of column name to Column, describing the current state.
+	Returns a 2-tuple of the plan and a list of warnings.'''
+	steps = []
+	warnings = []
+	if remove or replace:
+		for t in tables:
+			if replace or t not in data:
+				steps.append({'table': t, 'action': 'drop', 'changes': []})
+	for t in data:
+		if replace or t not in tables:
+			if replace or add:
+				steps.append({'table': t, 'action': 'create', 'changes': ['%s %s' % tuple(c) for c in data[t]]})
+			continue
+		changes, w = diff_table(t, tables[t], data[t], remove, add)
+		warnings.extend(w)
+		if len(changes) > 0:
+			steps.append({'table': t, 'action': 'alter', 'changes': changes})
+	return steps, warnings
+# }}}
+
+# vim: set foldmethod=marker :
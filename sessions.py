@@ -0,0 +1,517 @@
+# Session state for userdata: the dcids that players use to log in.
+# With one server process, the state is kept in that process. With several
+# worker processes (see start()), it is kept by the parent process, which
+# serves it to the workers over Unix sockets.
+
+# Imports {{{
+import sys
+import os
+import json
+import time
+import heapq
+import collections
+import signal
+import traceback
+import socket
+import secrets
+import selectors
+import threading
+import websocketd
+import fhs
+# }}}
+
+fhs.module_info('sessions', 'session state', '0.1', 'Bas Wijnen <wijnen@debian.org>')
+fhs.module_option('sessions', 'dcid-ttl', 'number of seconds after which a dcid expires if no player logged in with it; 0 to keep it until the game disconnects', default = 3600, argtype = float)
+
+'''Records: {{{
+For every dcid, the store keeps a record, which is a dict with:
+	- 'state': 'pending' until the player logged in, then 'active'.
+	- 'worker': index of the worker process that has the game connection.
+	- 'connection': id of the game connection in that worker.
+	- 'channel': channel of the game on that connection.
+	- 'gcid': id of the player, as given by the game; None for external players.
+	- 'name': name of the managed player, or None before login and for external players.
+	- 'game': id of the game, or None for external players.
+	- 'user': id of the user that owns the game or the player.
+	- 'url': url of the game for external players, or None.
+	- 'allow-new-players': whether players may register through the dcid.
+	- 'expires': for pending dcids, the time (of the store process) when they expire.
+Records are copied when they are read, so changing them has no effect on the
+store.
+
+Messages are sent between workers through the store, for example to tell the
+worker that has a game connection that a player has logged in. They are
+dicts with a 'type' key; the server passes them to handler().
+}}}'''
+
+# The store that is used by this process; set by start().
+store = None
+# Index of this worker process; 0 if there is only one process.
+worker = 0
+# Function that handles messages for this process; set by the server.
+handler = None
+# Time to live of pending dcids.
+ttl = 3600
+
+@fhs.atinit
+def init(): # {{{
+	global ttl
+	ttl = fhs.module_get_config('sessions')['dcid-ttl']
+	assert ttl >= 0
+# }}}
+
+class Requests: # {{{
+	'''Generator versions of the store operations whose result is used, so the server works with Store and Client.
+	They must be called with yield from, like the bg_* functions in db.py.'''
+	def bg_create(self, wake, record): # {{{
+		return (yield from self.bg_call(wake, 'create', record))
+	# }}}
+	def bg_get(self, wake, dcid): # {{{
+		return (yield from self.bg_call(wake, 'get', dcid))
+	# }}}
+	def bg_activate(self, wake, dcid, name): # {{{
+		return (yield from self.bg_call(wake, 'activate', dcid, name))
+	# }}}
+	def bg_drop(self, wake, dcid, state = None): # {{{
+		return (yield from self.bg_call(wake, 'drop', dcid, state))
+	# }}}
+# }}}
+
+class Store(Requests): # {{{
+	'''Session registry. This is used directly by a single server process, and by the parent process in worker mode.
+	deliver(worker, message) passes a message to a worker, or to all workers if worker is None.
+	Records are indexed by connection (worker, connection id) and by channel
+	(worker, connection id, channel), so all dcids of a connection or channel
+	are revoked without looking at other records, and by gcid, so a game
+	gets the same dcid when it asks twice.
+	Pending dcids expire ttl seconds after they were last requested. They
+	are kept in a heap by expiry time, which is checked on every create().'''
+	def __init__(self, deliver, ttl = 0): # {{{
+		self.records = {}
+		self.deliver = deliver
+		self.ttl = ttl
+		self.connections = {}	# (worker, connection) -> set of dcids
+		self.channels = {}	# (worker, connection, channel) -> set of dcids
+		self.gcids = {}	# (worker, connection, channel, gcid) -> dcid, for managed players
+		self.counts = {'pending': 0, 'active': 0}
+		# (expiry time, dcid) of pending dcids; entries for dcids that were removed or requested again are skipped when they are popped.
+		self.expiry = []
+	# }}}
+	def add_index(self, dcid, record): # {{{
+		connection = (record['worker'], record['connection'])
+		self.connections.setdefault(connection, set()).add(dcid)
+		self.channels.setdefault(connection + (record['channel'],), set()).add(dcid)
+		if record['gcid'] is not None:
+			self.gcids[connection + (record['channel'], record['gcid'])] = dcid
+		self.counts[record['state']] += 1
+	# }}}
+	def remove(self, dcid): # {{{
+		'Remove a record and its index entries, and return it.'
+		record = self.records.pop(dcid)
+		connection = (record['worker'], record['connection'])
+		channel = connection + (record['channel'],)
+		for index, key in ((self.connections, connection), (self.channels, channel)):
+			dcids = index[key]
+			dcids.discard(dcid)
+			if len(dcids) == 0:
+				del index[key]
+		if record['gcid'] is not None:
+			self.gcids.pop(channel + (record['gcid'],), None)
+		self.counts[record['state']] -= 1
+		return record
+	# }}}
+	def refresh(self, dcid, record): # {{{
+		'Restart the time to live of a pending dcid.'
+		if self.ttl <= 0:
+			return
+		record['expires'] = time.monotonic() + self.ttl
+		heapq.heappush(self.expiry, (record['expires'], dcid))
+		if len(self.expiry) > 2 * self.counts['pending'] + 64:
+			# Most entries are outdated; rebuild the heap, so its size stays proportional to the number of pending dcids.
+			self.expiry = [(r['expires'], d) for d, r in self.records.items() if r['state'] == 'pending']
+			heapq.heapify(self.expiry)
+	# }}}
+	def expired(self, record): # {{{
+		return record['state'] == 'pending' and record.get('expires') is not None and record['expires'] <= time.monotonic()
+	# }}}
+	def expire(self): # {{{
+		'Remove pending dcids whose time to live has passed; return the number of removed dcids.'
+		now = time.monotonic()
+		count = 0
+		while len(self.expiry) > 0 and self.expiry[0][0] <= now:
+			expires, dcid = heapq.heappop(self.expiry)
+			record = self.records.get(dcid)
+			if record is not None and record['state'] == 'pending' and record['expires'] == expires:
+				self.remove(dcid)
+				count += 1
+		return count
+	# }}}
+	def lookup(self, dcid): # {{{
+		'Return the record of a dcid, or None; an expired dcid is removed.'
+		record = self.records.get(dcid)
+		if record is not None and self.expired(record):
+			self.remove(dcid)
+			return None
+		return record
+	# }}}
+	def create(self, record): # {{{
+		'''Store a new record and return its dcid, which is a cryptographically hard to guess token.
+		For a managed player that already has a pending dcid on the same
+		channel, that dcid is returned and its time to live is restarted. If
+		the player is already logged in, None is returned.'''
+		self.expire()
+		if record['gcid'] is not None:
+			dcid = self.gcids.get((record['worker'], record['connection'], record['channel'], record['gcid']))
+			if dcid is not None:
+				if self.records[dcid]['state'] != 'pending':
+					return None
+				self.refresh(dcid, self.records[dcid])
+				return dcid
+		dcid = secrets.token_urlsafe()
+		while dcid in self.records:
+			dcid = secrets.token_urlsafe()
+		record = dict(record)
+		self.records[dcid] = record
+		self.add_index(dcid, record)
+		if record['state'] == 'pending':
+			self.refresh(dcid, record)
+		return dcid
+	# }}}
+	def get(self, dcid): # {{{
+		'Return the record of a dcid, or None.'
+		record = self.lookup(dcid)
+		return None if record is None else dict(record)
+	# }}}
+	def activate(self, dcid, name): # {{{
+		'''Mark a pending dcid as logged in by managed player name. Active dcids do not expire.
+		Return the record, or None if the dcid is not pending (for example because it was revoked).'''
+		record = self.lookup(dcid)
+		if record is None or record['state'] != 'pending':
+			return None
+		self.counts['pending'] -= 1
+		self.counts['active'] += 1
+		record['state'] = 'active'
+		record['name'] = name
+		record.pop('expires', None)
+		return dict(record)
+	# }}}
+	def drop(self, dcid, state = None): # {{{
+		'Remove a dcid and return its record; if state is not None, only if the dcid is in that state. Return None if nothing was removed.'
+		record = self.lookup(dcid)
+		if record is None or (state is not None and record['state'] != state):
+			return None
+		return self.remove(dcid)
+	# }}}
+	def drop_connection(self, index, connection): # {{{
+		'Remove all dcids of a connection of worker index; return the number of removed dcids.'
+		dcids = list(self.connections.get((index, connection), ()))
+		for dcid in dcids:
+			self.remove(dcid)
+		return len(dcids)
+	# }}}
+	def drop_channel(self, index, connection, channel): # {{{
+		'Remove all dcids of a channel of a connection of worker index; return the number of removed dcids.'
+		dcids = list(self.channels.get((index, connection, channel), ()))
+		for dcid in dcids:
+			self.remove(dcid)
+		return len(dcids)
+	# }}}
+	def drop_worker(self, index): # {{{
+		'Remove all records of a worker that has exited; return the number of removed records.'
+		return sum(self.drop_connection(*key) for key in [key for key in self.connections if key[0] == index])
+	# }}}
+	def count(self, state): # {{{
+		'Return the number of dcids in a state. Expired dcids that have not been removed yet are included.'
+		return self.counts[state]
+	# }}}
+	def notify(self, index, message): # {{{
+		'Send a message to a worker.'
+		self.deliver(index, message)
+	# }}}
+	def broadcast(self, message): # {{{
+		'Send a message to all workers, including the sender.'
+		self.deliver(None, message)
+	# }}}
+	def bg_call(self, wake, op, *args): # {{{
+		'Run an operation for Requests; the store is in this process, so this does not wait.'
+		yield from ()
+		return getattr(self, op)(*args)
+	# }}}
+# }}}
+
+# Operations that workers can request from the store process.
+operations = ('create', 'get', 'activate', 'drop', 'drop_connection', 'drop_channel', 'count', 'notify', 'broadcast')
+
+class Client(Requests): # {{{
+	'''Store interface for a worker process; every call is a request to the store process.
+	Requests are answered in order. The bg_* calls wait for their reply in
+	the main loop; drop_connection(), drop_channel(), notify() and
+	broadcast() do not wait for a reply. The metrics thread uses count(),
+	which has its own socket and blocks that thread until the reply arrives.
+	The store process never waits for a worker (see serve()), so sending a
+	request only waits for the store to read it.'''
+	def __init__(self, requests, events, queries): # {{{
+		self.requests = requests
+		self.replies = b''
+		# Wakes of the requests that were sent and not answered yet, in order; None if nobody waits for the reply.
+		self.waiting = collections.deque()
+		self.queries = queries
+		self.reader = queries.makefile('r', encoding = 'utf-8')
+		self.lock = threading.Lock()
+		self.events = events
+		self.buffer = b''
+		events.setblocking(False)
+		websocketd.add_read(events.fileno(), self.receive)
+		websocketd.add_read(requests.fileno(), self.receive_replies)
+	# }}}
+	def send(self, wake, op, *args): # {{{
+		self.requests.sendall(json.dumps({'op': op, 'args': args}).encode('utf-8') + b'\n')
+		self.waiting.append(wake)
+	# }}}
+	def bg_call(self, wake, op, *args): # {{{
+		self.send(wake, op, *args)
+		reply = (yield)
+		if 'error' in reply:
+			raise ValueError('session store: %s' % reply['error'])
+		return reply['result']
+	# }}}
+	def drop_connection(self, index, connection): # {{{
+		self.send(None, 'drop_connection', index, connection)
+	# }}}
+	def drop_channel(self, index, connection, channel): # {{{
+		self.send(None, 'drop_channel', index, connection, channel)
+	# }}}
+	def count(self, state): # {{{
+		with self.lock:
+			self.queries.sendall(json.dumps({'op': 'count', 'args': (state,)}).encode('utf-8') + b'\n')
+			line = self.reader.readline()
+		if line == '':
+			raise ConnectionError('session store is gone')
+		reply = json.loads(line)
+		if 'error' in reply:
+			raise ValueError('session store: %s' % reply['error'])
+		return reply['result']
+	# }}}
+	def notify(self, index, message): # {{{
+		if index == worker:
+			# No need to go through the store process.
+			handler(message)
+			return
+		self.send(None, 'notify', index, message)
+	# }}}
+	def broadcast(self, message): # {{{
+		self.send(None, 'broadcast', message)
+	# }}}
+	def receive_replies(self): # {{{
+		'Pass replies from the store to the calls that wait for them. This is called from the main loop.'
+		try:
+			data = self.requests.recv(65536, socket.MSG_DONTWAIT)
+		except BlockingIOError:
+			return True
+		if data == b'':
+			print('session store is gone; stopping worker %d' % worker, file = sys.stderr)
+			sys.exit(1)
+		lines = (self.replies + data).split(b'\n')
+		self.replies = lines.pop()
+		for line in lines:
+			wake = self.waiting.popleft()
+			reply = json.loads(line)
+			if wake is None:
+				# Nobody is waiting for this reply.
+				if 'error' in reply:
+					print('Error in session store request: %s' % reply['error'], file = sys.stderr)
+				continue
+			try:
+				wake(reply)
+			except:
+				print('Error in request after session store reply', file = sys.stderr)
+				traceback.print_exc()
+		return True
+	# }}}
+	def receive(self): # {{{
+		'Handle messages from other workers. This is called from the main loop.'
+		try:
+			data = self.events.recv(65536)
+		except BlockingIOError:
+			return True
+		if data == b'':
+			print('session store is gone; stopping worker %d' % worker, file = sys.stderr)
+			sys.exit(1)
+		lines = (self.buffer + data).split(b'\n')
+		self.buffer = lines.pop()
+		for line in lines:
+			try:
+				handler(json.loads(line))
+			except Exception as e:
+				print('error handling message %s: %s' % (line, e), file = sys.stderr)
+		return True
+	# }}}
+# }}}
+
+def local(): # {{{
+	'Use a store in this process; this is used when there is only one server process.'
+	global store
+	store = Store(lambda index, message: handler(message), ttl)
+# }}}
+
+# Worker processes. {{{
+def listening_sockets(port): # {{{
+	'Return the file descriptors of this process that are sockets listening on port. This only works on Linux.'
+	ret = []
+	for name in os.listdir('/proc/self/fd'):
+		fd = int(name)
+		try:
+			s = socket.socket(fileno = os.dup(fd))
+		except OSError:
+			continue
+		with s:
+			try:
+				if s.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN) and s.getsockname()[1] == port:
+					ret.append(fd)
+			except (OSError, IndexError, TypeError):
+				pass
+	return ret
+# }}}
+
+def start(count, port): # {{{
+	'''Fork count worker processes, which share the listening socket(s) of port.
+	Each worker returns from this function, with store and worker set. The
+	parent process runs the store until all workers have exited, and then
+	exits. The listening sockets are made non-blocking, so a worker that
+	loses the race for a new connection gets BlockingIOError from the main
+	loop, which it must ignore.'''
+	global store, worker
+	fds = listening_sockets(port)
+	if len(fds) == 0:
+		sys.exit('no listening socket found for port %d; worker mode needs Linux' % port)
+	for fd in fds:
+		os.set_blocking(fd, False)
+	children = {}
+	for index in range(count):
+		requests = socket.socketpair()
+		events = socket.socketpair()
+		queries = socket.socketpair()
+		sys.stdout.flush()
+		sys.stderr.flush()
+		pid = os.fork()
+		if pid == 0:
+			# Worker.
+			for sockets in children.values():
+				for s in sockets:
+					s.close()
+			for pair in (requests, events, queries):
+				pair[0].close()
+			worker = index
+			store = Client(requests[1], events[1], queries[1])
+			return index
+		for pair in (requests, events, queries):
+			pair[1].close()
+		children[pid] = (requests[0], events[0], queries[0])
+	serve(children)
+	sys.exit(0)
+# }}}
+
+def serve(children): # {{{
+	'''Run the store for the workers; children is a dict of pid to (request socket, event socket, query socket).
+	Requests on the request and query sockets are answered on the socket they came from.
+	Returns when all workers have exited. SIGTERM and SIGHUP are passed on to the workers.
+	Replies and messages for the workers are buffered and written when the
+	socket accepts them, so a worker that does not read them (for example
+	because it is busy) cannot block the store.'''
+	pids = list(children)
+	def forward(signum, frame):
+		for pid in children:
+			try:
+				os.kill(pid, signum)
+			except ProcessLookupError:
+				pass
+	signal.signal(signal.SIGTERM, forward)
+	signal.signal(signal.SIGHUP, forward)
+	# Ctrl-C is sent to the workers by the terminal; they exit, and so does this process.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	selector = selectors.DefaultSelector()
+	buffers = {}	# request or query socket -> incomplete line that was received on it
+	outgoing = {}	# socket -> data that is waiting to be written to it
+	masks = {}	# socket -> events for which it is registered
+	def watch(s, pid):
+		'Register a socket for the events it needs: reading requests, and writing if data is waiting.'
+		mask = (selectors.EVENT_WRITE if len(outgoing[s]) > 0 else 0) | (selectors.EVENT_READ if s in buffers else 0)
+		if mask == masks[s]:
+			return
+		if masks[s] == 0:
+			selector.register(s, mask, pid)
+		elif mask == 0:
+			selector.unregister(s)
+		else:
+			selector.modify(s, mask, pid)
+		masks[s] = mask
+	def flush(s, pid):
+		try:
+			sent = s.send(outgoing[s])
+		except BlockingIOError:
+			sent = 0
+		except OSError:
+			# The worker is gone; its request socket reports that.
+			sent = len(outgoing[s])
+		outgoing[s] = outgoing[s][sent:]
+		watch(s, pid)
+	def deliver(index, message):
+		data = json.dumps(message).encode('utf-8') + b'\n'
+		for pid in children:
+			if index is None or pids.index(pid) == index:
+				events = children[pid][1]
+				outgoing[events] += data
+				flush(events, pid)
+	records = Store(deliver, ttl)
+	for pid, sockets in children.items():
+		for s in sockets:
+			s.setblocking(False)
+			outgoing[s] = b''
+			masks[s] = 0
+		requests, events, queries = sockets
+		for s in (requests, queries):
+			buffers[s] = b''
+			watch(s, pid)
+	while len(children) > 0:
+		for key, mask in selector.select():
+			pid = key.data
+			if pid not in children:
+				# The worker exited while handling an earlier event.
+				continue
+			s = key.fileobj
+			if mask & selectors.EVENT_WRITE:
+				flush(s, pid)
+			if not mask & selectors.EVENT_READ:
+				continue
+			try:
+				data = s.recv(65536)
+			except BlockingIOError:
+				continue
+			except OSError:
+				data = b''
+			if data == b'':
+				# The worker has exited.
+				for s in children.pop(pid):
+					if masks.pop(s) != 0:
+						selector.unregister(s)
+					buffers.pop(s, None)
+					outgoing.pop(s)
+					s.close()
+				os.waitpid(pid, 0)
+				print('worker %d has exited; dropped %d sessions' % (pids.index(pid), records.drop_worker(pids.index(pid))), file = sys.stderr)
+				continue
+			lines = (buffers[s] + data).split(b'\n')
+			buffers[s] = lines.pop()
+			for line in lines:
+				try:
+					request = json.loads(line)
+					assert request['op'] in operations
+					reply = {'result': getattr(records, request['op'])(*request['args'])}
+				except Exception as e:
+					reply = {'error': str(e)}
+				outgoing[s] += json.dumps(reply).encode('utf-8') + b'\n'
+			flush(s, pid)
+# }}}
+# }}}
+
+# vim: set foldmethod=marker :
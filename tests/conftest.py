@@ -0,0 +1,7 @@
+# The modules of userdata are not a package; make them importable from the tests.
+# The module that games use is in module/userdata.
+import os
+import sys
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'module'))
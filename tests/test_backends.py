@@ -0,0 +1,73 @@
+# Tests for the SQLite translation of the MySQL statements that userdata uses; see backends.py.
+import pytest
+import backends
+
+@pytest.fixture
+def cursor(tmp_path): # {{{
+	connection = backends.SQLite({'file': str(tmp_path / 'test.sqlite')}).connect()
+	yield connection.cursor()
+	connection.close()
+# }}}
+
+def test_translate(): # {{{
+	assert backends.translate('INSERT IGNORE INTO t (a) VALUES (%s)') == 'INSERT OR IGNORE INTO t (a) VALUES (?)'
+	assert backends.translate("SELECT a FROM t WHERE b LIKE '10%%' LIMIT 18446744073709551615 OFFSET %s") == "SELECT a FROM t WHERE b LIKE '10%' LIMIT -1 OFFSET ?"
+# }}}
+
+def test_split_definitions(): # {{{
+	assert backends.split_definitions("a DECIMAL(5, 2), b VARCHAR(10) DEFAULT 'x,y', PRIMARY KEY (a, b)") == ['a DECIMAL(5, 2)', "b VARCHAR(10) DEFAULT 'x,y'", 'PRIMARY KEY (a, b)']
+# }}}
+
+def test_create_statements(): # {{{
+	assert backends.create_statements('t', 'id INT PRIMARY KEY AUTO_INCREMENT, name VARCHAR(10) NOT NULL UNIQUE', False) == ['CREATE TABLE t (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(10) NOT NULL UNIQUE)']
+	statements = backends.create_statements('t', 'o INT NOT NULL, n INT NOT NULL AUTO_INCREMENT, PRIMARY KEY (o, n), KEY (n)', True)
+	assert statements[0] == 'CREATE TABLE IF NOT EXISTS t (o INT NOT NULL, n INT, PRIMARY KEY (o, n))'
+	assert statements[1] == 'CREATE INDEX IF NOT EXISTS t_n ON t (n)'
+	assert statements[2].startswith('CREATE TRIGGER IF NOT EXISTS t_n_ai AFTER INSERT ON t ')
+# }}}
+
+def test_describe(cursor): # {{{
+	cursor.execute("CREATE TABLE t (id INT PRIMARY KEY AUTO_INCREMENT, name VARCHAR(10) NOT NULL DEFAULT 'x' UNIQUE, n INT)")
+	cursor.execute('DESCRIBE t')
+	assert cursor.fetchall() == (('id', 'INTEGER', 'NO', 'PRI', None, 'auto_increment'), ('name', 'VARCHAR(10)', 'NO', 'UNI', "'x'", ''), ('n', 'INT', 'YES', '', None, ''))
+	cursor.execute('SHOW TABLES LIKE %s', ('t%',))
+	assert cursor.fetchall() == (('t',),)
+# }}}
+
+def test_auto_increment_trigger(cursor): # {{{
+	cursor.execute('CREATE TABLE t (o INT NOT NULL, n INT NOT NULL AUTO_INCREMENT, PRIMARY KEY (o, n), KEY (n))')
+	cursor.execute('INSERT INTO t (o) VALUES (%s)', (5,))
+	cursor.execute('INSERT INTO t (o) VALUES (%s)', (5,))
+	cursor.execute('SELECT o, n FROM t ORDER BY n')
+	assert cursor.fetchall() == ((5, 1), (5, 2))
+# }}}
+
+def test_alter_table(cursor): # {{{
+	cursor.execute('CREATE TABLE t (id INT PRIMARY KEY, a INT, b INT UNIQUE)')
+	cursor.execute('INSERT INTO t (id, a, b) VALUES (%s, %s, %s)', (1, 2, 3))
+	index = [row for row in backends.table_columns(cursor.cursor, 't') if row[0] == 'b'][0][6]
+	cursor.execute("ALTER TABLE t DROP INDEX %s, DROP COLUMN a, MODIFY COLUMN b BIGINT NOT NULL, ADD COLUMN c VARCHAR(5) DEFAULT 'x' UNIQUE" % index)
+	cursor.execute('DESCRIBE t')
+	assert cursor.fetchall() == (('id', 'INT', 'NO', 'PRI', None, ''), ('b', 'BIGINT', 'NO', '', None, ''), ('c', 'VARCHAR(5)', 'YES', 'UNI', "'x'", ''))
+	cursor.execute('SELECT * FROM t')
+	assert cursor.fetchall() == ((1, 3, 'x'),)
+# }}}
+
+def test_alter_table_unsupported(cursor): # {{{
+	cursor.execute('CREATE TABLE t (id INT PRIMARY KEY)')
+	with pytest.raises(ValueError):
+		cursor.execute('ALTER TABLE t RENAME TO u')
+	cursor.execute('SHOW TABLES')
+	assert cursor.fetchall() == (('t',),)
+# }}}
+
+def test_union(cursor): # {{{
+	backend = backends.SQLite({'file': ':memory:'})
+	for t in ('a', 'b'):
+		cursor.execute('CREATE TABLE %s (n INT)' % t)
+		cursor.execute('INSERT INTO %s (n) VALUES (1), (2)' % t)
+	cursor.execute(backend.union(['SELECT %s, n FROM a ORDER BY n DESC LIMIT 1', 'SELECT %s, n FROM b ORDER BY n LIMIT 1']), ('a', 'b'))
+	assert cursor.fetchall() == (('a', 2), ('b', 1))
+# }}}
+
+# vim: set foldmethod=marker :
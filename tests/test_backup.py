@@ -0,0 +1,53 @@
+# Tests for the value encoding and definition checks of restore; see backup.py.
+import json
+import decimal
+import pytest
+import backup
+
+body = "id int NOT NULL AUTO_INCREMENT, name varchar(20) NOT NULL DEFAULT 'x', data blob, PRIMARY KEY (id)"
+names = ['id', 'name', 'data']
+
+def test_encode_decode(): # {{{
+	values = [1, 'text', None, b'\x00\xffbytes', bytearray(b'ab')]
+	decoded = [backup.decode(x) for x in json.loads(backup.line(values))]
+	assert decoded == [1, 'text', None, b'\x00\xffbytes', b'ab']
+	assert backup.encode(b'a') == {'base64': 'YQ=='}
+	# Other values, such as dates and decimals, are stored as strings.
+	assert backup.encode(decimal.Decimal('1.50')) == '1.50'
+# }}}
+
+def test_parse_definition(): # {{{
+	assert backup.parse_definition(body, names) == body
+	assert backup.parse_definition('a int, b text', ['a', 'b']) == 'a int, b text'
+# }}}
+
+@pytest.mark.parametrize('definition', [
+		None,
+		5,
+		body + ', evil INT); DROP TABLE x; --',
+		body.replace('data blob', 'data blob COMMENT \'x\''),
+		body.replace('data blob', 'data blob; DROP'),
+		body.replace('data blob', 'data'),
+		# Only definitions as written by schema.create_body() are accepted.
+		body.replace('data blob', 'data BLOB'),
+		body.replace('data blob', 'data blob PRIMARY KEY'),
+		body.replace('data blob', 'data 5'),
+		body.replace('data blob', '`data` blob'),
+		body.replace('data blob', 'name blob'),
+		body.replace("DEFAULT 'x'", "DEFAULT 'x\\\\'"),
+		body.replace('PRIMARY KEY (id)', 'PRIMARY KEY (other)'),
+	])
+def test_parse_definition_rejected(definition): # {{{
+	with pytest.raises(ValueError):
+		backup.parse_definition(definition, names)
+# }}}
+
+def test_parse_definition_columns(): # {{{
+	# The columns must match the records in the backup, in order.
+	with pytest.raises(ValueError):
+		backup.parse_definition(body, ['id', 'data', 'name'])
+	with pytest.raises(ValueError):
+		backup.parse_definition(body, ['id', 'name'])
+# }}}
+
+# vim: set foldmethod=marker :
@@ -0,0 +1,91 @@
+# Tests for the database functions of db.py, on a temporary SQLite database.
+import pytest
+import backends
+import db
+
+@pytest.fixture
+def database(tmp_path, monkeypatch): # {{{
+	config = tmp_path / 'db.ini'
+	config.write_text('backend = sqlite\nfile = %s\n' % (tmp_path / 'userdata.sqlite'))
+	settings = {'config': str(config), 'userdefs': str(tmp_path / 'none'), 'tabledefs': str(tmp_path / 'none'), 'pool_size': 3, 'queue_depth': 100, 'reconnect_attempts': 1, 'max_streams': 1, 'max_transactions': 1, 'transaction_timeout': 60, 'stream_chunk': 10, 'hash_workers': 0, 'backend': None}
+	for name, value in settings.items():
+		monkeypatch.setattr(db, name, value, raising = False)
+	db.setup(create_globals = True)
+	db.rebuild_catalog()
+	yield db
+	db.disconnect()
+# }}}
+
+def test_write_many_ids(database): # {{{
+	db.write('CREATE TABLE g1_t (id INT PRIMARY KEY AUTO_INCREMENT, n INT)')
+	db.write('INSERT INTO g1_t (n) VALUES (%s)', 0)
+	db.write('DELETE FROM g1_t')
+	ids = db.run_sync(db.bg_write_many, 'INSERT INTO g1_t (n) VALUES (%s)', [(1,), (2,), (3,)])
+	assert ids == [2, 3, 4]
+	assert db.read('SELECT id, n FROM g1_t ORDER BY id') == ((2, 1), (3, 2), (4, 3))
+	assert db.run_sync(db.bg_write_many, 'INSERT INTO g1_t (n) VALUES (%s)', [(4,), (5,)], None, False) == 2
+	assert db.run_sync(db.bg_write_many, 'UPDATE g1_t SET n = %s WHERE id = %s', [(10, 2), (11, 3), (12, 99)]) == 2
+# }}}
+
+def test_write_many_rollback(database): # {{{
+	db.write('CREATE TABLE g1_t (id INT PRIMARY KEY, n INT)')
+	with pytest.raises(backends.sqlite3.IntegrityError):
+		db.run_sync(db.bg_write_many, 'INSERT INTO g1_t (id, n) VALUES (%s, %s)', [(1, 1), (1, 2)])
+	# The rows are written in one transaction, so nothing was inserted.
+	assert db.read('SELECT * FROM g1_t') == ()
+# }}}
+
+def test_mysql_insert_many(): # {{{
+	class Cursor:
+		'Cursor that hands out ids with gaps, as MySQL may do.'
+		def __init__(self):
+			self.lastrowid = 0
+			self.rows = []
+		def execute(self, cmd, row):
+			self.rows.append(row)
+			self.lastrowid += 5
+	c = Cursor()
+	mysql = backends.MySQL.__new__(backends.MySQL)
+	assert mysql.insert_many(None, c, 'INSERT INTO t (a) VALUES (%s)', [(1,), (2,)]) == [5, 10]
+	assert c.rows == [(1,), (2,)]
+# }}}
+
+def test_rebuild_catalog(database): # {{{
+	db.write('CREATE TABLE g1_board (a INT)')
+	db.write('CREATE TABLE g1_moves (a INT)')
+	db.write('CREATE TABLE p2f_state (a INT)')
+	db.write('CREATE TABLE unrelated (a INT)')
+	assert db.rebuild_catalog() == 3
+	assert sorted(db.list_owner_tables('g1_')) == ['board', 'moves']
+	assert db.list_owner_tables('p2f_') == ['state']
+	# Rebuilding replaces the old entries.
+	db.write('DROP TABLE g1_moves')
+	assert db.rebuild_catalog() == 2
+	assert db.list_owner_tables('g1_') == ['board']
+# }}}
+
+def test_catalog_add_remove(database): # {{{
+	db.run_sync(db.bg_catalog_add, 'g1_', 'board')
+	# Adding an existing entry is ignored.
+	db.run_sync(db.bg_catalog_add, 'g1_', 'board')
+	db.run_sync(db.bg_catalog_add, 'g1_', 'moves')
+	assert sorted(db.run_sync(db.bg_catalog_list, 'g1_')) == ['board', 'moves']
+	db.run_sync(db.bg_catalog_remove, 'g1_', 'board')
+	assert db.run_sync(db.bg_catalog_list, 'g1_') == ['moves']
+	assert db.run_sync(db.bg_catalog_list, 'g2_') == []
+# }}}
+
+def test_drop_owner_tables(database): # {{{
+	for table in ('g1_board', 'g1_moves', 'g2_board'):
+		db.write('CREATE TABLE %s (a INT)' % table)
+	db.rebuild_catalog()
+	db.run_sync(db.bg_drop_owner_tables, 'g1_')
+	assert db.list_owner_tables('g1_') == []
+	assert 'g1_board' not in db.read1('SHOW TABLES')
+	assert 'g2_board' in db.read1('SHOW TABLES')
+	db.drop_owner_tables('g2_')
+	assert db.list_owner_tables('g2_') == []
+	assert 'g2_board' not in db.read1('SHOW TABLES')
+# }}}
+
+# vim: set foldmethod=marker :
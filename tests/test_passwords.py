@@ -0,0 +1,46 @@
+# Tests for password hashing; see passwords.py.
+import pytest
+import passwords
+
+# A low cost keeps the tests fast.
+COST = 4
+
+def test_scrypt(): # {{{
+	stored = passwords.hash_password('secret', 'scrypt', COST)
+	assert stored.startswith('$scrypt$ln=4,r=8,p=1$')
+	assert passwords.identify(stored) == 'scrypt'
+	assert passwords.is_hash(stored)
+	assert not passwords.is_hash('secret')
+	assert passwords.verify_password('secret', stored, 'scrypt', COST) == (True, None)
+	assert passwords.verify_password('wrong', stored, 'scrypt', COST) == (False, None)
+	# Every hash has its own salt.
+	assert passwords.hash_password('secret', 'scrypt', COST) != stored
+# }}}
+
+def test_rehash_on_cost_change(): # {{{
+	stored = passwords.hash_password('secret', 'scrypt', COST)
+	ok, rehash = passwords.verify_password('secret', stored, 'scrypt', COST + 1)
+	assert ok
+	assert rehash.startswith('$scrypt$ln=5,')
+	assert passwords.verify_password('secret', rehash, 'scrypt', COST + 1) == (True, None)
+# }}}
+
+def test_refresh_hash(): # {{{
+	stored = passwords.hash_password('secret', 'scrypt', COST)
+	assert passwords.refresh_hash('secret', stored, 'scrypt', COST) == stored
+	changed = passwords.refresh_hash('other', stored, 'scrypt', COST)
+	assert changed != stored and passwords.verify_password('other', changed, 'scrypt', COST)[0]
+	assert passwords.verify_password('secret', passwords.refresh_hash('secret', None, 'scrypt', COST), 'scrypt', COST)[0]
+# }}}
+
+@pytest.mark.skipif(passwords.crypt is None, reason = 'crypt module is not available')
+def test_legacy_rehash(): # {{{
+	stored = passwords.crypt.crypt('secret')
+	assert passwords.identify(stored) == 'crypt'
+	assert passwords.verify_password('wrong', stored, 'scrypt', COST) == (False, None)
+	ok, rehash = passwords.verify_password('secret', stored, 'scrypt', COST)
+	assert ok
+	assert passwords.identify(rehash) == 'scrypt'
+# }}}
+
+# vim: set foldmethod=marker :
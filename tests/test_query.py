@@ -0,0 +1,144 @@
+# Tests for the query builder; see query.py.
+import pytest
+import backends
+import query
+
+def sql(kind, table, *a, **ka): # {{{
+	'Return the full query for table (without prefix) and its values.'
+	(head, tail), values = query.build(kind, table, *a, **ka)
+	return head + table + tail, values
+# }}}
+
+def test_condition_shape(): # {{{
+	values = []
+	shape = query.condition_shape(('and', ('=', 'a', 1), ('or', ('in', 'b', [2, 3]), ('not', ('between', 'c', 4, 5))), ('<>', 'd', None)), values)
+	assert shape == ('AND', ('=', 'a', 1), ('OR', ('IN', 'b', 2), ('NOT', ('BETWEEN', 'c', 2))), ('<>', 'd', None))
+	assert values == [1, 2, 3, 4, 5]
+	assert query.condition_shape((), values) == ()
+# }}}
+
+@pytest.mark.parametrize('condition', [
+	'a = 1',
+	(1, 'a', 2),
+	('and', ('=', 'a', 1)),
+	('not', ('=', 'a', 1), ('=', 'b', 2)),
+	('drop', 'a', 1),
+	('=', 1, 1),
+	('=', 'a'),
+	('in', 'a', 1),
+	('between', 'a', 1),
+])
+def test_condition_shape_rejects(condition): # {{{
+	with pytest.raises(ValueError):
+		query.condition_shape(condition, [])
+# }}}
+
+def test_build_select(): # {{{
+	assert sql('select', 't', ('a', 'b'), ('=', 'a', 1)) == ('SELECT a, b FROM t WHERE a = %s', [1])
+	assert sql('select', 't', 'a', ('=', 'a', None)) == ('SELECT a FROM t WHERE a IS NULL', [])
+	assert sql('select', 't', ('a', ('count', '*')), group = 'a', order = (('a', 'desc'),), limit = 10, offset = 20) == ('SELECT a, COUNT(*) FROM t GROUP BY a ORDER BY a DESC LIMIT %s OFFSET %s', [10, 20])
+	assert sql('select', 't', 'a', offset = 5) == ('SELECT a FROM t LIMIT 18446744073709551615 OFFSET %s', [5])
+	assert sql('select', 't', 'a', ('in', 'a', [])) == ('SELECT a FROM t WHERE (1 = 0)', [])
+# }}}
+
+def test_build_nested_condition(): # {{{
+	assert sql('select', 't', 'a', ('or', ('not', ('in', 'a', [1, 2])), ('and', ('between', 'b', 3, 4), ('>=', 'c', 5)))) == ('SELECT a FROM t WHERE (NOT (a IN (%s, %s)) OR (b BETWEEN %s AND %s AND c >= %s))', [1, 2, 3, 4, 5])
+# }}}
+
+def test_order_shape(): # {{{
+	assert query.order_shape('a') == (('a', 'ASC'),)
+	assert query.order_shape(('a', ('b', 'desc'), (('max', 'c'), 'asc'))) == (('a', 'ASC'), ('b', 'DESC'), (('MAX', 'c'), 'ASC'))
+	with pytest.raises(ValueError):
+		query.order_shape(5)
+	with pytest.raises(ValueError):
+		query.order_shape((('a', 'b', 'c'),))
+# }}}
+
+def test_build_write(): # {{{
+	assert sql('insert', 't', ('a', 'b')) == ('INSERT INTO t (a, b) VALUES (%s, %s)', [])
+	assert sql('update', 't', ('a',), ('>', 'b', 2)) == ('UPDATE t SET a = %s WHERE b > %s', [2])
+	assert sql('delete', 't', (), ('like', 'a', 'x%')) == ('DELETE FROM t WHERE a LIKE %s', ['x%'])
+# }}}
+
+def test_build_shared(): # {{{
+	assert sql('select', 't', 'a', ('=', 'a', 1), owner = 7) == ('SELECT a FROM t WHERE _owner = %s AND a = %s', [7, 1])
+	assert sql('insert', 't', ('a',), owner = 7) == ('INSERT INTO t (a, _owner) VALUES (%s, %s)', [7])
+	with pytest.raises(ValueError):
+		query.build('update', 't', ('_owner',), owner = 7)
+# }}}
+
+def test_build_uses_cache(): # {{{
+	first = query.build('select', 'cached', 'a', ('=', 'a', 1))[0]
+	second, values = query.build('select', 'cached', 'a', ('=', 'a', 2))
+	assert second is first
+	assert values == [2]
+# }}}
+
+@pytest.mark.parametrize('args', [
+	('select', 1, 'a'),
+	('select', 't', 5),
+	('select', 't', (('sum', '*'),)),
+	('select', 't', (('avg', 'a'),)),
+	('select', 't', 'a; DROP TABLE t'),
+	('select', 't', 'a', (), 'a', (('a', 'sideways'),)),
+	('select', 't', 'a', (), (), (), -1),
+	('select', 't', 'a', (), (), (), True),
+	('select', 't', 'a', (), [['a']]),
+	('update', 't', [1]),
+	('merge', 't', ('a',)),
+])
+def test_build_rejects(args): # {{{
+	with pytest.raises((ValueError, AssertionError)):
+		query.build(*args)
+# }}}
+
+def test_union(monkeypatch): # {{{
+	compiled = query.build('select', 'inv', 'a', ('=', 'a', 1), order = 'a')[0]
+	monkeypatch.setattr(query.db, 'backend', backends.SQLite.__new__(backends.SQLite))
+	assert query.union(compiled, ('m1_inv', 'm2_inv')) == 'SELECT * FROM (SELECT %s, a FROM m1_inv WHERE a = %s ORDER BY a ASC) AS u0 UNION ALL SELECT * FROM (SELECT %s, a FROM m2_inv WHERE a = %s ORDER BY a ASC) AS u1'
+	monkeypatch.setattr(query.db, 'backend', backends.MySQL.__new__(backends.MySQL))
+	assert query.union(compiled, ('m1_inv', 'm2_inv')) == '(SELECT %s, a FROM m1_inv WHERE a = %s ORDER BY a ASC LIMIT 18446744073709551615) UNION ALL (SELECT %s, a FROM m2_inv WHERE a = %s ORDER BY a ASC LIMIT 18446744073709551615)'
+# }}}
+
+def test_result_cache(): # {{{
+	results = query.ResultCache(1 << 20, 2)
+	compiled = ('SELECT a FROM ', '')
+	a = results.key('t1', compiled, [1])
+	b = results.key('t2', compiled, [2])
+	assert results.key('t1', compiled, [[1]]) is None
+	results.put(a, [(1,)], results.generation)
+	results.put(b, [(2,)], results.generation)
+	assert results.get(a) == [(1,)]
+	# The least recently used entry is dropped when the cache is full.
+	results.put(results.key('t3', compiled, [3]), [(3,)], results.generation)
+	assert results.get(b) is None
+	assert results.get(a) == [(1,)]
+	results.invalidate('t1')
+	assert results.get(a) is None
+	assert 't1' not in results.tables
+# }}}
+
+def test_result_cache_generation(): # {{{
+	results = query.ResultCache(1 << 20, 10)
+	key = results.key('t', ('SELECT a FROM ', ''), [])
+	generation = results.generation
+	results.invalidate_prefix('t')
+	# The result was read before the invalidation, so it must not be stored.
+	results.put(key, [(1,)], generation)
+	assert results.get(key) is None
+# }}}
+
+def test_result_cache_ttl(monkeypatch): # {{{
+	now = [100.0]
+	monkeypatch.setattr(query.time, 'monotonic', lambda: now[0])
+	results = query.ResultCache(1 << 20, 10, ttl = 5)
+	key = results.key('t', ('SELECT a FROM ', ''), [])
+	results.put(key, [(1,)], results.generation)
+	now[0] += 4
+	assert results.get(key) == [(1,)]
+	now[0] += 1
+	assert results.get(key) is None
+	assert results.bytes == 0 and len(results.tables) == 0
+# }}}
+
+# vim: set foldmethod=marker :
@@ -0,0 +1,94 @@
+# Tests for the schema diff of setup_db(); see schema.py.
+import schema
+
+def columns(*definitions): # {{{
+	'Return the current state of a table, as read_tables() would, from (name, definition) pairs.'
+	return {name: schema.parse_definition(name, definition)[0] for name, definition in definitions}
+# }}}
+
+def test_parse_definition(): # {{{
+	column, plain = schema.parse_definition('id', 'INT(11) PRIMARY KEY AUTO_INCREMENT')
+	assert column.type == 'int'
+	assert column.primary and column.auto_increment
+	assert not column.nullable
+	assert plain == 'INT(11) NOT NULL AUTO_INCREMENT'
+	column, plain = schema.parse_definition('name', "varchar( 20 ) NOT NULL DEFAULT 'it''s' UNIQUE")
+	assert column.type == 'varchar(20)'
+	assert column.default == "it's"
+	assert column.unique and not column.nullable
+	assert plain == "varchar( 20 ) NOT NULL DEFAULT 'it''s'"
+# }}}
+
+def test_same_definition_ignores_spelling(): # {{{
+	a = schema.parse_definition('n', 'integer(11) default NULL')[0]
+	b = schema.parse_definition('n', 'INT')[0]
+	assert a.same_definition(b)
+	assert not a.same_definition(schema.parse_definition('n', 'INT NOT NULL')[0])
+# }}}
+
+def test_plan_unchanged(): # {{{
+	tables = {'scores': columns(('id', 'INT PRIMARY KEY'), ('score', 'INT'))}
+	assert schema.plan(tables, {'scores': [('id', 'int(11) PRIMARY KEY'), ('score', 'integer')]}) == ([], [])
+# }}}
+
+def test_plan_create_and_drop(): # {{{
+	tables = {'old': columns(('a', 'INT'))}
+	steps, warnings = schema.plan(tables, {'new': [('b', 'INT')]})
+	assert steps == [{'table': 'old', 'action': 'drop', 'changes': []}, {'table': 'new', 'action': 'create', 'changes': ['b INT']}]
+	assert warnings == []
+	# Without remove, the old table is kept; without add, the new table is not created.
+	assert schema.plan(tables, {'new': [('b', 'INT')]}, remove = False, add = False) == ([], [])
+# }}}
+
+def test_plan_alter(): # {{{
+	tables = {'t': columns(('id', 'INT PRIMARY KEY'), ('old', 'INT'), ('n', 'INT'))}
+	steps, warnings = schema.plan(tables, {'t': [('id', 'INT PRIMARY KEY'), ('n', 'BIGINT NOT NULL'), ('new', 'VARCHAR(10) UNIQUE')]})
+	assert warnings == []
+	assert steps == [{'table': 't', 'action': 'alter', 'changes': ['DROP COLUMN old', 'MODIFY COLUMN n BIGINT NOT NULL', 'ADD COLUMN new VARCHAR(10)', 'ADD UNIQUE (new)']}]
+# }}}
+
+def test_plan_warnings(): # {{{
+	tables = {'t': columns(('id', 'INT'), ('old', 'INT'))}
+	steps, warnings = schema.plan(tables, {'t': [('id', 'BIGINT'), ('new', 'INT')]}, remove = False, add = False)
+	assert steps == []
+	assert warnings == ['obsolete column old in table t', 'column id in table t does not match its definition', 'extra column new defined in table t']
+# }}}
+
+def test_plan_primary_key(): # {{{
+	tables = {'t': columns(('a', 'INT PRIMARY KEY'), ('b', 'INT NOT NULL'))}
+	steps, warnings = schema.plan(tables, {'t': [('a', 'INT PRIMARY KEY'), ('b', 'INT PRIMARY KEY')]})
+	assert steps[0]['changes'] == ['DROP PRIMARY KEY', 'ADD PRIMARY KEY (a, b)']
+# }}}
+
+def test_plan_replace(): # {{{
+	tables = {'t': columns(('a', 'INT'))}
+	steps, warnings = schema.plan(tables, {'t': [('a', 'INT')]}, replace = True)
+	assert [step['action'] for step in steps] == ['drop', 'create']
+# }}}
+
+def test_shared_tables(): # {{{
+	definition = [('id', 'INT PRIMARY KEY AUTO_INCREMENT'), ('name', 'VARCHAR(20) UNIQUE'), ('n', 'INT')]
+	# The owner column is part of the primary key; unique keys are left to shared_create().
+	assert schema.shared_definition(definition) == [('_owner', 'INT NOT NULL PRIMARY KEY'), ('id', 'INT NOT NULL AUTO_INCREMENT PRIMARY KEY'), ('name', 'VARCHAR(20)'), ('n', 'INT')]
+	assert schema.shared_create(definition) == '_owner INT NOT NULL, id INT NOT NULL AUTO_INCREMENT, name VARCHAR(20), n INT, PRIMARY KEY (_owner, id), KEY (id), UNIQUE (_owner, name)'
+	# Without a primary key, the owner column is still indexed.
+	assert schema.shared_definition([('a', 'INT')]) == [('_owner', 'INT NOT NULL'), ('a', 'INT')]
+	assert schema.shared_create([('a', 'INT')]) == '_owner INT NOT NULL, a INT, KEY (_owner)'
+# }}}
+
+def test_restrict_shared(): # {{{
+	steps = [{'table': 'a', 'action': 'drop', 'changes': []}, {'table': 'b', 'action': 'alter', 'changes': ['DROP COLUMN x']}, {'table': 'c', 'action': 'alter', 'changes': ['DROP COLUMN y', 'ADD COLUMN z INT']}]
+	ret, warnings = schema.restrict_shared(steps)
+	assert ret == [{'table': 'a', 'action': 'delete', 'changes': []}, {'table': 'c', 'action': 'alter', 'changes': ['ADD COLUMN z INT']}]
+	assert warnings == ['not dropping column x of shared table b', 'not dropping column y of shared table c']
+# }}}
+
+def test_fingerprint(): # {{{
+	data = {'t': [['a', 'INT'], ['b', 'INT']]}
+	assert schema.fingerprint(data, True, True) == schema.fingerprint({'t': [['a', 'INT'], ['b', 'INT']]}, 1, 1)
+	# The options and the column order are part of the fingerprint.
+	assert schema.fingerprint(data, True, True) != schema.fingerprint(data, False, True)
+	assert schema.fingerprint(data, True, True) != schema.fingerprint({'t': [['b', 'INT'], ['a', 'INT']]}, True, True)
+# }}}
+
+# vim: set foldmethod=marker :
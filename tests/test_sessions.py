@@ -0,0 +1,99 @@
+# Tests for the session registry; see sessions.py.
+import sessions
+
+def record(connection = 1, channel = 0, gcid = None, state = 'pending', worker = 0): # {{{
+	return {'state': state, 'worker': worker, 'connection': connection, 'channel': channel, 'gcid': gcid, 'name': None, 'game': 1, 'user': 1, 'url': None, 'allow-new-players': False}
+# }}}
+
+def store(ttl = 0): # {{{
+	messages = []
+	return sessions.Store(lambda index, message: messages.append((index, message)), ttl), messages
+# }}}
+
+def test_create_and_activate(): # {{{
+	s, messages = store()
+	dcid = s.create(record(gcid = 5))
+	assert s.get(dcid)['state'] == 'pending'
+	# A managed player gets the same dcid when the game asks again.
+	assert s.create(record(gcid = 5)) == dcid
+	assert s.count('pending') == 1
+	active = s.activate(dcid, 'bob')
+	assert active['state'] == 'active' and active['name'] == 'bob'
+	assert (s.count('pending'), s.count('active')) == (0, 1)
+	# The player is logged in, so no new dcid is handed out, and the dcid cannot be activated again.
+	assert s.create(record(gcid = 5)) is None
+	assert s.activate(dcid, 'bob') is None
+	# Records are copies.
+	s.get(dcid)['state'] = 'pending'
+	assert s.get(dcid)['state'] == 'active'
+# }}}
+
+def test_drop(): # {{{
+	s, messages = store()
+	dcid = s.create(record())
+	assert s.drop(dcid, 'active') is None
+	assert s.drop(dcid, 'pending')['connection'] == 1
+	assert s.get(dcid) is None
+	assert s.count('pending') == 0
+# }}}
+
+def test_index(): # {{{
+	s, messages = store()
+	a = s.create(record(connection = 1, channel = 0, gcid = 1))
+	b = s.create(record(connection = 1, channel = 1, gcid = 2))
+	c = s.create(record(connection = 2, channel = 0, state = 'active'))
+	d = s.create(record(connection = 1, worker = 1))
+	assert s.drop_channel(0, 1, 1) == 1
+	assert s.get(b) is None and s.get(a) is not None
+	assert s.drop_connection(0, 1) == 1
+	assert s.get(a) is None and s.get(c) is not None and s.get(d) is not None
+	# The gcid of a dropped record can get a new dcid.
+	assert s.create(record(connection = 1, channel = 0, gcid = 1)) != a
+	assert s.drop_worker(1) == 1
+	assert s.get(d) is None
+	assert s.connections.keys() == {(0, 1), (0, 2)}
+	assert (s.count('pending'), s.count('active')) == (1, 1)
+# }}}
+
+def test_expiry(monkeypatch): # {{{
+	now = [1000.0]
+	monkeypatch.setattr(sessions.time, 'monotonic', lambda: now[0])
+	s, messages = store(ttl = 10)
+	old = s.create(record(gcid = 1))
+	active = s.create(record(gcid = 2))
+	s.activate(active, 'bob')
+	now[0] += 6
+	refreshed = s.create(record(gcid = 3))
+	# Asking again restarts the time to live.
+	assert s.create(record(gcid = 3)) == refreshed
+	now[0] += 6
+	assert s.get(old) is None
+	assert s.get(refreshed) is not None
+	# Active dcids do not expire.
+	assert s.get(active)['state'] == 'active'
+	now[0] += 10
+	assert s.expire() == 1
+	assert s.count('pending') == 0
+	assert s.get(active) is not None
+# }}}
+
+def test_messages(): # {{{
+	s, messages = store()
+	s.notify(2, {'type': 'x'})
+	s.broadcast({'type': 'y'})
+	assert messages == [(2, {'type': 'x'}), (None, {'type': 'y'})]
+# }}}
+
+def test_bg_calls(): # {{{
+	s, messages = store()
+	gen = s.bg_create(None, record())
+	try:
+		next(gen)
+	except StopIteration as e:
+		dcid = e.value
+	else:
+		assert False, 'the local store must not wait'
+	assert s.get(dcid) is not None
+# }}}
+
+# vim: set foldmethod=marker :
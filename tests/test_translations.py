@@ -0,0 +1,81 @@
+# Tests for the po file parser of the game module; see module/userdata/__init__.py.
+import pytest
+import userdata
+
+po = '''# Dutch translation.
+msgid ""
+msgstr ""
+"Content-Type: text/plain; charset=UTF-8\\n"
+
+# A comment.
+msgid "Hello"
+msgstr "Hallo"
+
+msgid "Long "
+"line"
+msgstr "Lange "
+"regel"
+
+#, fuzzy
+msgid "Unsure"
+msgstr "Onzeker"
+
+msgid "Untranslated"
+msgstr ""
+
+msgctxt "menu"
+msgid "Open"
+msgstr "Openen"
+
+msgid "$1 player"
+msgid_plural "$1 players"
+msgstr[0] "$1 speler"
+msgstr[1] "$1 spelers"
+
+msgid "Café"
+msgstr "Koffie"
+'''.encode('utf-8')
+
+def test_compile_translation(): # {{{
+	assert userdata.compile_translation(po) == {
+			'Hello': 'Hallo',
+			'Long line': 'Lange regel',
+			'menu\x04Open': 'Openen',
+			('$1 player', 0): '$1 speler',
+			('$1 player', 1): '$1 spelers',
+			'Café': 'Koffie',
+		}
+# }}}
+
+def test_compile_translation_charset(): # {{{
+	data = b'msgid ""\nmsgstr "Content-Type: text/plain; charset=ISO-8859-1\\n"\n\nmsgid "caf\\xe9"\nmsgstr "\xe9"\n'
+	assert userdata.compile_translation(data) == {'caf\xe9': '\xe9'}
+# }}}
+
+@pytest.mark.parametrize('data', [b'msgid "a"\nmsgfoo "b"\n', b'"a"\n', b'msgid "a\n'])
+def test_compile_translation_invalid(data): # {{{
+	with pytest.raises((ValueError, SyntaxError)):
+		userdata.compile_translation(data)
+# }}}
+
+def test_parse_translation_cache(tmp_path, monkeypatch): # {{{
+	monkeypatch.setattr(userdata, 'catalog_cache', str(tmp_path))
+	first = userdata.parse_translation(po)
+	assert len(list(tmp_path.iterdir())) == 1
+	# The second parse reads the cache, including the plural keys.
+	monkeypatch.setattr(userdata, 'compile_translation', None)
+	assert userdata.parse_translation(po) == first
+# }}}
+
+def test_read_translations(tmp_path): # {{{
+	(tmp_path / 'nl.po').write_bytes(po)
+	(tmp_path / 'de.po').write_bytes(b'msgfoo "x"\n')
+	(tmp_path / 'notes.txt').write_bytes(po)
+	(tmp_path / '.hidden.po').write_bytes(po)
+	translations = userdata.read_translations(str(tmp_path))
+	assert list(translations) == ['nl']
+	assert translations['nl']['Hello'] == 'Hallo'
+	assert userdata.read_translations(str(tmp_path / 'missing')) == {}
+# }}}
+
+# vim: set foldmethod=marker :
@@ -0,0 +1,85 @@
+# Tests for write-behind buffering; see writebehind.py.
+import writebehind
+
+def buffer(*updates): # {{{
+	'Return a Buffer with updates of table t, given as (condition, data).'
+	ret = writebehind.Buffer()
+	for condition, data in updates:
+		assert ret.add('t', 'g1_t', condition, None, data)
+	return ret
+# }}}
+
+def test_merge(): # {{{
+	b = buffer((('=', 'id', 1), {'x': 1}), (('=', 'id', 2), {'x': 2}), (('=', 'id', 1), {'x': 3, 'y': 4}))
+	assert [(entry.condition, entry.data) for entry in b.entries] == [(('=', 'id', 1), {'x': 3, 'y': 4}), (('=', 'id', 2), {'x': 2})]
+	# Lists and tuples are the same condition.
+	assert b.add('t', 'g1_t', ['=', 'id', 2], None, {'y': 5})
+	assert len(b.entries) == 2
+	assert b.entries[1].data == {'x': 2, 'y': 5}
+# }}}
+
+def test_can_merge(): # {{{
+	# A later update that may touch the same record prevents merging a column that it also writes.
+	b = buffer((('=', 'id', 1), {'x': 1}), (('>', 'id', 0), {'x': 2}))
+	assert not b.can_merge(b.entries[0], {'x': 3})
+	assert b.can_merge(b.entries[0], {'y': 3})
+	# A later update that depends on a column cannot see it change before it.
+	b = buffer((('=', 'id', 1), {'x': 1}), (('=', 'x', 5), {'y': 2}))
+	assert not b.can_merge(b.entries[0], {'x': 3})
+	# Updates of other records, or other tables, do not matter.
+	b = buffer((('=', 'id', 1), {'x': 1}), (('=', 'id', 2), {'x': 2}))
+	assert b.can_merge(b.entries[0], {'x': 3})
+	# An update of the columns of its own condition is never merged.
+	assert not b.can_merge(b.entries[0], {'id': 3})
+# }}}
+
+def test_no_merge_after_condition_change(): # {{{
+	b = buffer((('=', 'id', 1), {'id': 2}), (('=', 'id', 1), {'x': 1}))
+	assert len(b.entries) == 2
+# }}}
+
+def test_unhashable_condition(): # {{{
+	b = writebehind.Buffer()
+	assert not b.add('t', 'g1_t', ('=', 'id', {'a': 1}), None, {'x': 1})
+	assert b.entries == []
+# }}}
+
+def test_take_and_restore(): # {{{
+	b = buffer((('=', 'id', 1), {'x': 1}), (('=', 'id', 2), {'x': 2}), (('=', 'id', 3), {'y': 3}))
+	b.take()
+	assert b.entries == []
+	assert [(group.cmd, group.rows) for group in b.writing] == [('UPDATE g1_t SET x = %s WHERE id = %s', [(1, 1), (2, 2)]), ('UPDATE g1_t SET y = %s WHERE id = %s', [(3, 3)])]
+	assert b.touches('g1_t') and not b.touches('g1_u')
+	b.add('t', 'g1_t', ('=', 'id', 4), None, {'x': 4})
+	assert [entry.condition[2] for entry in b.pending('g1_t')] == [1, 2, 3, 4]
+	b.restore()
+	assert [entry.condition[2] for entry in b.entries] == [1, 2, 3, 4]
+	assert b.writing == []
+# }}}
+
+def test_overlay(): # {{{
+	b = buffer((('=', 'id', 1), {'x': 10}), (('=', 'id', 2), {'x': 20}))
+	assert b.overlay('g1_u', ('=', 'id', 1), ('x',), (), ()) is None
+	# Updates of other records are ignored.
+	assert b.overlay('g1_t', ('=', 'id', 3), ('x',), (), ()) is None
+	entries, extra = b.overlay('g1_t', ('>', 'score', 0), ('x',), (), ())
+	assert [entry.condition for entry in entries] == [('=', 'id', 1), ('=', 'id', 2)] and extra == ['id']
+	# Aggregates, grouping, and order or conditions on changed columns need the written data.
+	assert b.overlay('g1_t', (), (('count', '*'),), (), ()) is False
+	assert b.overlay('g1_t', (), ('x',), ('x',), ()) is False
+	assert b.overlay('g1_t', (), ('id',), (), 'x') is False
+	assert b.overlay('g1_t', ('=', 'x', 10), ('id',), (), ()) is False
+	# Only updates of records selected by = on numbers can be applied.
+	b = buffer((('=', 'name', 'a'), {'x': 1}))
+	assert b.overlay('g1_t', (), ('x',), (), ()) is False
+# }}}
+
+def test_apply(): # {{{
+	b = buffer((('=', 'id', 1), {'x': 10}), (('=', 'id', 1), {'y': 11}))
+	entries, extra = b.overlay('g1_t', (), ('x', 'y', 'x'), (), ())
+	assert extra == ['id']
+	rows = [(1, 2, 1, 1), (3, 4, 3, 2)]
+	assert writebehind.apply(rows, entries, ('x', 'y', 'x'), extra) == [(10, 11, 10), (3, 4, 3)]
+# }}}
+
+# vim: set foldmethod=marker :
@@ -0,0 +1,170 @@
+# Slow query log and request tracing for userdata.
+# db.py reports every database request here; entries are written as JSON lines.
+
+# Imports {{{
+import sys
+import os
+import json
+import time
+import random
+import itertools
+import fhs
+# }}}
+
+fhs.module_info('tracing', 'slow query log and request tracing', '0.1', 'Bas Wijnen <wijnen@debian.org>')
+fhs.module_option('tracing', 'slow-query-ms', 'log database requests that take at least this many milliseconds to run; negative to disable', default = -1, argtype = float)
+fhs.module_option('tracing', 'trace-sample', 'fraction of RPC calls for which all database requests are logged', default = 0, argtype = float)
+fhs.module_option('tracing', 'trace-log', 'file for slow query and trace entries; empty for standard error', default = '')
+fhs.module_option('tracing', 'trace-settings', 'file with slow-query-ms, trace-sample and trace-log settings, which is read again when the server receives SIGHUP', default = '')
+
+'''Log entries: {{{
+Every entry is a JSON object on its own line, with keys:
+	- 'type': 'slow' for a slow query, 'query' for a database request of a
+	  sampled RPC call, 'rpc' for the end of a sampled RPC call.
+	- 'time': wall clock time when the entry was written.
+	- 'trace': id of the sampled RPC call, or None.
+	- 'method', 'channel': the RPC call that made the request, or None if it
+	  was not made by an RPC call (for example during setup).
+For database requests ('slow' and 'query'), also:
+	- 'kind': 'read' or 'write'.
+	- 'query': the statement, with %s for all values (so it is the shape of the query).
+	- 'owner': the owner prefix of the table (see db.py), or None.
+	- 'rows': number of returned or affected rows, or None if unknown.
+	- 'wait_ms': time that the request waited for a worker.
+	- 'ms': time that the request took on the database.
+	- 'transaction': whether the request was part of a transaction.
+For 'rpc' entries, 'ms' is the duration of the call.
+
+Settings can be changed while the server is running: write them to the
+trace-settings file (lines of key = value, with the same keys as the
+options) and send SIGHUP to the server.
+}}}'''
+
+slow_ms = -1
+sample = 0
+log_name = ''
+log = sys.stderr
+settings = ''
+
+class Call: # {{{
+	'RPC call that is running; db.py reads it from current to find out who made a request.'
+	def __init__(self, method, channel, trace): # {{{
+		self.method = method
+		self.channel = channel
+		self.trace = trace
+	# }}}
+# }}}
+
+# The RPC call that is currently being handled by the main thread, or None.
+current = None
+
+trace_ids = itertools.count(1)
+
+@fhs.atinit
+def init(): # {{{
+	global settings
+	values = fhs.module_get_config('tracing')
+	settings = values['trace-settings']
+	configure(values['slow-query-ms'], values['trace-sample'], values['trace-log'])
+	reload()
+# }}}
+
+def configure(new_slow_ms = None, new_sample = None, new_log = None): # {{{
+	'Change settings; arguments that are None are not changed.'
+	global slow_ms, sample, log_name, log
+	if new_slow_ms is not None:
+		slow_ms = float(new_slow_ms)
+	if new_sample is not None:
+		sample = float(new_sample)
+		assert 0 <= sample <= 1
+	if new_log is not None and new_log != log_name:
+		if log is not sys.stderr:
+			log.close()
+		log_name = new_log
+		log = open(log_name, 'a', buffering = 1) if log_name != '' else sys.stderr
+# }}}
+
+def reload(): # {{{
+	'Read the settings file, if there is one.'
+	if settings == '' or not os.path.isfile(settings):
+		return
+	cfg = {key.strip(): value.strip() for key, value in (x.split('=', 1) for x in open(settings).read().split('\n') if '=' in x and not x.strip().startswith('#'))}
+	try:
+		configure(cfg.pop('slow-query-ms', None), cfg.pop('trace-sample', None), cfg.pop('trace-log', None))
+	except (ValueError, AssertionError, OSError) as e:
+		print('invalid trace settings: %s' % e, file = sys.stderr)
+		return
+	for key in cfg:
+		print('ignoring unknown trace setting %s' % key, file = sys.stderr)
+	print('trace settings: slow-query-ms = %s, trace-sample = %s, trace-log = %s' % (slow_ms, sample, log_name or '(stderr)'), file = sys.stderr)
+# }}}
+
+def write(entry): # {{{
+	entry['time'] = time.time()
+	try:
+		log.write(json.dumps(entry, default = str) + '\n')
+	except OSError as e:
+		print('unable to write trace log: %s' % e, file = sys.stderr)
+# }}}
+
+def begin(method, channel): # {{{
+	'Return the Call for a new RPC call, which is sampled for tracing with the configured probability.'
+	return Call(method, channel, next(trace_ids) if sample > 0 and random.random() < sample else None)
+# }}}
+
+def end(call, duration): # {{{
+	'Record the end of an RPC call.'
+	if call.trace is not None:
+		write({'type': 'rpc', 'trace': call.trace, 'method': call.method, 'channel': call.channel, 'ms': duration * 1000})
+# }}}
+
+def run(call, gen): # {{{
+	'''Run the generator of an RPC call, with current set to call while it runs.
+	Use as: return (yield from run(call, gen)), which works the same as (yield from gen).'''
+	global current
+	send = gen.send
+	value = None
+	while True:
+		previous = current
+		current = call
+		try:
+			item = send(value)
+		except StopIteration as e:
+			return e.value
+		finally:
+			current = previous
+		try:
+			value = (yield item)
+		except GeneratorExit:
+			gen.close()
+			raise
+		except BaseException as e:
+			# Pass the exception on to the generator.
+			send = gen.throw
+			value = e
+			continue
+		send = gen.send
+# }}}
+
+def query(call, kind, cmd, owner, rows, wait, duration, transaction): # {{{
+	'Record a database request. Times are in seconds.'
+	slow = slow_ms >= 0 and duration * 1000 >= slow_ms
+	traced = call is not None and call.trace is not None
+	if not slow and not traced:
+		return
+	write({
+		'type': 'slow' if slow else 'query',
+		'trace': call.trace if call is not None else None,
+		'method': call.method if call is not None else None,
+		'channel': call.channel if call is not None else None,
+		'kind': kind,
+		'query': ' '.join(cmd.split()),
+		'owner': owner,
+		'rows': rows,
+		'wait_ms': wait * 1000,
+		'ms': duration * 1000,
+		'transaction': transaction,
+	})
+# }}}
+
+# vim: set foldmethod=marker :
@@ -163,6 +163,62 @@ public:
 		realargs->insert(0, channel);
 		co_return YieldFrom(socket->fgcall(command, realargs, kwargs));
 	}
+	// Batch writes. Rows is a vector of maps, which must all have the same keys. They are written with a single commit.
+	// insert_many returns a vector of the new ids; the others return the number of affected records.
+	Webloop::coroutine insert_many(std::string const &table, std::shared_ptr <Webloop::WebVector> rows) {
+		co_return YieldFrom(fgcall("insert_many", Webloop::WebVector::create(Webloop::WebString::create(table), rows)));
+	}
+	Webloop::coroutine update_many(std::string const &table, std::shared_ptr <Webloop::WebVector> rows, std::shared_ptr <Webloop::WebVector> keys) {
+		co_return YieldFrom(fgcall("update_many", Webloop::WebVector::create(Webloop::WebString::create(table), rows, keys)));
+	}
+	Webloop::coroutine delete_many(std::string const &table, std::shared_ptr <Webloop::WebVector> rows) {
+		co_return YieldFrom(fgcall("delete_many", Webloop::WebVector::create(Webloop::WebString::create(table), rows)));
+	}
+}; // }}}
+
+// Streaming select, for results that are too large for a single reply. {{{
+// Construct it with the arguments for select_stream (table, columns, and optionally condition etc.),
+// then call next() until it returns None. Each call returns a vector of at most chunk rows (0 means the server's maximum).
+template <class Connection>
+class SelectStream {
+	Access <Connection> *access;
+	Webloop::Args args;
+	Webloop::KwArgs kwargs;
+	int chunk;
+	std::shared_ptr <Webloop::WebObject> token;
+	bool started;
+public:
+	SelectStream(Access <Connection> *access, Webloop::Args args, Webloop::KwArgs kwargs = {}, int chunk = 0) : access(access), args(args), kwargs(kwargs ? kwargs : Webloop::WebMap::create()), chunk(chunk), token(Webloop::WebNone::create()), started(false) {
+		if (chunk > 0)
+			(*this->kwargs)["chunk"] = Webloop::WebInt::create(chunk);
+	}
+	~SelectStream() { close(); }
+	Webloop::coroutine next() {
+		std::shared_ptr <Webloop::WebObject> reply;
+		if (!started) {
+			started = true;
+			reply = YieldFrom(access->fgcall("select_stream", args, kwargs));
+		}
+		else if (token->get_type() == Webloop::WebObject::NONE)
+			co_return Webloop::WebNone::create();
+		else if (chunk > 0)
+			reply = YieldFrom(access->fgcall("select_next", Webloop::WebVector::create(token, Webloop::WebInt::create(chunk))));
+		else
+			reply = YieldFrom(access->fgcall("select_next", Webloop::WebVector::create(token)));
+		auto r = reply->as_map();
+		token = (*r)["token"];
+		if ((*r)["rows"]->as_vector()->size() == 0 && token->get_type() == Webloop::WebObject::NONE)
+			co_return Webloop::WebNone::create();
+		co_return (*r)["rows"];
+	}
+	// Stop retrieving rows; this does not wait for a reply.
+	void close() {
+		started = true;
+		if (token->get_type() == Webloop::WebObject::NONE)
+			return;
+		access->bgcall("select_close", Webloop::WebVector::create(token));
+		token = Webloop::WebNone::create();
+	}
 }; // }}}
 
 // Commandline options. {{{
@@ -0,0 +1,360 @@
+# Write-behind buffering of updates for userdata.
+# Games that store positions or timers update the same record many times per
+# second. For tables where a channel enables write-behind, update() stores the
+# change here instead of writing it, and the buffer is written to the database
+# periodically, with one statement per record instead of one per call.
+
+# Imports {{{
+import sys
+import time
+import fhs
+import websocketd
+import db
+import query
+# }}}
+
+fhs.module_info('writebehind', 'write-behind buffering of updates', '0.1', 'Bas Wijnen <wijnen@debian.org>')
+fhs.module_option('writebehind', 'write-behind-interval', 'maximum number of seconds that updates to write-behind tables are kept in memory', default = 1, argtype = float)
+fhs.module_option('writebehind', 'write-behind-size', 'maximum number of buffered updates per channel; when it is reached, the buffer is written immediately', default = 1000, argtype = int)
+
+'''Buffering: {{{
+A Buffer belongs to one channel. It holds a list of entries, which are
+updates (table, condition, changed columns) in the order that they must be
+written. An update with the same table and condition as an earlier entry is
+merged into that entry, as long as this cannot change the result: no later
+entry may touch the same records in a way that depends on the order. If it
+might, the update is added as a new entry. For the usual case, updates of
+single records by their id, all updates of the same record are merged.
+
+The buffer is written (flushed) when:
+	- the oldest entry is interval seconds old.
+	- it has size entries.
+	- the channel writes to a buffered table in any other way, or starts a
+	  transaction; so the channel always sees its own changes.
+	- the channel reads from a buffered table and the buffered changes can
+	  not be applied to the result; see below.
+	- the channel is closed.
+	- the server stops (see shutdown()).
+Other channels do not see buffered changes until they are written.
+
+A select() of the channel does not flush the buffer if the result can be
+computed without it (see Buffer.overlay()):
+	- Updates of records that the select cannot return (their conditions
+	  require a different value of a column than the select condition) are
+	  ignored, unless they change a column of the select condition.
+	- Otherwise, the rows are read from the database and the buffered
+	  updates are applied to them in memory. This is done if the updates
+	  select their records with = comparisons on numbers (such as the id),
+	  and do not change the columns of any condition or of the order.
+	  Changed values are returned as the channel passed them, without
+	  the conversion that the database would do.
+The buffer is still written for selects with aggregates or GROUP BY, for
+updates that select their records in any other way, and for all other
+reads, such as select_stream() and the data of managed players.
+
+The buffer is written in groups of entries with the same statement. A group
+is removed from the buffer when it is committed. If writing fails because
+the database cannot be reached, the group and all later ones are put back
+and written again after interval seconds, so updates that were accepted are
+not lost. Other errors can not be solved by trying again; those updates are
+reported and dropped.
+
+When the server stops, shutdown() waits for the workers and writes the groups
+that were not committed, and the entries that were not written yet.
+}}}'''
+
+interval = 1
+size = 1000
+
+# All buffers that may contain entries, for shutdown().
+buffers = set()
+
+@fhs.atinit
+def init(): # {{{
+	global interval, size
+	values = fhs.module_get_config('writebehind')
+	interval = values['write-behind-interval']
+	size = values['write-behind-size']
+	assert interval > 0
+	assert size > 0
+# }}}
+
+def freeze(value): # {{{
+	'Return a hashable version of a condition, for use as a key.'
+	if isinstance(value, (list, tuple)):
+		return tuple(freeze(v) for v in value)
+	hash(value)
+	return value
+# }}}
+
+def condition_columns(condition): # {{{
+	'Return the set of columns that are used in a condition (see query.py for the format).'
+	if len(condition) == 0:
+		return set()
+	op = condition[0].upper()
+	if op in ('AND', 'OR', 'NOT'):
+		return set().union(*(condition_columns(c) for c in condition[1:]))
+	return {condition[1]}
+# }}}
+
+def equalities(condition): # {{{
+	'''Return a dict of column: value that all records matching the condition have, or None if the condition is not a conjunction of = comparisons.'''
+	if len(condition) == 0:
+		return None
+	op = condition[0].upper()
+	if op == 'AND':
+		ret = {}
+		for c in condition[1:]:
+			sub = equalities(c)
+			if sub is None:
+				return None
+			ret.update(sub)
+		return ret
+	if op == '=' and condition[2] is not None:
+		return {condition[1]: condition[2]}
+	return None
+# }}}
+
+def disjoint(a, b): # {{{
+	'Return True if conditions a and b can not match the same record.'
+	a = equalities(a)
+	b = equalities(b)
+	if a is None or b is None:
+		return False
+	return any(column in b and b[column] != value for column, value in a.items())
+# }}}
+
+class Entry: # {{{
+	'An update that has not been written yet. data is a dict of column: value.'
+	def __init__(self, table, t, condition, owner, data): # {{{
+		self.table = table
+		self.t = t
+		self.condition = condition
+		self.owner = owner
+		self.data = data
+		self.columns = condition_columns(condition)
+	# }}}
+	def statement(self): # {{{
+		'Return the SQL and values for writing this entry.'
+		(head, tail), values = query.build('update', self.table, tuple(self.data), self.condition, owner = self.owner)
+		return head + self.t + tail, tuple(self.data.values()) + tuple(values)
+	# }}}
+# }}}
+
+class Group: # {{{
+	'Entries with the same statement that are written together. rows is the list of values for the statement.'
+	def __init__(self, cmd, t): # {{{
+		self.cmd = cmd
+		self.t = t
+		self.rows = []
+		self.entries = []
+		self.done = False
+	# }}}
+	def write(self, connection, c, cmd, rows, in_transaction): # {{{
+		'Write the rows; see db.bg_wait(). This runs in a worker thread. done is set when they are committed, for shutdown().'
+		ret = db.pooled_write_many(connection, c, cmd, rows, in_transaction)
+		self.done = True
+		return ret
+	# }}}
+# }}}
+
+class Buffer: # {{{
+	'''Buffered updates of one channel.
+	tables is the set of (unprefixed) tables for which the channel enabled write-behind.'''
+	def __init__(self): # {{{
+		self.tables = set()
+		self.entries = []
+		# Last entry for each (prefixed table, condition), if it can still be merged.
+		self.index = {}
+		# Groups that are being written, in order.
+		self.writing = []
+		self.flushing = False
+		# Generators that wait for the running flush to finish.
+		self.waiting = []
+		self.timer = False
+	# }}}
+	def pending(self, t): # {{{
+		'Return the entries of prefixed table t that are not committed, in the order that they are written.'
+		return [entry for group in self.writing for entry in group.entries if entry.t == t] + [entry for entry in self.entries if entry.t == t]
+	# }}}
+	def overlay(self, t, condition, columns, group, order): # {{{
+		'''Find how a select on prefixed table t can see the buffered updates; see "Buffering" above.
+		Returns None if no buffered update can change the result, False if
+		the buffer must be written first, or (entries, extra) to apply the
+		entries to the rows with apply(). extra is the list of columns that
+		must be selected after columns, because the entries need them.'''
+		entries = self.pending(t)
+		if len(entries) == 0:
+			return None
+		selected = condition_columns(condition)
+		written = set().union(*(entry.data for entry in entries))
+		if len(written & selected) > 0:
+			return False
+		entries = [entry for entry in entries if not disjoint(entry.condition, condition)]
+		if len(entries) == 0:
+			return None
+		if len(group) > 0 or not all(isinstance(column, str) for column in columns):
+			return False
+		ordered = set(column if isinstance(column, str) else column[1] for column, direction in query.order_shape(order))
+		if len(written & ordered) > 0:
+			return False
+		extra = []
+		for entry in entries:
+			match = equalities(entry.condition)
+			if match is None or len(written & set(match)) > 0 or not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in match.values()):
+				return False
+			extra.extend(column for column in match if column not in columns and column not in extra)
+		return entries, extra
+	# }}}
+	def touches(self, t): # {{{
+		'Return True if there are buffered or running updates of prefixed table t, or of any table if t is None.'
+		return any(t is None or entry.t == t for entry in self.entries) or any(t is None or group.t == t for group in self.writing)
+	# }}}
+	def add(self, table, t, condition, owner, data): # {{{
+		'''Buffer an update. data is a dict of column: value.
+		Returns False if the update cannot be buffered; it must be written by the caller.'''
+		try:
+			key = (t, freeze(condition))
+		except TypeError:
+			return False
+		if len(self.entries) == 0:
+			buffers.add(self)
+		entry = self.index.get(key)
+		if entry is not None and self.can_merge(entry, data):
+			entry.data.update(data)
+			return True
+		entry = Entry(table, t, condition, owner, dict(data))
+		self.entries.append(entry)
+		# An update that changes the columns of its own condition cannot be merged with later ones.
+		if len(entry.columns & set(data)) == 0:
+			self.index[key] = entry
+		else:
+			self.index.pop(key, None)
+		return True
+	# }}}
+	def can_merge(self, entry, data): # {{{
+		'''Return True if writing data as part of entry gives the same result as writing it after all later entries.
+		That is the case if no later entry could change the same records, or depend on their new values, or change which records entry selects.'''
+		columns = set(data)
+		if len(entry.columns & columns) > 0:
+			return False
+		for later in self.entries[self.entries.index(entry) + 1:]:
+			if later.t != entry.t or disjoint(entry.condition, later.condition):
+				continue
+			if len(columns & set(later.data)) > 0 or len(columns & later.columns) > 0 or len(entry.columns & set(later.data)) > 0:
+				return False
+		return True
+	# }}}
+	def take(self): # {{{
+		'Move all entries to writing, as Groups; consecutive entries with the same SQL are combined.'
+		for entry in self.entries:
+			cmd, values = entry.statement()
+			if len(self.writing) == 0 or self.writing[-1].cmd != cmd:
+				self.writing.append(Group(cmd, entry.t))
+			self.writing[-1].rows.append(values)
+			self.writing[-1].entries.append(entry)
+		self.entries = []
+		self.index = {}
+	# }}}
+	def restore(self): # {{{
+		'Put the entries of groups that were not written back in front of the buffer, so they are written again.'
+		self.entries = [entry for group in self.writing for entry in group.entries] + self.entries
+		self.writing = []
+	# }}}
+# }}}
+
+def apply(rows, entries, columns, extra): # {{{
+	'''Apply buffered updates to rows that were selected with columns + extra; see Buffer.overlay().
+	Returns the rows with only columns.'''
+	positions = {}
+	for i, column in enumerate(tuple(columns) + tuple(extra)):
+		positions.setdefault(column, []).append(i)
+	matches = [equalities(entry.condition) for entry in entries]
+	ret = []
+	for row in rows:
+		row = list(row)
+		for entry, match in zip(entries, matches):
+			if all(row[positions[column][0]] == value for column, value in match.items()):
+				for column, value in entry.data.items():
+					for i in positions.get(column, ()):
+						row[i] = value
+		ret.append(tuple(row[:len(columns)]))
+	return ret
+# }}}
+
+def flush(buffer, wake = None): # {{{
+	'''Write all entries of a buffer.
+	If a flush is already running, wait for it first, so the changes are written in order.'''
+	if wake is None:
+		wake = (yield)
+	while buffer.flushing:
+		buffer.waiting.append(wake)
+		yield
+	if len(buffer.entries) == 0:
+		return
+	buffer.flushing = True
+	try:
+		buffer.take()
+		while len(buffer.writing) > 0:
+			group = buffer.writing[0]
+			try:
+				yield from db.bg_wait(wake, group.write, group.cmd, group.rows, None)
+			except (db.backend.OperationalError, RuntimeError) as e:
+				# The database cannot be reached, or is too busy; try again later.
+				print('unable to write %d buffered updates of %s; trying again: %s' % (len(group.rows), group.t, e), file = sys.stderr)
+				buffer.restore()
+				schedule(buffer)
+				break
+			except Exception as e:
+				# Writing these changes again would fail again; report and drop them.
+				print('dropping %d buffered updates of %s: %s' % (len(group.rows), group.t, e), file = sys.stderr)
+			finally:
+				query.results.invalidate(group.t)
+			buffer.writing.pop(0)
+	finally:
+		buffer.flushing = False
+		if len(buffer.entries) == 0 and len(buffer.writing) == 0:
+			buffers.discard(buffer)
+		waiting = buffer.waiting
+		buffer.waiting = []
+		for w in waiting:
+			w(None)
+# }}}
+
+def schedule(buffer): # {{{
+	'Make sure that the buffer is flushed within interval seconds.'
+	if buffer.timer:
+		return
+	buffer.timer = True
+	def timeout():
+		buffer.timer = False
+		if len(buffer.entries) > 0:
+			websocketd.call(None, flush, buffer)
+	websocketd.add_timeout(time.time() + interval, timeout)
+# }}}
+
+def shutdown(): # {{{
+	'''Write all buffers with the synchronous connection. This is called when the server stops.
+	The workers are waited for first; groups that they committed are not written again.'''
+	if len(buffers) == 0:
+		return
+	if db.executor is not None:
+		db.executor.shutdown(wait = True)
+	count = 0
+	for buffer in list(buffers):
+		groups = [group for group in buffer.writing if not group.done]
+		buffer.writing = []
+		for group in groups:
+			for values in group.rows:
+				db.write(group.cmd, *values)
+				count += 1
+		for entry in buffer.entries:
+			cmd, values = entry.statement()
+			db.write(cmd, *values)
+			count += 1
+		buffer.entries = []
+	buffers.clear()
+	print('wrote %d buffered updates' % count, file = sys.stderr)
+# }}}
+
+# vim: set foldmethod=marker :